@@ -0,0 +1,119 @@
+"""Bytes on the wire and CPU per request for a 5000-row /history response.
+
+Compares the previous endpoint shape (plain dict return, default FastAPI encoder, no
+compression) with orjson rendering and each negotiated content coding. No database is
+needed: the endpoints return a synthetic payload shaped like aggregated history.
+
+    python benchmarks/history_payload.py [--rows 5000] [--requests 50]
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from fastapi import FastAPI, Response
+
+from mqttap.api.compression import CompressionMiddleware
+from mqttap.api.responses import fast_json
+
+
+def build_payload(rows: int) -> dict[str, Any]:
+    rng = random.Random(42)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    temperature = 21.0
+    result = []
+    for index in range(rows):
+        temperature += rng.uniform(-0.05, 0.05)
+        result.append(
+            {
+                "bucket": start + timedelta(minutes=index),
+                "temperature": round(temperature, 3),
+                "humidity": round(45 + rng.uniform(-2, 2), 3),
+                "pressure": round(1013 + rng.uniform(-1, 1), 3),
+            }
+        )
+    return {"table": "t_sensor_room", "is_json": True, "rows": result, "interval": "1 minute"}
+
+
+def build_apps(payload: dict[str, Any]) -> tuple[FastAPI, FastAPI]:
+    default_app = FastAPI()
+
+    @default_app.get("/history")
+    async def default_history() -> dict[str, Any]:
+        return payload
+
+    fast_app = FastAPI()
+    fast_app.add_middleware(CompressionMiddleware, minimum_size=1024)
+
+    @fast_app.get("/history")
+    async def fast_history(response: Response) -> Response:
+        return fast_json(payload, response)
+
+    return default_app, fast_app
+
+
+async def request(app: FastAPI, accept_encoding: str) -> int:
+    """Drive one GET /history through the ASGI stack and return the body size sent."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/history",
+        "raw_path": b"/history",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"accept-encoding", accept_encoding.encode())],
+        "client": ("127.0.0.1", 50000),
+        "server": ("bench", 80),
+    }
+    sent = 0
+
+    async def receive() -> dict[str, Any]:
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message: dict[str, Any]) -> None:
+        nonlocal sent
+        if message["type"] == "http.response.body":
+            sent += len(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return sent
+
+
+async def measure(app: FastAPI, accept_encoding: str, requests: int) -> tuple[int, float]:
+    wire_bytes = await request(app, accept_encoding)
+    started = time.process_time()
+    for _ in range(requests):
+        await request(app, accept_encoding)
+    elapsed = time.process_time() - started
+    return wire_bytes, elapsed / requests * 1000
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    default_app, fast_app = build_apps(build_payload(args.rows))
+    cases = [
+        ("default encoder, identity", default_app, ""),
+        ("orjson, identity", fast_app, ""),
+        ("orjson + gzip", fast_app, "gzip"),
+        ("orjson + br", fast_app, "br"),
+        ("orjson + zstd", fast_app, "zstd"),
+    ]
+    print(f"{args.rows} rows, {args.requests} requests per case")
+    print(f"{'case':<28}{'bytes':>12}{'cpu ms/req':>14}")
+    for label, app, accept_encoding in cases:
+        wire_bytes, cpu_ms = await measure(app, accept_encoding, args.requests)
+        print(f"{label:<28}{wire_bytes:>12}{cpu_ms:>14.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
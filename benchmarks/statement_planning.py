@@ -0,0 +1,160 @@
+"""What statement preparation and planning cost the ingest and history hot paths.
+
+Runs the JSON-topic INSERT and the raw /history SELECT against a scratch table, each in
+two shapes: as previously generated (columns in payload/request order, so the SQL text
+varies between calls) and canonical (stable column order, one text per table). Every
+shape runs with the prepared statement cache disabled and enabled, and EXPLAIN ANALYZE
+reports the server-side planning time of one execution. Needs a Postgres database:
+
+    python benchmarks/statement_planning.py [--dsn postgresql+asyncpg://...] [--calls 2000]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable
+
+from sqlalchemy import TextClause, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from mqttap.config import settings
+from mqttap.db.dynamic import insert_statement, quote_ident
+
+TABLE = "bench_statement_planning"
+FIELDS = [f"field_{index}" for index in range(12)]
+
+StatementFactory = Callable[[random.Random], tuple[TextClause, dict[str, Any]]]
+
+
+def legacy_insert(rng: random.Random) -> tuple[TextClause, dict[str, Any]]:
+    # Payload keys arrive in any order and some are missing, as with real devices.
+    keys = rng.sample(FIELDS, rng.randint(len(FIELDS) - 3, len(FIELDS)))
+    values = {key: rng.random() for key in keys}
+    column_names = ", ".join(quote_ident(key) for key in values)
+    placeholders = ", ".join(f":{key}" for key in values)
+    return text(f"INSERT INTO {TABLE} ({column_names}) VALUES ({placeholders})"), values
+
+
+def canonical_insert(rng: random.Random) -> tuple[TextClause, dict[str, Any]]:
+    keys = rng.sample(FIELDS, rng.randint(len(FIELDS) - 3, len(FIELDS)))
+    values = {key: rng.random() for key in keys}
+    columns = tuple(FIELDS)
+    return insert_statement(TABLE, columns), {column: values.get(column) for column in columns}
+
+
+def _select(fields: list[str]) -> TextClause:
+    select_cols = ", ".join(quote_ident(column) for column in ["ts", *fields])
+    return text(
+        f"SELECT {select_cols} FROM {TABLE} WHERE ts >= :from_ts ORDER BY ts DESC LIMIT :limit"
+    )
+
+
+def _select_params(rng: random.Random) -> dict[str, Any]:
+    start = datetime.now(timezone.utc) - timedelta(minutes=rng.randint(5, 60))
+    return {"from_ts": start, "limit": 500}
+
+
+def legacy_select(rng: random.Random) -> tuple[TextClause, dict[str, Any]]:
+    return _select(rng.sample(FIELDS, 4)), _select_params(rng)
+
+
+def canonical_select(rng: random.Random) -> tuple[TextClause, dict[str, Any]]:
+    return _select(sorted(rng.sample(FIELDS, 4))), _select_params(rng)
+
+
+CASES: dict[str, StatementFactory] = {
+    "insert, legacy": legacy_insert,
+    "insert, canonical": canonical_insert,
+    "select, legacy": legacy_select,
+    "select, canonical": canonical_select,
+}
+
+
+def build_engine(dsn: str, cache_size: int) -> AsyncEngine:
+    url = make_url(dsn)
+    if url.drivername == "postgresql":
+        url = url.set(drivername="postgresql+asyncpg")
+    return create_async_engine(
+        url,
+        pool_size=1,
+        max_overflow=0,
+        connect_args={"prepared_statement_cache_size": cache_size, "statement_cache_size": cache_size},
+    )
+
+
+async def setup(engine: AsyncEngine, rows: int) -> None:
+    columns = ", ".join(f"{quote_ident(field)} double precision" for field in FIELDS)
+    async with engine.begin() as conn:
+        await conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+        await conn.execute(
+            text(f"CREATE TABLE {TABLE} (id BIGSERIAL PRIMARY KEY, ts TIMESTAMPTZ NOT NULL DEFAULT now(), {columns})")
+        )
+        await conn.execute(text(f"CREATE INDEX ON {TABLE} (ts)"))
+        fill = ", ".join("random()" for _ in FIELDS)
+        await conn.execute(
+            text(
+                f"INSERT INTO {TABLE} (ts, {', '.join(quote_ident(field) for field in FIELDS)}) "
+                f"SELECT now() - make_interval(secs => g), {fill} "
+                f"FROM generate_series(1, :rows) AS g"
+            ),
+            {"rows": rows},
+        )
+        await conn.execute(text(f"ANALYZE {TABLE}"))
+
+
+async def run_case(engine: AsyncEngine, factory: StatementFactory, calls: int) -> list[float]:
+    rng = random.Random(7)
+    timings = []
+    async with engine.connect() as conn:
+        for _ in range(calls):
+            sql, params = factory(rng)
+            started = time.perf_counter()
+            await conn.execute(sql, params)
+            timings.append((time.perf_counter() - started) * 1000)
+        await conn.rollback()
+    return timings
+
+
+async def planning_ms(engine: AsyncEngine, factory: StatementFactory) -> float:
+    sql, params = factory(random.Random(7))
+    explain = text(f"EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) {sql.text}")
+    async with engine.connect() as conn:
+        plan = (await conn.execute(explain, params)).scalar_one()
+        await conn.rollback()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Planning Time"]
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default=settings.database_dsn)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    uncached = build_engine(args.dsn, 0)
+    cached = build_engine(args.dsn, settings.db_statement_cache_size)
+    try:
+        await setup(uncached, args.rows)
+        print(f"{'case':<20} {'plan ms':>8} {'no cache ms':>12} {'cache ms':>10} {'saved':>7}")
+        for name, factory in CASES.items():
+            plan = await planning_ms(uncached, factory)
+            without = statistics.mean(await run_case(uncached, factory, args.calls))
+            with_cache = statistics.mean(await run_case(cached, factory, args.calls))
+            saved = 1 - with_cache / without if without else 0.0
+            print(f"{name:<20} {plan:>8.3f} {without:>12.3f} {with_cache:>10.3f} {saved:>6.0%}")
+    finally:
+        async with uncached.begin() as conn:
+            await conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+        await uncached.dispose()
+        await cached.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
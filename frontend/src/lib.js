@@ -120,6 +120,7 @@ export const api = {
   }),
   topics: () => request('/topics'),
   history: (params) => request(`/history${toQuery(params)}`),
+  historyFormula: (params) => request(`/history/formula${toQuery(params)}`),
   previewHistoryImport: (payload) => request('/history-import/preview', {
     method: 'POST',
     body: JSON.stringify(payload)
@@ -1,6 +1,5 @@
 import {
   alignTimeSeries,
-  buildFormulaEvaluator,
   normalizeNumericValue,
   palette
 } from '../chart-utils.js'
@@ -10,6 +9,7 @@ export async function fetchChartSeries(api, item, isAggEnabled, valueFromRow, ma
   let labels = []
   let datasets = []
   let error = ''
+  let serverTruncated = false
   const limit = Number.isFinite(maxPoints) ? Math.max(1, maxPoints) : 5000
 
   if (type === 'single') {
@@ -23,12 +23,14 @@ export async function fetchChartSeries(api, item, isAggEnabled, valueFromRow, ma
       params.agg = item.agg
       const count = Math.max(1, Number(item.intervalCount) || 1)
       params.interval = count > 1 ? `${count} ${item.interval}` : item.interval
+      if (item.alignTime) params.align = true
     } else {
       params.order = 'desc'
       params.limit = maxPoints
     }
     const data = await api.history(params)
     const rows = data.rows || []
+    serverTruncated = Boolean(data.truncated)
     labels = isAggEnabled(item.agg)
       ? rows.map(r => r.bucket)
       : rows.map(r => r.ts).reverse()
@@ -61,12 +63,14 @@ export async function fetchChartSeries(api, item, isAggEnabled, valueFromRow, ma
       params.agg = item.agg
       const count = Math.max(1, Number(item.intervalCount) || 1)
       params.interval = count > 1 ? `${count} ${item.interval}` : item.interval
+      if (item.alignTime) params.align = true
     } else {
       params.order = 'desc'
       params.limit = maxPoints
     }
     const data = await api.history(params)
     const rows = data.rows || []
+    serverTruncated = Boolean(data.truncated)
     labels = isAggEnabled(item.agg)
       ? rows.map(r => r.bucket)
       : rows.map(r => r.ts).reverse()
@@ -93,43 +97,24 @@ export async function fetchChartSeries(api, item, isAggEnabled, valueFromRow, ma
     const params = {
       topic: item.topic,
       fields: item.fields.join(','),
+      formula: item.formula,
       from_ts: item.fromTs || undefined,
-      to_ts: item.toTs || undefined
+      to_ts: item.toTs || undefined,
+      limit
     }
     if (isAggEnabled(item.agg)) {
       params.agg = item.agg
       params.interval = count > 1 ? `${count} ${item.interval}` : item.interval
-    } else {
-      // Formula series can discard rows when one of the source fields is empty.
-      // Fetch a wider raw window first, then trim back to the chart limit.
-      params.order = 'desc'
-      params.limit = Math.min(limit * Math.max(2, Math.min(item.fields.length, 5)), 25000)
     }
-    const data = await api.history(params)
+    // The backend evaluates the formula over the whole window and downsamples the result.
+    const data = await api.historyFormula(params)
     const rows = data.rows || []
-    const evaluator = buildFormulaEvaluator(item.fields, item.formula)
-    const formulaRows = isAggEnabled(item.agg) ? rows : rows.slice().reverse()
     const labelKey = isAggEnabled(item.agg) ? 'bucket' : 'ts'
-    const formulaLabels = []
-    const formulaValues = []
-
-    formulaRows.forEach((row) => {
-      const numericValues = item.fields.map(name => normalizeNumericValue(row[name]))
-      if (numericValues.some(value => !Number.isFinite(value))) return
-      let result
-      try {
-        result = evaluator(...numericValues)
-      } catch (err) {
-        error = 'errors.formulaEvaluation'
-        return
-      }
-      if (!Number.isFinite(result)) {
-        error = 'errors.divisionByZero'
-        return
-      }
-      formulaValues.push(result)
-      formulaLabels.push(row[labelKey])
-    })
+    const formulaLabels = rows.map(row => row[labelKey])
+    const formulaValues = rows.map(row => row.value)
+    if (data.invalid_points) {
+      error = 'errors.divisionByZero'
+    }
     labels = formulaLabels
     datasets = [
       {
@@ -148,11 +133,13 @@ export async function fetchChartSeries(api, item, isAggEnabled, valueFromRow, ma
 
   const trimmed = trimSeries(labels, datasets, limit)
   const alignInterval = isAggEnabled(item.agg) ? item.interval : null
+  // Aggregated single/multi series are already aligned to the bucket grid by the backend.
+  const serverAligned = isAggEnabled(item.agg) && type !== 'formula'
   const aligned = alignTimeSeries(
     trimmed.labels,
     trimmed.datasets,
     alignInterval,
-    item.alignTime,
+    item.alignTime && !serverAligned,
     limit,
     item.intervalCount || 1
   )
@@ -160,7 +147,7 @@ export async function fetchChartSeries(api, item, isAggEnabled, valueFromRow, ma
     labels: aligned.labels,
     datasets: aligned.datasets,
     error,
-    truncated: trimmed.truncated || aligned.truncated
+    truncated: serverTruncated || trimmed.truncated || aligned.truncated
   }
 }
 
@@ -1,21 +1,55 @@
+import argparse
 import asyncio
 import logging.config
+import os
 import sys
 
 import uvicorn
 
+from mqttap.api.lifecycle import RUN_MODES
+from mqttap.config import settings
 from mqttap.logging_config import get_logging_config
 
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
+APPS = {
+    "combined": "mqttap.api.app:app",
+    "api": "mqttap.api.app:app",
+    "ingest": "mqttap.api.ingest:app",
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run MQTTap.")
+    parser.add_argument(
+        "--mode",
+        choices=RUN_MODES,
+        default=settings.run_mode,
+        help="combined: API and MQTT consumer; api: API only; ingest: MQTT consumer only",
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="API worker processes (api mode only)")
+    args = parser.parse_args()
+    if args.workers > 1 and args.mode != "api":
+        # Every worker would start its own consumer under the same MQTT client id.
+        parser.error(f"--workers > 1 needs --mode api, got --mode {args.mode}")
+    return args
+
 
 if __name__ == "__main__":
+    args = parse_args()
+    # A single worker loads the app in this process, where settings already exist;
+    # spawned workers read the mode from the environment like any other setting.
+    settings.run_mode = args.mode
+    os.environ["MQTTAP_RUN_MODE"] = args.mode
     logging.config.dictConfig(get_logging_config())
     uvicorn.run(
-        "mqttap.api.app:app",
-        host="0.0.0.0",
-        port=8000,
+        APPS[args.mode],
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
         reload=False,
         log_config=get_logging_config(),
     )
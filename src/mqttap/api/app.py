@@ -1,25 +1,35 @@
 ﻿import asyncio
+import hashlib
 import json
 import csv
 import logging
 import math
+import os
 import secrets
 import sys
+import tempfile
 from contextlib import asynccontextmanager
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from io import StringIO
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
-from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import UploadFile
+import numpy as np
 from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
 
 from mqttap.api.auth import authenticate, require_admin, require_user
+from mqttap.api.compression import CompressionMiddleware
+from mqttap.api.query_guard import query_guard
+from mqttap.api.responses import FastJSONResponse, fast_json
 from mqttap.api.schemas import (
     ChangePasswordRequest,
+    CsvImportJobRequest,
     CsvImportRequest,
     InviteCreateRequest,
     InviteUpdateRequest,
@@ -36,23 +46,108 @@ from mqttap.security import hash_password, verify_password
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-from mqttap.db.core import engine
-from mqttap.db.init import init_base_schema
-from mqttap.services.mqtt import MqttConsumer
+from mqttap.db.core import (
+    begin_with_timeout,
+    engine,
+    maintenance_engine,
+    read_replica_engines,
+    statement_cache_stats,
+)
+from mqttap.db.routing import ReadRouter, read_consistent_at, read_engine
+from mqttap.api.lifecycle import check_run_mode, start_services, stop_services
+from mqttap.services.admission import AdmissionController, estimate_scanned_rows
+from mqttap.services.agg_cache import AggregateCache
+from mqttap.services.backfills import backfill_log
+from mqttap.services.formula import (
+    FormulaError,
+    downsample_indices,
+    evaluate_formula,
+    parse_formula,
+    to_float_array,
+)
+from mqttap.services.csv_import import (
+    CONFLICT_MODES,
+    ChunkValidator,
+    CsvStream,
+    ImportResult,
+    chunk_validator,
+    copy_csv_stream,
+    copy_rows,
+    create_staging_table,
+    detect_csv_delimiter,
+    ensure_tzaware,
+    infer_datetime_parser,
+    merge_staged_rows,
+    normalize_csv_headers,
+    run_in_thread,
+    validate_import_record,
+)
+from mqttap.services.import_jobs import ImportJob, ImportJobs
+from mqttap.services.ingest_process import IngestProcess
+from mqttap.services.latest import latest_values
+from mqttap.services.metrics import metrics
 from mqttap.services.settings import load_settings, save_settings
+from mqttap.services.topic_stats import topic_stats
+from mqttap.services.watermarks import write_watermarks
+from mqttap.services.sketches import (
+    SKETCH_BUCKET_SECONDS,
+    SketchBuffer,
+    parse_quantile_agg,
+    query_quantiles,
+    rebuild_sketches,
+)
 
 MAX_CHART_POINTS = 5000
 CSV_IMPORT_PREVIEW_LIMIT = 20
+FORMULA_MAX_SOURCE_ROWS = 50000
+JOIN_MAX_SERIES = 8
+AUTO_INTERVALS = [
+    (1, "second"), (2, "second"), (5, "second"), (10, "second"), (15, "second"), (30, "second"),
+    (1, "minute"), (2, "minute"), (5, "minute"), (10, "minute"), (15, "minute"), (30, "minute"),
+    (1, "hour"), (2, "hour"), (3, "hour"), (6, "hour"), (12, "hour"),
+    (1, "day"), (2, "day"), (7, "day"), (14, "day"), (30, "day"),
+]
+SCALAR_VALUE_EXPR = "CASE WHEN value_type = 'float' THEN value_float WHEN value_type = 'int' THEN value_int END"
+
+aggregate_cache = AggregateCache(
+    max_buckets=settings.agg_cache_max_buckets,
+    seal_seconds=settings.agg_cache_seal_seconds,
+)
+
+admission = AdmissionController(
+    light_limit=settings.admission_max_concurrent,
+    heavy_limit=settings.admission_heavy_concurrent,
+    user_limit=settings.admission_user_concurrent,
+    heavy_rows=settings.admission_heavy_rows,
+    queue_seconds=settings.admission_queue_seconds,
+    max_queue=settings.admission_max_queue,
+)
+
+read_router = ReadRouter(
+    engine,
+    read_replica_engines,
+    max_lag=settings.replica_max_lag_seconds,
+    check_seconds=settings.replica_check_seconds,
+)
+
+import_jobs = ImportJobs(
+    engine,
+    directory=settings.csv_import_dir or os.path.join(tempfile.gettempdir(), "mqttap-imports"),
+    ttl_seconds=settings.csv_import_job_ttl_seconds,
+    workers=settings.csv_import_workers,
+)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await init_base_schema(engine)
-    consumer = MqttConsumer()
-    await consumer.start()
+    mode = check_run_mode(settings.run_mode)
+    if mode == "ingest":
+        raise RuntimeError("Ingest-only mode serves mqttap.api.ingest:app, not the API")
+    consumer = await start_services(mode)
     app.state.mqtt_consumer = consumer
     yield
-    await consumer.stop()
+    await import_jobs.close()
+    await stop_services(consumer)
 
 
 app = FastAPI(title="MQTTap", lifespan=lifespan)
@@ -66,12 +161,21 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=settings.compression_min_size,
+    encodings=[name.strip() for name in settings.compression_encodings.split(",") if name.strip()],
+)
 
 
 
 @api_router.get("/health")
-async def health() -> dict[str, str]:
-    return {"status": "ok"}
+async def health(request: Request) -> dict[str, Any]:
+    result: dict[str, Any] = {"status": "ok", "mode": settings.run_mode}
+    consumer = getattr(request.app.state, "mqtt_consumer", None)
+    if consumer is not None:
+        result["ingest"] = consumer.status()
+    return result
 
 
 def _normalize_max_points(value: Any, default: int = MAX_CHART_POINTS) -> int:
@@ -245,6 +349,13 @@ async def get_settings(user=Depends(require_admin)) -> dict[str, Any]:
 @api_router.get("/settings/public")
 async def get_public_settings(user=Depends(require_user)) -> dict[str, Any]:
     data = await load_settings(engine)
+    return {
+        "float_precision": data.get("float_precision"),
+        "max_points": await _get_user_max_points(user),
+    }
+
+
+async def _get_user_max_points(user: dict[str, Any]) -> int:
     async with engine.begin() as conn:
         row = (
             await conn.execute(
@@ -252,10 +363,7 @@ async def get_public_settings(user=Depends(require_user)) -> dict[str, Any]:
                 {"id": user["id"]},
             )
         ).mappings().first()
-    return {
-        "float_precision": data.get("float_precision"),
-        "max_points": _normalize_max_points(row["max_points"] if row else MAX_CHART_POINTS),
-    }
+    return _normalize_max_points(row["max_points"] if row else MAX_CHART_POINTS)
 
 
 @api_router.put("/settings")
@@ -498,8 +606,8 @@ async def delete_invite(invite_id: int, user=Depends(require_admin)) -> dict[str
     return {"status": "ok"}
 
 
-@api_router.get("/charts")
-async def list_charts(user=Depends(require_user)) -> list[dict[str, Any]]:
+@api_router.get("/charts", response_class=FastJSONResponse)
+async def list_charts(user=Depends(require_user)) -> Response:
     await _require_feature_access(user, "charts")
     allowed_topics, allowed_signals = await _get_user_acl(user)
     sql = text(
@@ -541,7 +649,7 @@ async def list_charts(user=Depends(require_user)) -> list[dict[str, Any]]:
                     if not fields or any(field not in restricted for field in fields):
                         continue
         result.append(item)
-    return result
+    return fast_json(result)
 
 
 @api_router.post("/charts")
@@ -720,104 +828,127 @@ def _parse_interval(value: str | None) -> tuple[int, str] | None:
     return count, unit
 
 
-def _local_timezone():
-    return datetime.now().astimezone().tzinfo or timezone.utc
+def _interval_to_timedelta(interval_count: int, interval_unit: str) -> timedelta:
+    return timedelta(**{f"{interval_unit}s": interval_count})
 
 
-def _ensure_tzaware(value: datetime) -> datetime:
-    if value.tzinfo is None:
-        return value.replace(tzinfo=_local_timezone())
-    return value
+def _format_interval(interval_count: int, interval_unit: str) -> str:
+    return interval_unit if interval_count == 1 else f"{interval_count} {interval_unit}"
 
 
-def _parse_import_datetime(value: str) -> datetime:
-    raw = value.strip()
-    if not raw:
-        raise ValueError("datetime is empty")
-    try:
-        return _ensure_tzaware(datetime.fromisoformat(raw.replace("Z", "+00:00")))
-    except ValueError:
-        pass
-    for fmt in (
-        "%d.%m.%y %H:%M:%S",
-        "%d.%m.%Y %H:%M:%S",
-        "%d.%m.%y %H:%M",
-        "%d.%m.%Y %H:%M",
-        "%Y-%m-%d %H:%M:%S",
-        "%Y-%m-%d %H:%M",
-    ):
-        try:
-            return _ensure_tzaware(datetime.strptime(raw, fmt))
-        except ValueError:
-            continue
-    raise ValueError("unsupported datetime format")
+async def _history_time_span(
+    table_name: str,
+    dt_from: datetime | None,
+    dt_to: datetime | None,
+) -> tuple[datetime, datetime] | None:
+    end = dt_to or datetime.now(timezone.utc)
+    if dt_from:
+        return dt_from, end
+    async with begin_with_timeout(engine) as conn:
+        first_ts = await topic_stats.history_start(conn, table_name)
+    if first_ts is None:
+        return None
+    return first_ts, end
 
 
-def _detect_csv_delimiter(csv_text: str) -> str:
-    lines = csv_text.splitlines()
-    if not lines:
-        return ";"
-    sample = "\n".join(lines[:5])
-    try:
-        dialect = csv.Sniffer().sniff(sample, delimiters=";,\t|")
-        if dialect.delimiter:
-            return dialect.delimiter
-    except csv.Error:
-        pass
-    first_line = lines[0]
-    counts = {delimiter: first_line.count(delimiter) for delimiter in (";", "\t", ",", "|")}
-    best = max(counts, key=counts.get)
-    return best if counts[best] > 0 else ";"
-
-
-def _normalize_csv_headers(fieldnames: list[str | None] | None) -> list[str]:
-    if not fieldnames:
-        raise HTTPException(status_code=400, detail="CSV header row is required")
-    headers: list[str] = []
-    for index, fieldname in enumerate(fieldnames, start=1):
-        header = (fieldname or "").lstrip("\ufeff").strip()
-        if not header:
-            raise HTTPException(status_code=400, detail=f"CSV header #{index} is empty")
-        if header in headers:
-            raise HTTPException(status_code=400, detail=f"Duplicate CSV header: {header}")
-        headers.append(header)
-    return headers
-
-
-def _normalize_number_string(value: str) -> str:
-    normalized = value.strip().replace("\u00a0", "").replace(" ", "")
-    if "," in normalized and "." not in normalized:
-        normalized = normalized.replace(",", ".")
-    return normalized
-
-
-def _coerce_import_value(raw: str | None, column_type: str, float_precision: int) -> Any:
-    if raw is None:
-        return None
-    text_value = str(raw).strip()
-    if text_value == "":
-        return None
-    normalized_type = column_type.lower()
-    if normalized_type == "bigint":
-        parsed = float(_normalize_number_string(text_value))
-        if not math.isfinite(parsed) or not parsed.is_integer():
-            raise ValueError("expected integer")
-        return int(parsed)
-    if normalized_type == "double precision":
-        parsed = float(_normalize_number_string(text_value))
-        if not math.isfinite(parsed):
-            raise ValueError("expected finite number")
-        return round(parsed, float_precision)
-    if normalized_type == "boolean":
-        normalized_value = text_value.lower()
-        if normalized_value in {"true", "1", "yes", "on", "да"}:
-            return True
-        if normalized_value in {"false", "0", "no", "off", "нет"}:
-            return False
-        raise ValueError("expected boolean")
-    if normalized_type == "jsonb":
-        return json.loads(text_value)
-    return text_value
+async def _estimate_scan_rows(
+    table_name: str,
+    dt_from: datetime | None,
+    dt_to: datetime | None,
+) -> int:
+    """Rows a range scan of ``table_name`` will read, for admission control.
+
+    Uses the ingest statistics when they cover the start of the range and falls back to
+    the planner's estimate otherwise.
+    """
+    dt_from = _ensure_tz(dt_from)
+    dt_to = _ensure_tz(dt_to)
+    sql = text(
+        """
+        SELECT table_name, message_count, first_ts, last_ts
+        FROM topic_stats
+        WHERE table_name = :table_name
+        """
+    )
+    async with engine.begin() as conn:
+        row = (await conn.execute(sql, {"table_name": table_name})).mappings().first()
+    stats = topic_stats.overlay([row or {"table_name": table_name}])[0]
+    estimate = estimate_scanned_rows(
+        stats.get("message_count"), stats.get("first_ts"), stats.get("last_ts"), dt_from, dt_to
+    )
+    if estimate is not None:
+        return estimate
+
+    where = []
+    params: dict[str, Any] = {}
+    if dt_from:
+        where.append("ts >= :from_ts")
+        params["from_ts"] = dt_from
+    if dt_to:
+        where.append("ts <= :to_ts")
+        params["to_ts"] = dt_to
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+    explain_sql = text(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM {quote_ident(table_name)} {where_sql}")
+    async with begin_with_timeout(engine) as conn:
+        plan = (await conn.execute(explain_sql, params)).scalar_one()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def _bucket_count(span: tuple[datetime, datetime], step: timedelta) -> int:
+    seconds = max((span[1] - span[0]).total_seconds(), 0)
+    return math.ceil(seconds / step.total_seconds()) + 1
+
+
+async def _resolve_interval(
+    interval: str | None,
+    table_name: str,
+    dt_from: datetime | None,
+    dt_to: datetime | None,
+    max_points: int,
+    *,
+    min_seconds: int = 1,
+) -> tuple[int, str]:
+    """Parse ``interval`` (or pick one for ``auto``) and enforce the bucket cap."""
+    candidates = [
+        (count, unit)
+        for count, unit in AUTO_INTERVALS
+        if _interval_to_timedelta(count, unit).total_seconds() % min_seconds == 0
+    ]
+    if interval and interval.strip().lower() == "auto":
+        span = await _history_time_span(table_name, _ensure_tz(dt_from), _ensure_tz(dt_to))
+        if span is None:
+            return candidates[0]
+        for count, unit in candidates:
+            if _bucket_count(span, _interval_to_timedelta(count, unit)) <= max_points:
+                return count, unit
+        return candidates[-1]
+
+    parsed = _parse_interval(interval)
+    if not parsed:
+        raise HTTPException(status_code=400, detail="Invalid interval")
+    span = await _history_time_span(table_name, _ensure_tz(dt_from), _ensure_tz(dt_to))
+    if span is None:
+        return parsed
+    max_buckets = settings.history_max_buckets
+    if _bucket_count(span, _interval_to_timedelta(*parsed)) <= max_buckets:
+        return parsed
+    if settings.history_bucket_policy == "clamp":
+        requested = _interval_to_timedelta(*parsed)
+        for count, unit in candidates:
+            step = _interval_to_timedelta(count, unit)
+            if step >= requested and _bucket_count(span, step) <= max_buckets:
+                return count, unit
+        return candidates[-1]
+    raise HTTPException(
+        status_code=400,
+        detail=f"Interval too small for the requested range (more than {max_buckets} buckets)",
+    )
+
+
+def _ensure_tz(value: datetime | None) -> datetime | None:
+    return ensure_tzaware(value) if value else None
 
 
 def _normalize_allowed_topics(value: Any) -> list[str] | None:
@@ -1004,9 +1135,9 @@ async def _get_topic_context(
 def _parse_csv_records(csv_text: str, delimiter: str | None) -> tuple[str, list[str], list[dict[str, str]]]:
     if not csv_text or not csv_text.strip():
         raise HTTPException(status_code=400, detail="CSV is empty")
-    actual_delimiter = delimiter or _detect_csv_delimiter(csv_text)
+    actual_delimiter = delimiter or detect_csv_delimiter(csv_text)
     reader = csv.DictReader(StringIO(csv_text), delimiter=actual_delimiter)
-    headers = _normalize_csv_headers(reader.fieldnames)
+    headers = normalize_csv_headers(reader.fieldnames)
     reader.fieldnames = headers
     records: list[dict[str, str]] = []
     for row in reader:
@@ -1017,7 +1148,7 @@ def _parse_csv_records(csv_text: str, delimiter: str | None) -> tuple[str, list[
 
 
 def _validate_csv_import_payload(
-    payload: CsvImportRequest,
+    field_mapping: dict[str, str],
     headers: list[str],
     visible_fields: list[str],
 ) -> tuple[str, dict[str, str]]:
@@ -1025,7 +1156,7 @@ def _validate_csv_import_payload(
     mapping: dict[str, str] = {}
     assigned_targets: set[str] = set()
 
-    for source_column, target_field in payload.field_mapping.items():
+    for source_column, target_field in field_mapping.items():
         clean_column = source_column.strip()
         clean_target = target_field.strip()
         if not clean_column or not clean_target:
@@ -1060,59 +1191,19 @@ def _build_csv_import_preview(
     valid_rows: list[dict[str, Any]] = []
     skipped_rows = 0
 
+    parse_datetime = infer_datetime_parser(record.get(datetime_column) for record in records)
     for row_index, record in enumerate(records, start=2):
-        row_errors: list[dict[str, Any]] = []
-        raw_dt = record.get(datetime_column, "")
-        try:
-            parsed_dt = _parse_import_datetime(raw_dt)
-        except ValueError as exc:
-            row_errors.append(
-                {
-                    "row": row_index,
-                    "column": datetime_column,
-                    "value": raw_dt,
-                    "message": f"Invalid datetime: {exc}",
-                }
-            )
-            parsed_dt = None
-
-        values: dict[str, Any] = {}
-        for field, source_column in field_mapping.items():
-            raw_value = record.get(source_column, "")
-            try:
-                coerced_value = _coerce_import_value(
-                    raw_value,
-                    column_types.get(field, "text"),
-                    float_precision,
-                )
-            except (TypeError, ValueError, json.JSONDecodeError) as exc:
-                row_errors.append(
-                    {
-                        "row": row_index,
-                        "column": source_column,
-                        "field": field,
-                        "value": raw_value,
-                        "message": f"Invalid value for {field}: {exc}",
-                    }
-                )
-                continue
-            if coerced_value is not None:
-                values[field] = coerced_value
-
+        normalized_row, row_errors = validate_import_record(
+            row_index, record, datetime_column, field_mapping, column_types, float_precision, parse_datetime
+        )
         if row_errors:
             errors.extend(row_errors)
             continue
-        if parsed_dt is None:
-            continue
-        if not values:
+        if normalized_row is None:
             skipped_rows += 1
             continue
 
-        normalized_row = {"ts": parsed_dt}
-        preview_row = {"ts": parsed_dt.isoformat()}
-        for field in field_mapping:
-            normalized_row[field] = values.get(field)
-            preview_row[field] = values.get(field)
+        preview_row = {**normalized_row, "ts": normalized_row["ts"].isoformat()}
         valid_rows.append(normalized_row)
         if len(preview_rows) < CSV_IMPORT_PREVIEW_LIMIT:
             preview_rows.append(preview_row)
@@ -1130,15 +1221,23 @@ def _build_csv_import_preview(
     }
 
 
-@api_router.get("/topics")
-async def list_topics(user=Depends(require_user)) -> list[dict[str, Any]]:
+@api_router.get("/topics", response_class=FastJSONResponse)
+async def list_topics(user=Depends(require_user)) -> Response:
     allowed_topics, allowed_signals = await _get_user_acl(user)
-    sql = text("SELECT topic, table_name, is_json FROM topic_registry ORDER BY topic")
-    async with engine.begin() as conn:
+    sql = text(
+        """
+        SELECT r.topic, r.table_name, r.is_json,
+               s.message_count, s.last_ts, s.rate_ewma, s.rate_at
+        FROM topic_registry r
+        LEFT JOIN topic_stats s ON s.table_name = r.table_name
+        ORDER BY r.topic
+        """
+    )
+    async with read_router.route([]) as target, target.engine.begin() as conn:
         rows = (await conn.execute(sql)).mappings().all()
 
     result = []
-    for row in rows:
+    for row in topic_stats.overlay(rows):
         if not _is_topic_allowed(row["topic"], allowed_topics):
             continue
         columns = await get_table_columns(engine, row["table_name"])
@@ -1152,11 +1251,85 @@ async def list_topics(user=Depends(require_user)) -> list[dict[str, Any]]:
                 "table": row["table_name"],
                 "is_json": row["is_json"],
                 "fields": fields,
+                "stats": {
+                    "message_count": row["message_count"] or 0,
+                    "last_ts": row["last_ts"],
+                    "rate": row["rate"],
+                },
             }
         )
+    return fast_json(result)
+
+
+@api_router.get("/metrics")
+async def get_metrics(request: Request, user=Depends(require_admin)) -> dict[str, Any]:
+    result = {
+        **metrics.snapshot(),
+        "pools": {"api": engine.pool.status(), "maintenance": maintenance_engine.pool.status()},
+        "statement_cache": statement_cache_stats(),
+    }
+    consumer = getattr(request.app.state, "mqtt_consumer", None)
+    if isinstance(consumer, IngestProcess):
+        result["ingest"] = {**consumer.status(), "metrics": consumer.metrics_snapshot()}
     return result
 
 
+@api_router.get("/topic-stats", response_class=FastJSONResponse)
+async def list_topic_stats(user=Depends(require_admin)) -> Response:
+    sql = text(
+        """
+        SELECT r.topic, r.table_name, r.is_json,
+               s.message_count, s.bytes, s.schema_changes, s.first_ts, s.last_ts,
+               s.rate_ewma, s.rate_at,
+               pg_total_relation_size(to_regclass(quote_ident(r.table_name))) AS table_size
+        FROM topic_registry r
+        LEFT JOIN topic_stats s ON s.table_name = r.table_name
+        """
+    )
+    async with engine.begin() as conn:
+        rows = (await conn.execute(sql)).mappings().all()
+    result = topic_stats.overlay(rows)
+    for item in result:
+        for key in ("message_count", "bytes", "schema_changes"):
+            item[key] = item[key] or 0
+    result.sort(key=lambda item: (item["rate"] or 0, item["message_count"]), reverse=True)
+    return fast_json(result)
+
+
+@api_router.get("/latest", response_class=FastJSONResponse)
+async def latest(
+    topics: list[str] | None = Query(None),
+    user=Depends(require_user),
+) -> Response:
+    await _require_history_or_charts_access(user)
+    allowed_topics, allowed_signals = await _get_user_acl(user)
+    sql = text("SELECT topic, table_name FROM topic_registry ORDER BY topic")
+    async with engine.begin() as conn:
+        rows = (await conn.execute(sql)).mappings().all()
+    requested = set(topics) if topics else None
+    await latest_values.refresh(engine)
+
+    result = []
+    for row in rows:
+        if requested is not None and row["topic"] not in requested:
+            continue
+        if not _is_topic_allowed(row["topic"], allowed_topics):
+            continue
+        samples = latest_values.get(row["table_name"])
+        fields = _filter_fields_by_acl(row["topic"], list(samples), allowed_signals)
+        if not fields:
+            continue
+        result.append(
+            {
+                "topic": row["topic"],
+                "values": {
+                    field: {"ts": samples[field][0], "value": samples[field][1]} for field in fields
+                },
+            }
+        )
+    return fast_json(result)
+
+
 @api_router.post("/history-import/preview")
 async def preview_history_import(payload: CsvImportRequest, user=Depends(require_user)) -> dict[str, Any]:
     await _require_feature_access(user, "history")
@@ -1165,7 +1338,7 @@ async def preview_history_import(payload: CsvImportRequest, user=Depends(require
     float_precision = int(runtime.get("float_precision", settings.float_precision))
     actual_delimiter, headers, records = _parse_csv_records(payload.csv_text, payload.delimiter)
     datetime_column, field_mapping = _validate_csv_import_payload(
-        payload, headers, topic_context["visible_fields"]
+        payload.field_mapping, headers, topic_context["visible_fields"]
     )
     preview = _build_csv_import_preview(
         records,
@@ -1192,7 +1365,7 @@ async def commit_history_import(payload: CsvImportRequest, user=Depends(require_
     float_precision = int(runtime.get("float_precision", settings.float_precision))
     actual_delimiter, headers, records = _parse_csv_records(payload.csv_text, payload.delimiter)
     datetime_column, field_mapping = _validate_csv_import_payload(
-        payload, headers, topic_context["visible_fields"]
+        payload.field_mapping, headers, topic_context["visible_fields"]
     )
     preview = _build_csv_import_preview(
         records,
@@ -1207,29 +1380,297 @@ async def commit_history_import(payload: CsvImportRequest, user=Depends(require_
     if not valid_rows:
         raise HTTPException(status_code=400, detail="No valid rows to import")
 
-    column_names = ["ts", *field_mapping.keys()]
-    quoted_columns = ", ".join(quote_ident(column) for column in column_names)
-    placeholders = ", ".join(f":{column}" for column in column_names)
-    sql = text(
-        f"""
-        INSERT INTO {quote_ident(topic_context["table_name"])} ({quoted_columns})
-        VALUES ({placeholders})
-        """
-    )
-    async with engine.begin() as conn:
-        await conn.execute(sql, valid_rows)
-
+    table_name = topic_context["table_name"]
+    result = ImportResult()
+    result.add_rows(valid_rows, list(field_mapping))
+    if payload.conflict == "keep":
+        column_names = ["ts", *field_mapping.keys()]
+        quoted_columns = ", ".join(quote_ident(column) for column in column_names)
+        placeholders = ", ".join(f":{column}" for column in column_names)
+        sql = text(
+            f"""
+            INSERT INTO {quote_ident(table_name)} ({quoted_columns})
+            VALUES ({placeholders})
+            """
+        )
+        async with maintenance_engine.begin() as conn:
+            await conn.execute(sql, valid_rows)
+            await backfill_log.record(conn, table_name, result.first_ts)
+            await topic_stats.record_history_start(conn, table_name, result.first_ts)
+            await write_watermarks.record(conn, [table_name])
+
+        sketches = SketchBuffer()
+        for row in valid_rows:
+            sketches.add_values(table_name, row["ts"], {field: row[field] for field in field_mapping})
+        await sketches.flush(maintenance_engine)
+    else:
+        fields = list(field_mapping)
+        async with maintenance_engine.begin() as conn:
+            staging = await create_staging_table(conn, table_name, ["ts", *fields])
+            await copy_rows(conn, staging, ["ts", *fields], topic_context["columns"], valid_rows)
+            await _merge_import(conn, staging, table_name, fields, payload.conflict, result)
+            await backfill_log.record(conn, table_name, result.first_ts)
+            await topic_stats.record_history_start(conn, table_name, result.first_ts)
+            await write_watermarks.record(conn, [table_name])
+
+    await _finish_history_import(table_name, result)
     return {
         "status": "ok",
         "topic": topic_context["topic"],
         "delimiter": actual_delimiter,
-        "imported_rows": len(valid_rows),
+        **_import_counts(result),
         "skipped_rows": preview["summary"]["skipped_rows"],
     }
 
 
-@api_router.get("/history")
+@api_router.post("/history-import/upload")
+async def upload_history_import(request: Request, user=Depends(require_user)) -> dict[str, Any]:
+    """Import a CSV sent as multipart ``file`` with ``topic``, ``field_mapping`` (JSON) and
+    an optional ``delimiter``.
+
+    The upload is spooled to disk and read back in chunks that are validated and written
+    with COPY in one transaction, so memory use does not grow with the file size. Any
+    invalid row rolls the import back and is reported like the preview does.
+    """
+    await _require_feature_access(user, "history")
+    async with request.form(max_files=1) as form:
+        upload = form.get("file")
+        topic = form.get("topic")
+        if not isinstance(upload, UploadFile) or not isinstance(topic, str):
+            raise HTTPException(status_code=400, detail="file and topic are required")
+        try:
+            field_mapping = json.loads(str(form.get("field_mapping") or "{}"))
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="field_mapping must be a JSON object") from None
+        if not isinstance(field_mapping, dict):
+            raise HTTPException(status_code=400, detail="field_mapping must be a JSON object")
+        delimiter = form.get("delimiter")
+        delimiter = delimiter if isinstance(delimiter, str) and delimiter else None
+        conflict = form.get("conflict") or "keep"
+        if conflict not in CONFLICT_MODES:
+            raise HTTPException(status_code=400, detail=f"conflict must be one of {', '.join(CONFLICT_MODES)}")
+
+        topic_context = await _get_topic_context(topic, user, require_json=True)
+        runtime = await load_settings(engine)
+        float_precision = int(runtime.get("float_precision", settings.float_precision))
+        stream = await asyncio.to_thread(CsvStream, upload.file, delimiter)
+        try:
+            datetime_column, mapping = _validate_csv_import_payload(
+                field_mapping, stream.headers, topic_context["visible_fields"]
+            )
+            validate = chunk_validator(datetime_column, mapping, topic_context["columns"], float_precision)
+            result = ImportResult()
+            await _import_csv_stream(stream, topic_context, mapping, validate, result, conflict=conflict)
+        finally:
+            stream.close()
+
+    return {
+        "status": "ok",
+        "topic": topic_context["topic"],
+        "delimiter": stream.delimiter,
+        **_import_counts(result),
+        "skipped_rows": result.skipped_rows,
+    }
+
+
+@api_router.post("/history-import/jobs")
+async def create_history_import_job(request: Request, user=Depends(require_user)) -> dict[str, Any]:
+    """Upload a CSV (multipart ``file``, ``topic``, optional ``delimiter``) for a background import."""
+    await _require_feature_access(user, "history")
+    async with request.form(max_files=1) as form:
+        upload = form.get("file")
+        topic = form.get("topic")
+        if not isinstance(upload, UploadFile) or not isinstance(topic, str):
+            raise HTTPException(status_code=400, detail="file and topic are required")
+        delimiter = form.get("delimiter")
+        delimiter = delimiter if isinstance(delimiter, str) and delimiter else None
+        await _get_topic_context(topic, user, require_json=True)
+        job = await import_jobs.create(user["id"], topic, upload.file, delimiter)
+    return job.describe()
+
+
+@api_router.get("/history-import/jobs/{job_id}")
+async def get_history_import_job(job_id: str, user=Depends(require_user)) -> dict[str, Any]:
+    await _require_feature_access(user, "history")
+    return (await import_jobs.get(job_id, user["id"])).describe()
+
+
+@api_router.post("/history-import/jobs/{job_id}/preview")
+async def preview_history_import_job(
+    job_id: str, payload: CsvImportJobRequest, user=Depends(require_user)
+) -> dict[str, Any]:
+    """Validate the rows sampled at upload against ``field_mapping``; the file is not re-read."""
+    await _require_feature_access(user, "history")
+    job = await import_jobs.get(job_id, user["id"], with_sample=True)
+    topic_context = await _get_topic_context(job.topic, user, require_json=True)
+    runtime = await load_settings(engine)
+    float_precision = int(runtime.get("float_precision", settings.float_precision))
+    datetime_column, field_mapping = _validate_csv_import_payload(
+        payload.field_mapping, job.headers, topic_context["visible_fields"]
+    )
+    preview = _build_csv_import_preview(
+        [record for _, record in job.sample],
+        datetime_column,
+        field_mapping,
+        topic_context["columns"],
+        float_precision,
+    )
+    return {
+        "topic": topic_context["topic"],
+        "delimiter": job.delimiter,
+        "headers": job.headers,
+        "preview_rows": preview["preview_rows"],
+        "errors": preview["errors"],
+        "summary": {**preview["summary"], "complete": job.sample_complete},
+    }
+
+
+@api_router.post("/history-import/jobs/{job_id}/commit", status_code=202)
+async def commit_history_import_job(
+    job_id: str, payload: CsvImportJobRequest, user=Depends(require_user)
+) -> dict[str, Any]:
+    await _require_feature_access(user, "history")
+    job = await import_jobs.get(job_id, user["id"])
+    topic_context = await _get_topic_context(job.topic, user, require_json=True)
+    runtime = await load_settings(engine)
+    float_precision = int(runtime.get("float_precision", settings.float_precision))
+    datetime_column, field_mapping = _validate_csv_import_payload(
+        payload.field_mapping, job.headers, topic_context["visible_fields"]
+    )
+    big_file = job.size >= settings.csv_import_process_pool_bytes
+    validate = chunk_validator(
+        datetime_column,
+        field_mapping,
+        topic_context["columns"],
+        float_precision,
+        import_jobs.executor() if big_file else None,
+    )
+
+    async def run(job: ImportJob) -> None:
+        stream = await run_in_thread(CsvStream.open, job.path, job.delimiter)
+        try:
+            await _import_csv_stream(
+                stream,
+                topic_context,
+                field_mapping,
+                validate,
+                job.result,
+                in_flight=import_jobs.workers if big_file else 1,
+                conflict=payload.conflict,
+            )
+        finally:
+            stream.close()
+
+    await import_jobs.start(job, run)
+    return job.describe()
+
+
+@api_router.delete("/history-import/jobs/{job_id}")
+async def cancel_history_import_job(job_id: str, user=Depends(require_user)) -> dict[str, Any]:
+    """Cancel a job; a running import is rolled back."""
+    await _require_feature_access(user, "history")
+    job = await import_jobs.get(job_id, user["id"])
+    return (await import_jobs.cancel(job)).describe()
+
+
+async def _import_csv_stream(
+    stream: CsvStream,
+    topic_context: dict[str, Any],
+    field_mapping: dict[str, str],
+    validate: ChunkValidator,
+    result: ImportResult,
+    in_flight: int = 1,
+    conflict: str = "keep",
+) -> None:
+    """Copy a validated CSV stream into the topic table in one transaction.
+
+    Unless ``conflict`` is ``keep`` the rows are staged and merged on ``ts``.
+    """
+    table_name = topic_context["table_name"]
+    fields = list(field_mapping)
+    async with maintenance_engine.begin() as conn:
+        staging = None
+        if conflict != "keep":
+            staging = await create_staging_table(conn, table_name, ["ts", *fields])
+        await copy_csv_stream(
+            conn,
+            stream,
+            table_name,
+            field_mapping,
+            topic_context["columns"],
+            validate,
+            result,
+            settings.csv_import_chunk_rows,
+            in_flight,
+            staging_table=staging,
+        )
+        if result.invalid_rows:
+            raise HTTPException(
+                status_code=400,
+                detail={
+                    "message": "CSV import has errors",
+                    "errors": result.errors,
+                    "summary": result.summary,
+                },
+            )
+        if not result.imported_rows:
+            raise HTTPException(status_code=400, detail="No valid rows to import")
+        if staging is not None:
+            await _merge_import(conn, staging, table_name, fields, conflict, result)
+        await backfill_log.record(conn, table_name, result.first_ts)
+        await topic_stats.record_history_start(conn, table_name, result.first_ts)
+        await write_watermarks.record(conn, [table_name])
+    await _finish_history_import(table_name, result)
+
+
+async def _merge_import(
+    conn: AsyncConnection,
+    staging: str,
+    table_name: str,
+    fields: list[str],
+    conflict: str,
+    result: ImportResult,
+) -> None:
+    result.inserted_rows, result.updated_rows = await merge_staged_rows(
+        conn, staging, table_name, fields, conflict
+    )
+    if result.inserted_rows or result.updated_rows:
+        await rebuild_sketches(conn, table_name, fields, result.first_ts, result.last_ts)
+
+
+def _import_counts(result: ImportResult) -> dict[str, int]:
+    if result.inserted_rows is None:
+        return {"imported_rows": result.imported_rows}
+    return {
+        "imported_rows": result.inserted_rows + result.updated_rows,
+        "inserted_rows": result.inserted_rows,
+        "updated_rows": result.updated_rows,
+        "duplicate_rows": result.imported_rows - result.inserted_rows - result.updated_rows,
+    }
+
+
+async def _finish_history_import(table_name: str, result: ImportResult) -> None:
+    """Make committed import rows visible to replicas routing, caches and current values.
+
+    This covers the importing process right away; other API workers catch up through
+    the backfill log the import recorded.
+    """
+    if read_router.enabled:
+        async with maintenance_engine.begin() as conn:
+            lsn = (await conn.execute(text("SELECT pg_current_wal_lsn()::text"))).scalar_one()
+        read_router.note_write(table_name, lsn)
+    if result.first_ts is not None:
+        aggregate_cache.invalidate(table_name, result.first_ts)
+    write_watermarks.bump(table_name)
+    for field, (ts, value) in result.latest.items():
+        latest_values.update(table_name, ts, {field: value})
+    await latest_values.flush(maintenance_engine)
+
+
+@api_router.get("/history", response_class=FastJSONResponse)
 async def history(
+    request: Request,
+    response: Response,
     topic: str,
     fields: str | None = Query(None),
     from_ts: str | None = Query(None),
@@ -1238,8 +1679,11 @@ async def history(
     interval: str | None = Query(None),
     limit: int = Query(MAX_CHART_POINTS, ge=1),
     order: str = Query("desc"),
+    fill: str | None = Query(None),
+    align: bool = Query(False),
+    fresh: bool = Query(False),
     user=Depends(require_user),
-) -> dict[str, Any]:
+) -> Response:
     await _require_history_or_charts_access(user)
     topic_context = await _get_topic_context(topic, user)
     table_name = topic_context["table_name"]
@@ -1257,35 +1701,553 @@ async def history(
     dt_from = _parse_dt(from_ts)
     dt_to = _parse_dt(to_ts)
     limit = min(limit, MAX_CHART_POINTS)
+    if fill not in (None, "null", "previous", "linear"):
+        raise HTTPException(status_code=400, detail="Invalid fill")
+    if (fill or align) and not agg:
+        raise HTTPException(status_code=400, detail="fill and align require aggregation")
+
+    quantile = parse_quantile_agg(agg)
+    if quantile is not None and (fill or align):
+        raise HTTPException(status_code=400, detail="fill and align are not supported for quantiles")
+    step = None
+    if agg:
+        max_points = await _get_user_max_points(user)
+        interval_count, interval_unit = await _resolve_interval(
+            interval,
+            table_name,
+            dt_from,
+            dt_to,
+            max_points,
+            min_seconds=SKETCH_BUCKET_SECONDS if quantile is not None else 1,
+        )
+        step = _interval_to_timedelta(interval_count, interval_unit)
+    not_modified = await _apply_history_etag(
+        request,
+        response,
+        [table_name],
+        scope=_history_etag_scope(user, visible_fields),
+        window=_history_etag_window(dt_from, dt_to, step),
+    )
+    if not_modified:
+        return not_modified
+    if agg and quantile is None:
+        estimated_rows = await _estimate_scan_rows(table_name, dt_from, dt_to)
+    else:
+        # Raw reads walk the ts index up to ``limit``; quantiles read per-minute sketches.
+        estimated_rows = 0 if agg else limit
+    async with (
+        query_guard(request, "history", settings.history_statement_timeout),
+        admission.slot(user["id"], estimated_rows),
+        read_router.route([table_name], fresh=fresh) as target,
+    ):
+        if agg:
+            if quantile is not None:
+                result = await _history_quantile(
+                    table_name,
+                    is_json,
+                    requested_fields,
+                    dt_from,
+                    dt_to,
+                    quantile,
+                    interval_count,
+                    interval_unit,
+                )
+            else:
+                result = await _history_aggregate(
+                    table_name,
+                    is_json,
+                    requested_fields,
+                    dt_from,
+                    dt_to,
+                    agg,
+                    interval_count,
+                    interval_unit,
+                    fill=fill,
+                    align=align,
+                    max_points=max_points,
+                )
+            result["interval"] = _format_interval(interval_count, interval_unit)
+        else:
+            if not dt_from and not dt_to:
+                order = "desc"
+            result = await _history_raw(
+                table_name,
+                is_json,
+                requested_fields,
+                dt_from,
+                dt_to,
+                limit,
+                order,
+            )
+    if not target.covers([table_name]):
+        _drop_history_etag(response)
+    return fast_json(result, response)
+
 
+@api_router.get("/history/formula", response_class=FastJSONResponse)
+async def history_formula(
+    request: Request,
+    response: Response,
+    topic: str,
+    fields: str,
+    formula: str,
+    from_ts: str | None = Query(None),
+    to_ts: str | None = Query(None),
+    agg: str | None = Query(None),
+    interval: str | None = Query(None),
+    limit: int = Query(MAX_CHART_POINTS, ge=1),
+    fresh: bool = Query(False),
+    user=Depends(require_user),
+) -> Response:
+    await _require_history_or_charts_access(user)
+    topic_context = await _get_topic_context(topic, user)
+    table_name = topic_context["table_name"]
+    is_json = topic_context["is_json"]
+    requested_fields = _parse_fields(fields)
+    if not requested_fields:
+        raise HTTPException(status_code=400, detail="Fields for formula are required")
+    for field in requested_fields:
+        if field not in topic_context["all_fields"]:
+            raise HTTPException(status_code=400, detail=f"Unknown field: {field}")
+        if field not in topic_context["visible_fields"]:
+            raise HTTPException(status_code=403, detail="Signal access denied")
+        if topic_context["columns"].get(field) not in ("bigint", "double precision"):
+            raise HTTPException(status_code=400, detail=f"Field not numeric: {field}")
+    try:
+        tree = parse_formula(formula, requested_fields)
+    except FormulaError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    dt_from = _parse_dt(from_ts)
+    dt_to = _parse_dt(to_ts)
+    limit = min(limit, MAX_CHART_POINTS)
+    resolved_interval = None
+    quantile = parse_quantile_agg(agg)
+    if quantile is not None and not is_json:
+        raise HTTPException(status_code=400, detail="Quantile formulas require a JSON topic")
+    step = None
     if agg:
-        parsed = _parse_interval(interval)
-        if not parsed:
-            raise HTTPException(status_code=400, detail="Invalid interval")
-        interval_count, interval_unit = parsed
-        return await _history_aggregate(
+        interval_count, interval_unit = await _resolve_interval(
+            interval,
             table_name,
-            is_json,
-            requested_fields,
             dt_from,
             dt_to,
-            agg,
-            interval_count,
-            interval_unit,
+            await _get_user_max_points(user),
+            min_seconds=SKETCH_BUCKET_SECONDS if quantile is not None else 1,
         )
-    if not dt_from and not dt_to:
-        order = "desc"
-    return await _history_raw(
-        table_name,
-        is_json,
-        requested_fields,
-        dt_from,
-        dt_to,
-        limit,
-        order,
+        step = _interval_to_timedelta(interval_count, interval_unit)
+    not_modified = await _apply_history_etag(
+        request,
+        response,
+        [table_name],
+        scope=_history_etag_scope(user, topic_context["visible_fields"]),
+        window=_history_etag_window(dt_from, dt_to, step),
+    )
+    if not_modified:
+        return not_modified
+
+    if agg and quantile is None:
+        estimated_rows = await _estimate_scan_rows(table_name, dt_from, dt_to)
+    elif agg:
+        estimated_rows = 0
+    elif dt_from or dt_to:
+        # With a range the whole window is evaluated and the result is downsampled
+        # instead of the inputs.
+        estimated_rows = await _estimate_scan_rows(table_name, dt_from, dt_to)
+    else:
+        # Without a range only the latest points are charted.
+        estimated_rows = limit
+    source_aggregated = False
+    async with (
+        query_guard(request, "history_formula", settings.formula_statement_timeout),
+        admission.slot(user["id"], estimated_rows),
+        read_router.route([table_name], fresh=fresh) as target,
+    ):
+        if agg:
+            if quantile is not None:
+                source = await _history_quantile(
+                    table_name, True, requested_fields, dt_from, dt_to, quantile, interval_count, interval_unit
+                )
+            else:
+                source = await _history_aggregate(
+                    table_name, True, requested_fields, dt_from, dt_to, agg, interval_count, interval_unit
+                )
+            rows = source["rows"]
+            label_key = "bucket"
+            resolved_interval = _format_interval(interval_count, interval_unit)
+        else:
+            label_key = "ts"
+            rows = None
+            if not (dt_from or dt_to):
+                rows = await _formula_source_rows(table_name, requested_fields, dt_from, dt_to, limit)
+            elif estimated_rows <= FORMULA_MAX_SOURCE_ROWS:
+                rows = await _formula_source_rows(
+                    table_name, requested_fields, dt_from, dt_to, FORMULA_MAX_SOURCE_ROWS + 1
+                )
+                if len(rows) > FORMULA_MAX_SOURCE_ROWS:
+                    rows = None
+            if rows is None:
+                # More rows than are evaluated at once: evaluate the formula over bucket
+                # averages of the whole window rather than over its newest rows only.
+                interval_count, interval_unit = await _resolve_interval(
+                    "auto", table_name, dt_from, dt_to, FORMULA_MAX_SOURCE_ROWS
+                )
+                source = await _history_aggregate(
+                    table_name, True, requested_fields, dt_from, dt_to, "avg", interval_count, interval_unit
+                )
+                rows = [{**row, "ts": row["bucket"]} for row in source["rows"]]
+                resolved_interval = _format_interval(interval_count, interval_unit)
+                source_aggregated = True
+
+    labels = [row[label_key] for row in rows]
+    columns = {field: to_float_array([row[field] for row in rows]) for field in requested_fields}
+    values = evaluate_formula(tree, columns, len(rows))
+    has_inputs = np.logical_and.reduce([np.isfinite(columns[field]) for field in requested_fields])
+    valid = np.isfinite(values)
+    keep = np.flatnonzero(valid & has_inputs)
+    selected = keep[downsample_indices(len(keep), limit)]
+    if not target.covers([table_name]):
+        _drop_history_etag(response)
+    return fast_json(
+        {
+            "table": table_name,
+            "is_json": is_json,
+            "rows": [{label_key: labels[index], "value": float(values[index])} for index in selected],
+            "invalid_points": int(np.count_nonzero(has_inputs & ~valid)),
+            "truncated": source_aggregated or len(keep) > limit,
+            "interval": resolved_interval,
+        },
+        response,
     )
 
 
+@api_router.get("/history/join", response_class=FastJSONResponse)
+async def history_join(
+    request: Request,
+    response: Response,
+    series: list[str] = Query(...),
+    from_ts: str | None = Query(None),
+    to_ts: str | None = Query(None),
+    agg: str | None = Query(None),
+    interval: str | None = Query(None),
+    limit: int = Query(MAX_CHART_POINTS, ge=1),
+    fresh: bool = Query(False),
+    user=Depends(require_user),
+) -> Response:
+    await _require_history_or_charts_access(user)
+    if not series:
+        raise HTTPException(status_code=400, detail="At least one series is required")
+    if len(series) > JOIN_MAX_SERIES:
+        raise HTTPException(status_code=400, detail=f"At most {JOIN_MAX_SERIES} series can be joined")
+    specs = [await _get_join_series(item, user) for item in series]
+    table_names = sorted({spec["table_name"] for spec in specs})
+    dt_from = _parse_dt(from_ts)
+    dt_to = _parse_dt(to_ts)
+    limit = min(limit, MAX_CHART_POINTS)
+
+    where = []
+    params: dict[str, Any] = {"limit": limit}
+    if dt_from:
+        where.append("ts >= :from_ts")
+        params["from_ts"] = dt_from
+    if dt_to:
+        where.append("ts <= :to_ts")
+        params["to_ts"] = dt_to
+
+    if agg:
+        agg = agg.lower()
+        if agg not in ("min", "max", "avg"):
+            raise HTTPException(status_code=400, detail="Invalid aggregation")
+        interval_count, interval_unit = await _resolve_interval(
+            interval, specs[0]["table_name"], dt_from, dt_to, await _get_user_max_points(user)
+        )
+        params["count"] = interval_count
+        sql = _join_aggregate_sql(specs, where, agg, interval_unit)
+        label_key = "bucket"
+        resolved_interval = _format_interval(interval_count, interval_unit)
+    else:
+        sql = _join_asof_sql(specs, where)
+        label_key = "ts"
+        resolved_interval = None
+    not_modified = await _apply_history_etag(
+        request,
+        response,
+        table_names,
+        scope=_history_etag_scope(user),
+        window=_history_etag_window(
+            dt_from, dt_to, _interval_to_timedelta(interval_count, interval_unit) if agg else None
+        ),
+    )
+    if not_modified:
+        return not_modified
+
+    estimated_rows = 0
+    for name in table_names:
+        estimated_rows += await _estimate_scan_rows(name, dt_from, dt_to)
+    async with (
+        query_guard(request, "history_join", settings.join_statement_timeout),
+        admission.slot(user["id"], estimated_rows),
+        read_router.route(table_names, fresh=fresh) as target,
+        begin_with_timeout(target.engine) as conn,
+    ):
+        rows = (await conn.execute(text(sql), params)).mappings().all()
+    if not target.covers(table_names):
+        _drop_history_etag(response)
+    if agg:
+        rows = list(reversed(rows))
+    return fast_json(
+        {
+            "interval": resolved_interval,
+            "series": [
+                {"key": spec["key"], "topic": spec["topic"], "field": spec["field"]} for spec in specs
+            ],
+            "rows": [
+                {
+                    label_key: row[label_key],
+                    **{spec["key"]: row[f"s{index}"] for index, spec in enumerate(specs)},
+                }
+                for row in rows
+            ],
+        },
+        response,
+    )
+
+
+async def _get_join_series(value: str, user: dict[str, Any]) -> dict[str, Any]:
+    topic, separator, field = value.rpartition(":")
+    if not separator or not topic or not field:
+        raise HTTPException(status_code=400, detail=f"Invalid series: {value}")
+    topic_context = await _get_topic_context(topic, user)
+    if topic_context["is_json"]:
+        if field not in topic_context["all_fields"]:
+            raise HTTPException(status_code=400, detail=f"Unknown field: {field}")
+        if field not in topic_context["visible_fields"]:
+            raise HTTPException(status_code=403, detail="Signal access denied")
+        if topic_context["columns"].get(field) not in ("bigint", "double precision"):
+            raise HTTPException(status_code=400, detail=f"Field not numeric: {field}")
+        expr = quote_ident(field)
+    else:
+        if field != "value":
+            raise HTTPException(status_code=400, detail=f"Unknown field: {field}")
+        expr = SCALAR_VALUE_EXPR
+    return {
+        "key": value,
+        "topic": topic_context["topic"],
+        "field": field,
+        "table_name": topic_context["table_name"],
+        "expr": f"CAST({expr} AS double precision)",
+    }
+
+
+def _join_aggregate_sql(
+    specs: list[dict[str, Any]],
+    where: list[str],
+    agg: str,
+    interval_unit: str,
+) -> str:
+    interval_arg = {"second": "secs", "minute": "mins", "hour": "hours", "day": "days"}[interval_unit]
+    bucket_expr = f"date_bin(make_interval({interval_arg} => :count), ts, '1970-01-01')"
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+    ctes = []
+    for index, spec in enumerate(specs):
+        ctes.append(
+            f"""
+            s{index} AS (
+                SELECT {bucket_expr} AS bucket, {agg}({spec["expr"]}) AS v
+                FROM {quote_ident(spec["table_name"])}
+                {where_sql}
+                GROUP BY bucket
+            )
+            """
+        )
+    joins = " ".join(f"FULL JOIN s{index} USING (bucket)" for index in range(1, len(specs)))
+    columns = ", ".join(f"s{index}.v AS s{index}" for index in range(len(specs)))
+    return f"""
+        WITH {', '.join(ctes)}
+        SELECT bucket, {columns}
+        FROM s0 {joins}
+        ORDER BY bucket DESC
+        LIMIT :limit
+    """
+
+
+def _join_asof_sql(specs: list[dict[str, Any]], where: list[str]) -> str:
+    # The first series drives the timeline; every other series contributes its latest
+    # value at or before each driver timestamp. Rows of all series are merged into one
+    # ordered stream and values are carried forward with window functions, so no
+    # per-row index lookups are needed.
+    base = specs[0]
+    base_where = [f"{base['expr']} IS NOT NULL", *where]
+    nulls = ["NULL::double precision"] * len(specs)
+    branches = []
+    base_columns = list(nulls)
+    base_columns[0] = "v"
+    branches.append(
+        f"SELECT ts, 0 AS src, {', '.join(f'{col} AS s{i}' for i, col in enumerate(base_columns))} FROM base"
+    )
+    for index, spec in enumerate(specs[1:], start=1):
+        columns = list(nulls)
+        columns[index] = spec["expr"]
+        select_cols = ", ".join(columns)
+        table = quote_ident(spec["table_name"])
+        branches.append(
+            f"""
+            (SELECT ts, {index}, {select_cols}
+             FROM {table}, span
+             WHERE {spec["expr"]} IS NOT NULL AND ts < span.lo
+             ORDER BY ts DESC
+             LIMIT 1)
+            """
+        )
+        branches.append(
+            f"""
+            SELECT ts, {index}, {select_cols}
+            FROM {table}, span
+            WHERE {spec["expr"]} IS NOT NULL AND ts BETWEEN span.lo AND span.hi
+            """
+        )
+    order = "ORDER BY ts, src DESC"
+    groups = ", ".join(
+        f"s{index}, count(s{index}) OVER ({order}) AS g{index}" for index in range(1, len(specs))
+    )
+    carried = ", ".join(
+        f"first_value(s{index}) OVER (PARTITION BY g{index} {order}) AS s{index}"
+        for index in range(1, len(specs))
+    )
+    return f"""
+        WITH base AS (
+            SELECT ts, {base["expr"]} AS v
+            FROM {quote_ident(base["table_name"])}
+            WHERE {' AND '.join(base_where)}
+            ORDER BY ts DESC
+            LIMIT :limit
+        ),
+        span AS (
+            SELECT min(ts) AS lo, max(ts) AS hi FROM base
+        ),
+        merged AS (
+            {' UNION ALL '.join(branches)}
+        ),
+        grouped AS (
+            SELECT ts, src, s0{', ' + groups if groups else ''}
+            FROM merged
+        ),
+        carried AS (
+            SELECT ts, src, s0{', ' + carried if carried else ''}
+            FROM grouped
+        )
+        SELECT ts, s0{''.join(f', s{index}' for index in range(1, len(specs)))}
+        FROM carried
+        WHERE src = 0
+        ORDER BY ts
+    """
+
+
+async def _formula_source_rows(
+    table_name: str,
+    fields: list[str],
+    dt_from: datetime | None,
+    dt_to: datetime | None,
+    limit: int,
+) -> list[dict[str, Any]]:
+    cols = ["ts"] + fields
+    select_cols = ", ".join([quote_ident(c) for c in cols])
+    where = [f"{quote_ident(field)} IS NOT NULL" for field in fields]
+    params: dict[str, Any] = {"limit": limit}
+    if dt_from:
+        where.append("ts >= :from_ts")
+        params["from_ts"] = dt_from
+    if dt_to:
+        where.append("ts <= :to_ts")
+        params["to_ts"] = dt_to
+    sql = text(
+        f"""
+        SELECT {select_cols}
+        FROM {quote_ident(table_name)}
+        WHERE {' AND '.join(where)}
+        ORDER BY ts DESC
+        LIMIT :limit
+        """
+    )
+    async with begin_with_timeout(read_engine(engine)) as conn:
+        rows = (await conn.execute(sql, params)).mappings().all()
+    return [dict(row) for row in reversed(rows)]
+
+
+def _history_etag_scope(user: dict[str, Any], visible_fields: list[str] | None = None) -> list[Any]:
+    """What the caller may see, for the ETag: responses differ between users and ACLs."""
+    return [user["id"], user["role"], sorted(visible_fields) if visible_fields is not None else None]
+
+
+def _history_etag_window(
+    dt_from: datetime | None, dt_to: datetime | None, step: timedelta | None
+) -> list[Any]:
+    """The resolved time window of a history query, for the ETag.
+
+    An aggregated query without an end reaches up to the current bucket, so its tag
+    changes when a new bucket starts even if nothing was written.
+    """
+    end: Any = dt_to
+    if dt_to is None and step is not None:
+        end = math.floor(datetime.now(timezone.utc).timestamp() / step.total_seconds())
+    return [dt_from, end, step.total_seconds() if step is not None else None]
+
+
+async def _apply_history_etag(
+    request: Request,
+    response: Response,
+    table_names: list[str],
+    *,
+    scope: list[Any],
+    window: list[Any],
+) -> Response | None:
+    """Tag a history response with the write watermarks of its tables.
+
+    The tag also covers ``scope`` and ``window`` (see :func:`_history_etag_scope` and
+    :func:`_history_etag_window`). The watermark is read before the query runs, so a
+    write that lands while the query is executing changes the tag of the next request.
+    Returns a 304 response when the client already holds the current version.
+    """
+    await _apply_backfills()
+    await write_watermarks.refresh(engine, table_names)
+    tokens = ",".join(write_watermarks.token(name) for name in sorted(set(table_names)))
+    context = json.dumps([scope, window], default=str)
+    digest = hashlib.sha1(
+        f"{request.url.path}?{request.url.query}|{tokens}|{context}".encode()
+    ).hexdigest()
+    etag = f'W/"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    candidates = {
+        value.strip() for value in request.headers.get("if-none-match", "").split(",") if value.strip()
+    }
+    if etag in candidates or "*" in candidates:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+async def _apply_backfills() -> None:
+    """Catch up with writes into the past made by other processes and API workers."""
+    if not aggregate_cache.enabled and not read_router.enabled:
+        return
+    backfills = await backfill_log.poll(engine)
+    if backfills is None:
+        # Idle for so long that entries may have been pruned; anything older than that
+        # is past any replica lag, so only the cache needs to be dropped.
+        aggregate_cache.clear()
+        return
+    for backfill in backfills:
+        aggregate_cache.invalidate(backfill.table_name, backfill.since)
+        read_router.note_write(backfill.table_name, backfill.lsn)
+
+
+def _drop_history_etag(response: Response) -> None:
+    # A lagging replica may miss writes the tag already accounts for; caching that
+    # response under the tag could pin stale data on a topic that then goes quiet.
+    if "etag" in response.headers:
+        del response.headers["etag"]
+    response.headers["Cache-Control"] = "no-store"
+
+
 async def _history_raw(
     table_name: str,
     is_json: bool,
@@ -1297,7 +2259,9 @@ async def _history_raw(
 ) -> dict[str, Any]:
     order = "ASC" if order.lower() == "asc" else "DESC"
     cols = ["ts"] + fields
-    select_cols = ", ".join([quote_ident(c) for c in cols])
+    # Select columns in sorted order so requests listing the same fields differently
+    # reuse one prepared statement; rows are rebuilt in the requested order below.
+    select_cols = ", ".join([quote_ident(c) for c in ["ts", *sorted(set(fields) - {"ts"})]])
     where = []
     params: dict[str, Any] = {"limit": limit}
     if dt_from:
@@ -1316,12 +2280,12 @@ async def _history_raw(
         LIMIT :limit
         """
     )
-    async with engine.begin() as conn:
+    async with begin_with_timeout(read_engine(engine)) as conn:
         rows = (await conn.execute(sql, params)).mappings().all()
     return {
         "table": table_name,
         "is_json": is_json,
-        "rows": [dict(row) for row in rows],
+        "rows": [{c: row[c] for c in cols} for row in rows],
     }
 
 
@@ -1334,6 +2298,10 @@ async def _history_aggregate(
     agg: str,
     interval_count: int,
     interval_unit: str,
+    *,
+    fill: str | None = None,
+    align: bool = False,
+    max_points: int = MAX_CHART_POINTS,
 ) -> dict[str, Any]:
     agg = agg.lower()
     if agg not in ("min", "max", "avg"):
@@ -1350,7 +2318,8 @@ async def _history_aggregate(
     where_sql = f"WHERE {' AND '.join(where)}" if where else ""
 
     interval_arg = {"second": "secs", "minute": "mins", "hour": "hours", "day": "days"}[interval_unit]
-    bucket_expr = f"date_bin(make_interval({interval_arg} => :count), ts, '1970-01-01')"
+    interval_expr = f"make_interval({interval_arg} => :count)"
+    bucket_expr = f"date_bin({interval_expr}, ts, '1970-01-01')"
     if is_json:
         columns = await get_table_columns(engine, table_name)
         for field in fields:
@@ -1361,29 +2330,250 @@ async def _history_aggregate(
         agg_cols = ", ".join(
             [f"{agg}({quote_ident(field)}) AS {quote_ident(field)}" for field in fields]
         )
-        sql = text(
-            f"""
+        value_columns = fields
+    else:
+        agg_cols = f"{agg}({SCALAR_VALUE_EXPR}) AS value"
+        value_columns = ["value"]
+
+    def build_agg_sql(where_sql: str) -> str:
+        return f"""
             SELECT {bucket_expr} AS bucket, {agg_cols}
             FROM {quote_ident(table_name)}
             {where_sql}
             GROUP BY bucket
-            ORDER BY bucket
-            """
+        """
+
+    if not align and not fill:
+        rows = await _history_aggregate_cached(
+            table_name,
+            value_columns,
+            agg,
+            interval_count,
+            interval_unit,
+            dt_from,
+            dt_to,
+            build_agg_sql,
+            where,
+            params,
         )
-    else:
-        expr = "CASE WHEN value_type = 'float' THEN value_float WHEN value_type = 'int' THEN value_int END"
-        sql = text(
+        return {"table": table_name, "is_json": is_json, "rows": rows}
+
+    params["grid_from"] = dt_from
+    params["grid_to"] = dt_to
+    params["grid_points"] = max_points
+    params["grid_limit"] = max_points + 1
+    agg_values = ", ".join(f"agg.{quote_ident(c)}" for c in value_columns)
+    seed_sql = ""
+    if fill in ("previous", "linear"):
+        # Buckets before the grid that hold the last value of some column, so filling
+        # the first buckets of the grid carries or interpolates from them.
+        last_buckets = ", ".join(
+            f"max(agg.bucket) FILTER (WHERE agg.{quote_ident(c)} IS NOT NULL)" for c in value_columns
+        )
+        seed_sql = f"""
+            UNION ALL
+            SELECT agg.bucket, {agg_values}
+            FROM agg
+            WHERE agg.bucket IN (
+                SELECT unnest(ARRAY[{last_buckets}])
+                FROM agg, span
+                WHERE agg.bucket < span.start_bucket
+            )
+        """
+    sql = text(
+        f"""
+        WITH agg AS ({build_agg_sql(where_sql)}),
+        bounds AS (
+            SELECT
+                COALESCE(
+                    date_bin({interval_expr}, CAST(:grid_from AS timestamptz), '1970-01-01'),
+                    min(bucket)
+                ) AS start_bucket,
+                COALESCE(
+                    date_bin({interval_expr}, CAST(:grid_to AS timestamptz), '1970-01-01'),
+                    max(bucket)
+                ) AS end_bucket
+            FROM agg
+        ),
+        span AS (
+            -- Only the newest grid_points buckets are returned, plus one to detect that
+            -- the grid was cut; the grid is not built any further back.
+            SELECT
+                GREATEST(
+                    start_bucket, end_bucket - {interval_expr} * CAST(:grid_points AS integer)
+                ) AS start_bucket,
+                end_bucket
+            FROM bounds
+        ),
+        grid AS (
+            SELECT generate_series(start_bucket, end_bucket, {interval_expr}) AS bucket
+            FROM span
+        ),
+        aligned AS (
+            SELECT grid.bucket, {agg_values}
+            FROM grid
+            LEFT JOIN agg ON agg.bucket = grid.bucket
+            {seed_sql}
+        ),
+        {_gap_fill_sql(value_columns, fill)}
+        SELECT filled.*
+        FROM filled, span
+        WHERE filled.bucket >= span.start_bucket
+        ORDER BY bucket DESC
+        LIMIT :grid_limit
+        """
+    )
+    async with begin_with_timeout(read_engine(engine)) as conn:
+        rows = (await conn.execute(sql, params)).mappings().all()
+    # Keep the most recent buckets when the grid is larger than the point budget.
+    truncated = len(rows) > max_points
+    result = [dict(row) for row in reversed(rows[:max_points])]
+    return {"table": table_name, "is_json": is_json, "rows": result, "truncated": truncated}
+
+
+async def _history_aggregate_cached(
+    table_name: str,
+    value_columns: list[str],
+    agg: str,
+    interval_count: int,
+    interval_unit: str,
+    dt_from: datetime | None,
+    dt_to: datetime | None,
+    build_agg_sql: Callable[[str], str],
+    where: list[str],
+    params: dict[str, Any],
+) -> list[dict[str, Any]]:
+    """Run an aggregate query, reusing sealed buckets from ``aggregate_cache``.
+
+    Only the buckets that are not cached yet (the open tail and, for a range that
+    starts mid-bucket, the partial head bucket) are read from the topic table.
+    """
+    # On a replica only data up to its replay point is final.
+    now = read_consistent_at() or datetime.now(timezone.utc)
+    dt_from = _ensure_tz(dt_from)
+    dt_to = _ensure_tz(dt_to)
+    cacheable = aggregate_cache.enabled and (
+        dt_to is None or dt_to >= aggregate_cache.seal_point(now)
+    )
+    generation = aggregate_cache.generation(table_name)
+    plan = None
+    if cacheable:
+        plan = aggregate_cache.plan(
+            table_name, value_columns, agg, interval_count, interval_unit, dt_from
+        )
+    where = list(where)
+    params = dict(params)
+    if plan is not None:
+        params["tail_from"] = plan.tail_from
+        if dt_from:
+            params["head_end"] = plan.head_end
+            where.append("(ts < :head_end OR ts >= :tail_from)")
+        else:
+            where.append("ts >= :tail_from")
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+    sql = text(f"{build_agg_sql(where_sql)} ORDER BY bucket")
+    async with begin_with_timeout(read_engine(engine)) as conn:
+        rows = [dict(row) for row in (await conn.execute(sql, params)).mappings().all()]
+
+    if cacheable:
+        aggregate_cache.store(
+            table_name,
+            value_columns,
+            agg,
+            interval_count,
+            interval_unit,
+            _interval_to_timedelta(interval_count, interval_unit),
+            rows,
+            dt_from,
+            now,
+            plan,
+            generation,
+        )
+    if plan is not None and plan.cached_rows:
+        rows = sorted(rows + plan.cached_rows, key=lambda row: row["bucket"])
+    return rows
+
+
+def _gap_fill_sql(value_columns: list[str], fill: str | None) -> str:
+    """Build the ``filled`` CTE over ``aligned`` for the requested fill mode."""
+    if fill in (None, "null"):
+        return "filled AS (SELECT * FROM aligned)"
+
+    # Each run of empty buckets shares a group with the last non-empty bucket before it
+    # (ascending count) and with the first non-empty bucket after it (descending count).
+    groups = []
+    for index, column in enumerate(value_columns):
+        quoted = quote_ident(column)
+        groups.append(f"count({quoted}) OVER (ORDER BY bucket) AS _prev_grp_{index}")
+        if fill == "linear":
+            groups.append(f"count({quoted}) OVER (ORDER BY bucket DESC) AS _next_grp_{index}")
+    selects = []
+    for index, column in enumerate(value_columns):
+        quoted = quote_ident(column)
+        prev_value = f"first_value({quoted}) OVER (PARTITION BY _prev_grp_{index} ORDER BY bucket)"
+        if fill == "previous":
+            selects.append(f"{prev_value} AS {quoted}")
+            continue
+        prev_bucket = (
+            f"first_value(CASE WHEN {quoted} IS NOT NULL THEN bucket END) "
+            f"OVER (PARTITION BY _prev_grp_{index} ORDER BY bucket)"
+        )
+        next_value = f"first_value({quoted}) OVER (PARTITION BY _next_grp_{index} ORDER BY bucket DESC)"
+        next_bucket = (
+            f"first_value(CASE WHEN {quoted} IS NOT NULL THEN bucket END) "
+            f"OVER (PARTITION BY _next_grp_{index} ORDER BY bucket DESC)"
+        )
+        selects.append(
             f"""
-            SELECT {bucket_expr} AS bucket, {agg}({expr}) AS value
-            FROM {quote_ident(table_name)}
-            {where_sql}
-            GROUP BY bucket
-            ORDER BY bucket
+            CASE
+                WHEN {quoted} IS NOT NULL THEN {quoted}
+                ELSE {prev_value} + ({next_value} - {prev_value})
+                    * EXTRACT(EPOCH FROM bucket - {prev_bucket})
+                    / NULLIF(EXTRACT(EPOCH FROM {next_bucket} - {prev_bucket}), 0)
+            END AS {quoted}
             """
         )
-    async with engine.begin() as conn:
-        rows = (await conn.execute(sql, params)).mappings().all()
-    return {"table": table_name, "is_json": is_json, "rows": [dict(row) for row in rows]}
+    return f"""
+        grouped AS (
+            SELECT aligned.*, {', '.join(groups)}
+            FROM aligned
+        ),
+        filled AS (
+            SELECT bucket, {', '.join(selects)}
+            FROM grouped
+        )
+    """
+
+
+async def _history_quantile(
+    table_name: str,
+    is_json: bool,
+    fields: list[str],
+    dt_from: datetime | None,
+    dt_to: datetime | None,
+    quantile: float,
+    interval_count: int,
+    interval_unit: str,
+) -> dict[str, Any]:
+    bucket_interval = _interval_to_timedelta(interval_count, interval_unit)
+    if bucket_interval.total_seconds() % SKETCH_BUCKET_SECONDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Quantile aggregation requires an interval in multiples of {SKETCH_BUCKET_SECONDS} seconds",
+        )
+    if is_json:
+        columns = await get_table_columns(engine, table_name)
+        for field in fields:
+            data_type = columns.get(field, "")
+            if data_type not in ("bigint", "double precision"):
+                raise HTTPException(status_code=400, detail=f"Field not numeric: {field}")
+        sketch_fields = fields
+    else:
+        sketch_fields = ["value"]
+    rows = await query_quantiles(
+        read_engine(engine), table_name, sketch_fields, dt_from, dt_to, quantile, bucket_interval
+    )
+    return {"table": table_name, "is_json": is_json, "rows": rows}
 
 
 app.include_router(api_router, prefix="/api")
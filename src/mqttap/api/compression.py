@@ -0,0 +1,199 @@
+import asyncio
+import zlib
+from typing import Callable
+
+import brotli
+import zstandard
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+# Bodies at least this large are compressed in a worker thread instead of on the loop.
+THREAD_MINIMUM_SIZE = 128 * 1024
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/javascript",
+    "image/svg+xml",
+    "text/",
+)
+
+
+class _StreamCompressor:
+    """Uniform incremental interface over zlib, brotli and zstandard compressors."""
+
+    def __init__(
+        self,
+        compress: Callable[[bytes], bytes],
+        flush: Callable[[], bytes],
+        finish: Callable[[], bytes],
+    ) -> None:
+        self.compress = compress
+        self.flush = flush
+        self.finish = finish
+
+
+def _gzip_compressor() -> _StreamCompressor:
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return _StreamCompressor(
+        compressor.compress,
+        lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+        compressor.flush,
+    )
+
+
+def _brotli_compressor() -> _StreamCompressor:
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    return _StreamCompressor(compressor.process, compressor.flush, compressor.finish)
+
+
+def _zstd_compressor() -> _StreamCompressor:
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return _StreamCompressor(
+        compressor.compress,
+        lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+        compressor.flush,
+    )
+
+
+COMPRESSORS: dict[str, Callable[[], _StreamCompressor]] = {
+    "zstd": _zstd_compressor,
+    "br": _brotli_compressor,
+    "gzip": _gzip_compressor,
+}
+
+
+def negotiate_encoding(accept_encoding: str, preferred: list[str]) -> str | None:
+    """Pick a content coding from an Accept-Encoding header.
+
+    The client's q-values win; ties go to the first entry of ``preferred``.
+    """
+    weights: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        weights[name] = quality
+    best: str | None = None
+    best_quality = 0.0
+    for encoding in preferred:
+        quality = weights.get(encoding, weights.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _is_compressible(content_type: str) -> bool:
+    media_type = content_type.partition(";")[0].strip().lower()
+    return media_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class CompressionMiddleware:
+    """Negotiated zstd/brotli/gzip response compression.
+
+    Responses smaller than ``minimum_size``, already encoded, partial or of a
+    non-text media type are passed through untouched.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, encodings: list[str] | None = None) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.encodings = [name for name in (encodings or list(COMPRESSORS)) if name in COMPRESSORS]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.encodings:
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = Headers(scope=scope).get("accept-encoding", "")
+        encoding = negotiate_encoding(accept_encoding, self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressionResponder(self.app, encoding, self.minimum_size)
+        await responder(scope, receive, send)
+
+
+class _CompressionResponder:
+    def __init__(self, app: ASGIApp, encoding: str, minimum_size: int) -> None:
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.send: Send | None = None
+        self.start_message: Message | None = None
+        self.passthrough = False
+        self.compressor: _StreamCompressor | None = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_with_compression)
+
+    async def send_with_compression(self, message: Message) -> None:
+        assert self.send is not None
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            self.start_message = message
+            self.passthrough = (
+                "content-encoding" in headers
+                or message["status"] in (204, 206, 304)
+                or not _is_compressible(headers.get("content-type", ""))
+            )
+            if self.passthrough:
+                await self.send(message)
+            return
+        if message_type != "http.response.body" or self.passthrough:
+            if self.start_message is not None and not self.passthrough:
+                # e.g. pathsend: nothing to compress, release the held headers first.
+                await self.send(self.start_message)
+                self.start_message = None
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start_message is not None:
+            start, self.start_message = self.start_message, None
+            if not more_body and len(body) < self.minimum_size:
+                self.passthrough = True
+                await self.send(start)
+                await self.send(message)
+                return
+            self.compressor = COMPRESSORS[self.encoding]()
+            headers = MutableHeaders(raw=start["headers"])
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                # The encoded bytes differ from the identity representation.
+                headers["ETag"] = f"W/{etag}"
+            if more_body:
+                del headers["Content-Length"]
+                await self.send(start)
+            else:
+                message["body"] = await self._compress(body, final=True)
+                headers["Content-Length"] = str(len(message["body"]))
+                await self.send(start)
+                await self.send(message)
+                return
+        message["body"] = await self._compress(body, final=not more_body)
+        await self.send(message)
+
+    async def _compress(self, body: bytes, final: bool) -> bytes:
+        if len(body) >= THREAD_MINIMUM_SIZE:
+            return await asyncio.to_thread(self._compress_sync, body, final)
+        return self._compress_sync(body, final)
+
+    def _compress_sync(self, body: bytes, final: bool) -> bytes:
+        assert self.compressor is not None
+        data = self.compressor.compress(body)
+        return data + (self.compressor.finish() if final else self.compressor.flush())
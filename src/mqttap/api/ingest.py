@@ -0,0 +1,28 @@
+"""Ingest-only entry point: the MQTT consumer with a health endpoint and nothing else."""
+
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+from mqttap.api.lifecycle import start_services, stop_services
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    consumer = await start_services("ingest")
+    app.state.mqtt_consumer = consumer
+    yield
+    await stop_services(consumer)
+
+
+app = FastAPI(title="MQTTap ingest", lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+
+
+@app.get("/health")
+async def health() -> JSONResponse:
+    status = app.state.mqtt_consumer.status()
+    return JSONResponse(
+        {"status": "ok" if status["running"] else "down", "mode": "ingest", **status},
+        status_code=200 if status["running"] else 503,
+    )
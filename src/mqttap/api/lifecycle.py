@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable
+
+from mqttap.config import settings
+from mqttap.db.core import engine, maintenance_engine, read_replica_engines
+from mqttap.db.dynamic import watch_column_types
+from mqttap.db.init import SCHEMA_VERSION, build_topic_ts_indexes, init_base_schema
+from mqttap.services.ingest_process import IngestProcess
+from mqttap.services.latest import latest_values
+from mqttap.services.mqtt import MqttConsumer
+from mqttap.services.topic_stats import topic_stats
+from mqttap.services.watermarks import write_watermarks
+
+logger = logging.getLogger(__name__)
+
+# combined: API and MQTT consumer in one process (a single worker), or with
+# ``ingest_process`` the consumer in a child process supervised by the API.
+# api: HTTP API only, any number of workers; ingest runs in another process.
+# ingest: MQTT consumer with a health endpoint only.
+RUN_MODES = ("combined", "api", "ingest")
+
+_index_build: asyncio.Task | None = None
+_column_type_watch: asyncio.Task | None = None
+
+
+def check_run_mode(mode: str) -> str:
+    if mode not in RUN_MODES:
+        raise ValueError(f"Unknown run mode {mode!r}, expected one of {', '.join(RUN_MODES)}")
+    return mode
+
+
+async def _timed(steps: list[str], name: str, awaitable: Awaitable[Any]) -> Any:
+    started = time.perf_counter()
+    result = await awaitable
+    steps.append(f"{name} {(time.perf_counter() - started) * 1000:.0f} ms")
+    return result
+
+
+async def start_services(mode: str) -> MqttConsumer | IngestProcess | None:
+    """Prepare the schema and in-memory state of ``mode``; returns the consumer it runs."""
+    started = time.perf_counter()
+    steps: list[str] = []
+    version = await _timed(steps, "schema", init_base_schema(maintenance_engine))
+    _start_index_build()
+    _start_column_type_watch()
+    consumer: MqttConsumer | IngestProcess | None = None
+    in_child = mode == "combined" and settings.ingest_process
+    await _timed(steps, "latest values", latest_values.load(maintenance_engine))
+    if mode == "api" or in_child:
+        # Ingest writes from another process, so its state is read back from the database.
+        latest_values.reload_seconds = settings.sketch_flush_seconds
+        write_watermarks.track_database = True
+    else:
+        await _timed(steps, "topic stats", topic_stats.load(maintenance_engine))
+    if mode != "api":
+        consumer = IngestProcess() if in_child else MqttConsumer()
+        await _timed(steps, "mqtt consumer", consumer.start())
+    logger.info(
+        "Startup (%s) finished in %.0f ms (schema version %s -> %s): %s",
+        mode,
+        (time.perf_counter() - started) * 1000,
+        version,
+        SCHEMA_VERSION,
+        ", ".join(steps),
+    )
+    return consumer
+
+
+async def stop_services(consumer: MqttConsumer | IngestProcess | None) -> None:
+    if _index_build is not None and not _index_build.done():
+        # An interrupted build leaves an invalid index, which the next start rebuilds.
+        _index_build.cancel()
+        await asyncio.gather(_index_build, return_exceptions=True)
+    if _column_type_watch is not None:
+        _column_type_watch.cancel()
+        await asyncio.gather(_column_type_watch, return_exceptions=True)
+    if consumer is not None:
+        await consumer.stop()
+
+
+def _start_index_build() -> None:
+    global _index_build
+
+    async def build() -> None:
+        try:
+            await build_topic_ts_indexes(maintenance_engine)
+        except Exception:
+            logger.exception("Building topic ts indexes failed; retried on the next start")
+
+    _index_build = asyncio.create_task(build())
+
+
+def _start_column_type_watch() -> None:
+    global _column_type_watch
+    engines = [engine, maintenance_engine, *read_replica_engines]
+    _column_type_watch = asyncio.create_task(watch_column_types(maintenance_engine, engines))
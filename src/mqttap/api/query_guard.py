@@ -0,0 +1,58 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from fastapi import HTTPException, Request
+from sqlalchemy.exc import DBAPIError
+
+from mqttap.db.core import statement_timeout
+from mqttap.services.metrics import metrics
+
+QUERY_CANCELED_SQLSTATE = "57014"
+
+
+def _is_query_canceled(exc: DBAPIError) -> bool:
+    return getattr(exc.orig, "sqlstate", None) == QUERY_CANCELED_SQLSTATE
+
+
+@asynccontextmanager
+async def query_guard(request: Request, endpoint: str, timeout: float) -> AsyncIterator[None]:
+    """Run the queries of a history endpoint under a statement timeout.
+
+    If the client disconnects, the handler task is cancelled. asyncpg then sends a cancel
+    request for the running statement, so Postgres stops the query and the pool gets the
+    connection back. Cancelled and timed-out queries are counted in ``metrics``.
+    """
+    task = asyncio.current_task()
+    assert task is not None
+    disconnected = False
+
+    async def watch_disconnect() -> None:
+        nonlocal disconnected
+        while True:
+            message = await request.receive()
+            if message["type"] == "http.disconnect":
+                disconnected = True
+                task.cancel()
+                return
+
+    watcher = asyncio.create_task(watch_disconnect())
+    token = statement_timeout.set(timeout or None)
+    try:
+        yield
+    except asyncio.CancelledError:
+        if disconnected and task.uncancel() == 0:
+            metrics.increment("history_queries_cancelled", endpoint=endpoint)
+            raise HTTPException(status_code=499, detail="Client closed request") from None
+        raise
+    except DBAPIError as exc:
+        if not _is_query_canceled(exc):
+            raise
+        if disconnected:
+            metrics.increment("history_queries_cancelled", endpoint=endpoint)
+            raise HTTPException(status_code=499, detail="Client closed request") from None
+        metrics.increment("history_queries_timed_out", endpoint=endpoint)
+        raise HTTPException(status_code=504, detail="History query timed out") from None
+    finally:
+        watcher.cancel()
+        statement_timeout.reset(token)
@@ -0,0 +1,38 @@
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from fastapi import Response
+from fastapi.responses import JSONResponse
+
+_ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+
+
+def _default(value: Any) -> Any:
+    # numeric aggregates (sum/avg over bigint) come back from asyncpg as Decimal
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson.
+
+    Endpoints return it directly so FastAPI skips validating and re-encoding large row
+    lists; datetimes are rendered the same way as the default encoder (UTC as ``Z``).
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_default, option=_ORJSON_OPTIONS)
+
+
+def fast_json(content: Any, response: Response | None = None) -> FastJSONResponse:
+    """Render ``content``, keeping headers already set on an injected ``response``."""
+    result = FastJSONResponse(content)
+    if response is not None:
+        result.raw_headers.extend(
+            (key, value)
+            for key, value in response.raw_headers
+            if key not in (b"content-length", b"content-type")
+        )
+    return result
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic import BaseModel, EmailStr
 
 
@@ -56,3 +58,9 @@ class CsvImportRequest(BaseModel):
     csv_text: str
     field_mapping: dict[str, str]
     delimiter: str | None = None
+    conflict: Literal["keep", "skip", "overwrite"] = "keep"
+
+
+class CsvImportJobRequest(BaseModel):
+    field_mapping: dict[str, str]
+    conflict: Literal["keep", "skip", "overwrite"] = "keep"
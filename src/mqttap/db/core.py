@@ -1,15 +1,135 @@
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable
+
+from sqlalchemy import event, text
 from sqlalchemy.engine import make_url
-from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, PoolProxiedConnection
 
 from mqttap.config import settings
+from mqttap.services.metrics import metrics
+
+# Seconds; set per request by the API for endpoints with a statement timeout.
+statement_timeout: ContextVar[float | None] = ContextVar("statement_timeout", default=None)
+
+
+POOL_ROLES = ("api", "ingest", "maintenance")
+
+
+class _TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waited, per pool role."""
+
+    role = "default"
+
+    def connect(self) -> PoolProxiedConnection:
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            metrics.increment("db_pool_checkout_timeouts", pool=self.role)
+            raise
+        finally:
+            metrics.observe("db_pool_checkout_wait_seconds", time.perf_counter() - started, pool=self.role)
+
+
+_pool_classes: dict[str, type[_TimedQueuePool]] = {}
+
+
+def _pool_class(label: str) -> type[_TimedQueuePool]:
+    cls = _pool_classes.get(label)
+    if cls is None:
+        cls = _pool_classes[label] = type(f"{label.title()}QueuePool", (_TimedQueuePool,), {"role": label})
+    return cls
 
 
-def create_engine_from_settings() -> AsyncEngine:
-    url = make_url(settings.database_dsn)
+def _prepare_counter(label: str) -> Callable[[], None]:
+    # asyncpg calls the name function only when a statement misses the per-connection
+    # cache and is prepared; returning None keeps its default unnamed statements.
+    def name_func() -> None:
+        metrics.increment("db_statement_prepares", pool=label)
+
+    return name_func
+
+
+def _count_statements(engine: AsyncEngine, label: str) -> None:
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        # executemany() goes through asyncpg's own statement cache, not the LRU above.
+        if not executemany:
+            metrics.increment("db_statements", pool=label)
+
+
+def statement_cache_stats() -> dict[str, dict[str, Any]]:
+    """Executed statements, prepares and prepared-statement cache hit rate per pool."""
+    counters = metrics.snapshot()["counters"]
+    totals: dict[str, dict[str, Any]] = {}
+    for name, key in (("db_statements", "statements"), ("db_statement_prepares", "prepares")):
+        for item in counters.get(name, []):
+            pool = totals.setdefault(item["labels"]["pool"], {"statements": 0, "prepares": 0})
+            pool[key] = int(item["value"])
+    for pool in totals.values():
+        executed = pool["statements"]
+        pool["hit_rate"] = max(executed - pool["prepares"], 0) / executed if executed else None
+    return totals
+
+
+def create_engine_from_settings(
+    role: str = "api",
+    dsn: str | None = None,
+    label: str | None = None,
+) -> AsyncEngine:
+    """Engine with the pool size, overflow, timeout and pre-ping policy of ``role``.
+
+    Engines are bound to the event loop that first uses them, so the ingest thread
+    creates its own engines while the API process shares the module-level ones.
+    ``label`` names the pool in metrics and defaults to the role.
+
+    Each connection keeps an LRU of up to ``db_statement_cache_size`` prepared
+    statements; generated SQL has to be textually stable to be reused instead of
+    re-planned.
+    """
+    assert role in POOL_ROLES
+    label = label or role
+    url = make_url(dsn or settings.database_dsn)
     if url.drivername == "postgresql":
         url = url.set(drivername="postgresql+asyncpg")
-    return create_async_engine(url, pool_pre_ping=True)
+    engine = create_async_engine(
+        url,
+        poolclass=_pool_class(label),
+        pool_size=getattr(settings, f"db_{role}_pool_size"),
+        max_overflow=getattr(settings, f"db_{role}_max_overflow"),
+        pool_timeout=getattr(settings, f"db_{role}_pool_timeout"),
+        pool_pre_ping=getattr(settings, f"db_{role}_pre_ping"),
+        pool_recycle=settings.db_pool_recycle,
+        connect_args={
+            "prepared_statement_cache_size": settings.db_statement_cache_size,
+            "prepared_statement_name_func": _prepare_counter(label),
+            "statement_cache_size": settings.db_statement_cache_size,
+        },
+    )
+    _count_statements(engine, label)
+    return engine
+
+
+@asynccontextmanager
+async def begin_with_timeout(engine: AsyncEngine) -> AsyncIterator[AsyncConnection]:
+    """``engine.begin()`` that applies the current ``statement_timeout`` to the transaction."""
+    async with engine.begin() as conn:
+        timeout = statement_timeout.get()
+        if timeout:
+            await conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout * 1000)}"))
+        yield conn
 
 
-engine = create_engine_from_settings()
+engine = create_engine_from_settings("api")
+maintenance_engine = create_engine_from_settings("maintenance")
+read_replica_engines = [
+    create_engine_from_settings("api", dsn=dsn.strip(), label=f"replica{index}")
+    for index, dsn in enumerate(
+        dsn for dsn in settings.database_read_dsns.split(",") if dsn.strip()
+    )
+]
 SessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
@@ -1,13 +1,30 @@
+import asyncio
+import hashlib
 import json
+import logging
 import re
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Any
 
-from sqlalchemy import text
+from sqlalchemy import TextClause, text
 from sqlalchemy.ext.asyncio import AsyncEngine
 
+logger = logging.getLogger(__name__)
+
+# How often every process checks whether another one changed a column type.
+COLUMN_TYPES_POLL_SECONDS = 1.0
+
+COLUMN_TYPES_VERSION_SQL = "SELECT count(*), coalesce(sum(version), 0) FROM column_type_changes"
+RECORD_TYPE_CHANGE_SQL = """
+    INSERT INTO column_type_changes (table_name, version, updated_at)
+    VALUES (:table_name, 1, now())
+    ON CONFLICT (table_name) DO UPDATE
+    SET version = column_type_changes.version + 1, updated_at = now()
+"""
 
 _ident_re = re.compile(r"[^a-zA-Z0-9_]+")
+_ensured_tables: set[tuple[str, bool]] = set()
 
 
 def _sanitize_identifier(value: str, prefix: str) -> str:
@@ -35,6 +52,26 @@ def quote_ident(value: str) -> str:
     return '"' + value.replace('"', '""') + '"'
 
 
+def ts_index_name(table_name: str) -> str:
+    """Name of the ``ts`` index of a topic table, distinct for names sharing a prefix."""
+    digest = hashlib.sha1(table_name.encode()).hexdigest()[:8]
+    # Identifiers are limited to 63 characters.
+    return f"{table_name[:47]}_{digest}_ts_idx"
+
+
+def insert_columns(existing: dict[str, str]) -> tuple[str, ...]:
+    """Data columns of a topic table in a stable order, for canonical INSERT statements."""
+    return tuple(sorted(name for name in existing if name not in ("id", "ts")))
+
+
+@lru_cache(maxsize=1024)
+def insert_statement(table_name: str, columns: tuple[str, ...]) -> TextClause:
+    """``INSERT`` over ``columns``; identical inputs give the identical text."""
+    column_names = ", ".join(quote_ident(c) for c in columns)
+    placeholders = ", ".join(f":{c}" for c in columns)
+    return text(f"INSERT INTO {quote_ident(table_name)} ({column_names}) VALUES ({placeholders})")
+
+
 @dataclass
 class ColumnSpec:
     name: str
@@ -83,6 +120,8 @@ def _widen_type(current: str, incoming: str) -> str | None:
 
 
 async def ensure_topic_table(engine: AsyncEngine, table_name: str, is_json: bool) -> None:
+    if (table_name, is_json) in _ensured_tables:
+        return
     quoted = quote_ident(table_name)
     if is_json:
         ddl = f"""
@@ -104,8 +143,17 @@ async def ensure_topic_table(engine: AsyncEngine, table_name: str, is_json: bool
             value_json JSONB
         )
         """
+    index_ddl = f"CREATE INDEX IF NOT EXISTS {quote_ident(ts_index_name(table_name))} ON {quoted} (ts)"
     async with engine.begin() as conn:
-        await conn.execute(text(ddl))
+        exists = (
+            await conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": quoted})
+        ).scalar_one()
+        if not exists:
+            # A new table is empty, so indexing it here is cheap. Tables that existed
+            # before got their index from a migration, never from the ingest path.
+            await conn.execute(text(ddl))
+            await conn.execute(text(index_ddl))
+    _ensured_tables.add((table_name, is_json))
 
 
 async def get_table_columns(engine: AsyncEngine, table_name: str) -> dict[str, str]:
@@ -123,9 +171,11 @@ async def get_table_columns(engine: AsyncEngine, table_name: str) -> dict[str, s
 
 async def ensure_columns(
     engine: AsyncEngine, table_name: str, columns: list[ColumnSpec]
-) -> dict[str, str]:
+) -> tuple[dict[str, str], list[str]]:
+    """Add missing columns; returns all columns and the names of the ones added."""
     existing = await get_table_columns(engine, table_name)
     quoted_table = quote_ident(table_name)
+    added: list[str] = []
     async with engine.begin() as conn:
         for col in columns:
             if col.name in existing:
@@ -133,7 +183,8 @@ async def ensure_columns(
             ddl = f"ALTER TABLE {quoted_table} ADD COLUMN {quote_ident(col.name)} {col.type_name}"
             await conn.execute(text(ddl))
             existing[col.name] = col.type_name
-    return existing
+            added.append(col.name)
+    return existing, added
 
 
 async def widen_column(
@@ -149,6 +200,36 @@ async def widen_column(
     """
     async with engine.begin() as conn:
         await conn.execute(text(ddl))
+        await conn.execute(text(RECORD_TYPE_CHANGE_SQL), {"table_name": table_name})
+    # Pooled connections keep statements prepared with the old column type, so start a
+    # fresh pool; other processes do the same from watch_column_types().
+    await engine.dispose()
+
+
+async def column_types_version(engine: AsyncEngine) -> tuple[int, int]:
+    """Changes whenever any process changes the type of a topic table column."""
+    async with engine.begin() as conn:
+        return tuple((await conn.execute(text(COLUMN_TYPES_VERSION_SQL))).one())
+
+
+async def watch_column_types(engine: AsyncEngine, engines: list[AsyncEngine]) -> None:
+    """Dispose the pools of ``engines`` after a column type change made by any process.
+
+    Until the change is seen, a stale prepared statement fails its query once per
+    connection; the asyncpg dialect then clears its caches for the next one.
+    """
+    seen: tuple[int, int] | None = None
+    while True:
+        try:
+            version = await column_types_version(engine)
+        except Exception:
+            logger.exception("Reading column type changes failed")
+        else:
+            if seen is not None and version != seen:
+                for pooled in engines:
+                    await pooled.dispose()
+            seen = version
+        await asyncio.sleep(COLUMN_TYPES_POLL_SECONDS)
 
 
 def normalize_value_for_column(value: Any, column_type: str) -> Any:
@@ -1,12 +1,24 @@
 from sqlalchemy.engine import make_url
-from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
 
+import asyncio
 import asyncpg
 import logging
+import time
+from typing import Awaitable, Callable
 
 from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
 
-from mqttap.db.schema import metadata
+from mqttap.db.dynamic import quote_ident, ts_index_name
+from mqttap.db.schema import (
+    column_type_changes,
+    history_backfills,
+    import_jobs,
+    metadata,
+    schema_version,
+    topic_writes,
+)
 from mqttap.config import settings
 from mqttap.security import hash_password
 from mqttap.services.settings import seed_settings_if_empty
@@ -44,14 +56,197 @@ async def ensure_database_exists() -> None:
         await conn.close()
 
 
-async def init_base_schema(engine: AsyncEngine) -> None:
-    await ensure_database_exists()
-    async with engine.begin() as conn:
-        await conn.run_sync(metadata.create_all)
-        await _ensure_users_schema(conn)
-        await _ensure_invites_schema(conn)
-        await seed_settings_if_empty(conn)
-        await _seed_roles_and_admin(conn)
+async def init_base_schema(engine: AsyncEngine) -> int:
+    """Bring the database up to :data:`SCHEMA_VERSION` and return the version found.
+
+    An up-to-date database costs one query; the admin connection that creates the
+    database is only opened when connecting to it fails.
+    """
+    try:
+        version = await current_schema_version(engine)
+    except DBAPIError as exc:
+        if _sqlstate(exc) != INVALID_CATALOG_NAME:
+            raise
+        await ensure_database_exists()
+        version = 0
+    if version >= SCHEMA_VERSION:
+        return version
+    async with engine.connect() as lock_conn:
+        # Workers starting together migrate one at a time; later ones find nothing to do.
+        # The lock is held by a session outside any transaction and waited for by
+        # polling, so a waiting worker holds no snapshot that a concurrent index build
+        # in another process would have to wait for.
+        lock_conn = await lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+        while not (
+            await lock_conn.execute(
+                text("SELECT pg_try_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY}
+            )
+        ).scalar_one():
+            await asyncio.sleep(MIGRATION_LOCK_RETRY_SECONDS)
+        try:
+            await lock_conn.run_sync(schema_version.create, checkfirst=True)
+            applied = (
+                await lock_conn.execute(text("SELECT max(version) FROM schema_version"))
+            ).scalar_one() or 0
+            for number, name, migrate in MIGRATIONS:
+                if number <= applied:
+                    continue
+                started = time.perf_counter()
+                async with engine.begin() as conn:
+                    await migrate(conn)
+                    await _record_migration(conn, number, name)
+                logger.info(
+                    "Applied schema migration %s (%s) in %.0f ms",
+                    number,
+                    name,
+                    (time.perf_counter() - started) * 1000,
+                )
+        finally:
+            await lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+    return version
+
+
+async def _record_migration(conn: AsyncConnection, number: int, name: str) -> None:
+    await conn.execute(
+        text("INSERT INTO schema_version (version, name) VALUES (:version, :name)"),
+        {"version": number, "name": name},
+    )
+
+
+async def current_schema_version(engine: AsyncEngine) -> int:
+    async with engine.connect() as conn:
+        try:
+            result = await conn.execute(text("SELECT max(version) FROM schema_version"))
+        except DBAPIError as exc:
+            if _sqlstate(exc) != UNDEFINED_TABLE:
+                raise
+            return 0
+        return result.scalar_one() or 0
+
+
+def _sqlstate(exc: DBAPIError) -> str | None:
+    return getattr(exc.orig, "sqlstate", None)
+
+
+async def _migrate_base_schema(conn: AsyncConnection) -> None:
+    await conn.run_sync(metadata.create_all)
+    await _ensure_users_schema(conn)
+    await _ensure_invites_schema(conn)
+    await seed_settings_if_empty(conn)
+    await _seed_roles_and_admin(conn)
+
+
+async def _migrate_history_backfills(conn: AsyncConnection) -> None:
+    await conn.run_sync(history_backfills.create, checkfirst=True)
+
+
+async def _migrate_import_jobs(conn: AsyncConnection) -> None:
+    await conn.run_sync(import_jobs.create, checkfirst=True)
+
+
+async def _migrate_topic_writes(conn: AsyncConnection) -> None:
+    await conn.run_sync(topic_writes.create, checkfirst=True)
+
+
+async def _migrate_topic_history_start(conn: AsyncConnection) -> None:
+    # Left NULL: the first history read of each table fills it in (TopicStats.history_start).
+    await conn.execute(
+        text("ALTER TABLE topic_stats ADD COLUMN IF NOT EXISTS history_start TIMESTAMPTZ")
+    )
+
+
+async def _migrate_column_type_changes(conn: AsyncConnection) -> None:
+    await conn.run_sync(column_type_changes.create, checkfirst=True)
+
+
+async def build_topic_ts_indexes(engine: AsyncEngine) -> None:
+    """Index ``ts`` of topic tables created before new tables got the index with them.
+
+    Runs in the background after startup, in one process at a time. Indexes are built
+    with ``CREATE INDEX CONCURRENTLY`` outside a transaction, so ingest and history
+    queries keep running meanwhile; until a table's index exists its range scans are
+    sequential. The earlier indexes, named after a truncated table name that could
+    collide between tables, are dropped once every replacement exists.
+    """
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        locked = (
+            await conn.execute(
+                text("SELECT pg_try_advisory_lock(:key)"), {"key": INDEX_BUILD_LOCK_KEY}
+            )
+        ).scalar_one()
+        if not locked:
+            return
+        try:
+            table_names = (
+                await conn.execute(
+                    text(
+                        """
+                        SELECT DISTINCT table_name FROM topic_registry
+                        WHERE to_regclass(quote_ident(table_name)) IS NOT NULL
+                        ORDER BY table_name
+                        """
+                    )
+                )
+            ).scalars().all()
+            for table_name in table_names:
+                await _build_ts_index(conn, table_name)
+            index_names = {ts_index_name(table_name) for table_name in table_names}
+            for table_name in table_names:
+                legacy_name = table_name[:56] + "_ts_idx"
+                if legacy_name in index_names:
+                    continue
+                await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {quote_ident(legacy_name)}"))
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": INDEX_BUILD_LOCK_KEY})
+
+
+async def _build_ts_index(conn: AsyncConnection, table_name: str) -> None:
+    index_name = ts_index_name(table_name)
+    valid = (
+        await conn.execute(
+            text(
+                "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(quote_ident(:index_name))"
+            ),
+            {"index_name": index_name},
+        )
+    ).scalar_one_or_none()
+    if valid:
+        return
+    if valid is not None:
+        # A build interrupted earlier leaves an invalid index that IF NOT EXISTS would keep.
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {quote_ident(index_name)}"))
+    started = time.perf_counter()
+    await conn.execute(
+        text(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {quote_ident(index_name)} "
+            f"ON {quote_ident(table_name)} (ts)"
+        )
+    )
+    logger.info(
+        "Built ts index of %s in %.0f ms", table_name, (time.perf_counter() - started) * 1000
+    )
+
+
+# Applied in order, each exactly once. Append new steps; never edit or reorder applied
+# ones. Steps must be idempotent, because databases created before the schema_version
+# table existed run step 1 on top of a complete schema.
+MIGRATIONS: list[tuple[int, str, Callable[[AsyncConnection], Awaitable[None]]]] = [
+    (1, "base schema", _migrate_base_schema),
+    (2, "history backfill log", _migrate_history_backfills),
+    (3, "import jobs", _migrate_import_jobs),
+    (4, "topic write counters", _migrate_topic_writes),
+    (5, "topic history start", _migrate_topic_history_start),
+    (6, "column type changes", _migrate_column_type_changes),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+MIGRATION_LOCK_KEY = 0x6D717474  # "mqtt"
+MIGRATION_LOCK_RETRY_SECONDS = 0.5
+# Held by the one process building topic ts indexes; the others skip the build.
+INDEX_BUILD_LOCK_KEY = 0x6D717475
+
+UNDEFINED_TABLE = "42P01"
+INVALID_CATALOG_NAME = "3D000"
 
 
 async def _seed_roles_and_admin(conn) -> None:
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import math
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from mqttap.services.metrics import metrics
+from mqttap.services.watermarks import write_watermarks
+
+logger = logging.getLogger(__name__)
+
+# A replica's lag is measured against WAL positions sampled on the primary, not from its
+# own receiver state: a replica cut off from the primary has replayed everything it
+# received and would look current forever.
+PRIMARY_LSN_SQL = "SELECT pg_current_wal_lsn()::text"
+REPLICA_STATE_SQL = """
+    SELECT pg_is_in_recovery() AS in_recovery, pg_last_wal_replay_lsn()::text AS replay_lsn
+"""
+
+
+def parse_lsn(value: str | None) -> int | None:
+    if not value:
+        return None
+    high, _, low = value.partition("/")
+    return (int(high, 16) << 32) | int(low, 16)
+
+
+@dataclass
+class ReadTarget:
+    """Engine chosen for a read; ``consistent_at`` is None when it is the primary."""
+
+    engine: AsyncEngine
+    name: str
+    consistent_at: datetime | None = None
+
+    def covers(self, table_names: list[str]) -> bool:
+        """Whether every write this process made to ``table_names`` is visible here."""
+        if self.consistent_at is None:
+            return True
+        for table_name in table_names:
+            last_write = write_watermarks.last_write(table_name)
+            if last_write is not None and last_write >= self.consistent_at:
+                return False
+        return True
+
+
+class _Replica:
+    def __init__(self, name: str, engine: AsyncEngine) -> None:
+        self.name = name
+        self.engine = engine
+        self.lock = asyncio.Lock()
+        self.checked_at: datetime | None = None
+        self.healthy = False
+        self.lag = 0.0
+        self.replay_lsn: int | None = None
+        self.consistent_at: datetime | None = None
+
+
+_read_target: ContextVar[ReadTarget | None] = ContextVar("read_target", default=None)
+
+
+def read_engine(default: AsyncEngine) -> AsyncEngine:
+    """Engine selected by the enclosing :meth:`ReadRouter.route`, else ``default``."""
+    target = _read_target.get()
+    return target.engine if target is not None else default
+
+
+def read_consistent_at() -> datetime | None:
+    target = _read_target.get()
+    return target.consistent_at if target is not None else None
+
+
+class ReadRouter:
+    """Round-robin routing of read-only queries to streaming replicas.
+
+    A replica's lag is the age of the newest primary WAL position, sampled every
+    ``check_seconds``, that it has replayed. A replica is used only while its lag is
+    below ``max_lag`` and it has replayed every WAL position registered with
+    :meth:`note_write` for the tables being read. Otherwise the query goes to the
+    primary.
+    """
+
+    def __init__(
+        self,
+        primary: AsyncEngine,
+        replicas: list[AsyncEngine],
+        max_lag: float,
+        check_seconds: float,
+    ) -> None:
+        self.primary = primary
+        self.max_lag = max_lag
+        self.check_seconds = check_seconds
+        self._replicas = [_Replica(f"replica{index}", engine) for index, engine in enumerate(replicas)]
+        self._next = 0
+        self._required_lsn: dict[str, int] = {}
+        # (time, primary WAL position read at or after it), oldest first.
+        self._primary_lsns: deque[tuple[datetime, int]] = deque()
+        self._primary_lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._replicas)
+
+    def note_write(self, table_name: str, lsn: str) -> None:
+        """Require replicas to have replayed ``lsn`` before they serve ``table_name``."""
+        value = parse_lsn(lsn)
+        if value is not None:
+            self._required_lsn[table_name] = max(value, self._required_lsn.get(table_name, 0))
+
+    async def _sample_primary(self) -> None:
+        async with self._primary_lock:
+            now = datetime.now(timezone.utc)
+            if self._primary_lsns and (now - self._primary_lsns[-1][0]).total_seconds() < self.check_seconds:
+                return
+            async with self.primary.connect() as conn:
+                lsn = parse_lsn((await conn.execute(text(PRIMARY_LSN_SQL))).scalar_one())
+            assert lsn is not None
+            self._primary_lsns.append((now, lsn))
+            # Older samples could only prove a lag above max_lag.
+            horizon = now - timedelta(seconds=self.max_lag + self.check_seconds)
+            while len(self._primary_lsns) > 1 and self._primary_lsns[0][0] < horizon:
+                self._primary_lsns.popleft()
+
+    async def _refresh(self, replica: _Replica) -> None:
+        async with replica.lock:
+            now = datetime.now(timezone.utc)
+            if replica.checked_at and (now - replica.checked_at).total_seconds() < self.check_seconds:
+                return
+            try:
+                await self._sample_primary()
+                async with replica.engine.connect() as conn:
+                    row = (await conn.execute(text(REPLICA_STATE_SQL))).mappings().one()
+                replica.replay_lsn = parse_lsn(row["replay_lsn"])
+                if not row["in_recovery"]:
+                    replica.consistent_at = now
+                else:
+                    # The replica holds everything committed before the latest sample
+                    # whose position it has replayed.
+                    replica.consistent_at = max(
+                        (
+                            sampled_at
+                            for sampled_at, lsn in self._primary_lsns
+                            if replica.replay_lsn is not None and lsn <= replica.replay_lsn
+                        ),
+                        default=None,
+                    )
+                replica.lag = (
+                    max((now - replica.consistent_at).total_seconds(), 0.0)
+                    if replica.consistent_at is not None
+                    else math.inf
+                )
+                replica.healthy = True
+            except Exception as exc:
+                if replica.healthy or replica.checked_at is None:
+                    logger.warning("Read replica %s unavailable: %s", replica.name, exc)
+                replica.healthy = False
+            replica.checked_at = now
+
+    async def choose(self, table_names: list[str], fresh: bool = False) -> ReadTarget:
+        primary = ReadTarget(self.primary, "primary")
+        if not self._replicas:
+            return primary
+        if fresh:
+            metrics.increment("db_read_primary_fallbacks", reason="fresh")
+            return primary
+        required = max((self._required_lsn.get(name, 0) for name in table_names), default=0)
+        reason = "lag"
+        for offset in range(len(self._replicas)):
+            replica = self._replicas[(self._next + offset) % len(self._replicas)]
+            await self._refresh(replica)
+            if not replica.healthy:
+                reason = "unavailable"
+                continue
+            if replica.lag > self.max_lag:
+                continue
+            if required and replica.replay_lsn is not None and replica.replay_lsn < required:
+                reason = "read_your_writes"
+                continue
+            self._next = (self._next + offset + 1) % len(self._replicas)
+            metrics.increment("db_read_routes", target=replica.name)
+            return ReadTarget(replica.engine, replica.name, consistent_at=replica.consistent_at)
+        metrics.increment("db_read_primary_fallbacks", reason=reason)
+        return primary
+
+    @asynccontextmanager
+    async def route(self, table_names: list[str], fresh: bool = False) -> AsyncIterator[ReadTarget]:
+        target = await self.choose(table_names, fresh)
+        token = _read_target.set(target)
+        try:
+            yield target
+        finally:
+            _read_target.reset(token)
@@ -1,8 +1,11 @@
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
     DateTime,
+    Float,
     Integer,
+    LargeBinary,
     MetaData,
     JSON,
     String,
@@ -55,6 +58,42 @@ topic_registry = Table(
     Column("created_at", DateTime(timezone=True), server_default=func.now()),
 )
 
+topic_sketches = Table(
+    "topic_sketches",
+    metadata,
+    Column("table_name", String(255), primary_key=True),
+    Column("field", String(255), primary_key=True),
+    Column("bucket", DateTime(timezone=True), primary_key=True),
+    Column("sketch", LargeBinary, nullable=False),
+    Column("updated_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+topic_stats = Table(
+    "topic_stats",
+    metadata,
+    Column("table_name", String(255), primary_key=True),
+    Column("message_count", BigInteger, nullable=False, server_default="0"),
+    Column("bytes", BigInteger, nullable=False, server_default="0"),
+    Column("schema_changes", Integer, nullable=False, server_default="0"),
+    Column("first_ts", DateTime(timezone=True), nullable=True),
+    Column("last_ts", DateTime(timezone=True), nullable=True),
+    Column("rate_ewma", Float, nullable=True),
+    Column("rate_at", DateTime(timezone=True), nullable=True),
+    # Earliest ts in the table from any writer, including imports; NULL until first read.
+    Column("history_start", DateTime(timezone=True), nullable=True),
+    Column("updated_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+topic_latest = Table(
+    "topic_latest",
+    metadata,
+    Column("table_name", String(255), primary_key=True),
+    Column("field", String(255), primary_key=True),
+    Column("ts", DateTime(timezone=True), nullable=False),
+    Column("value", JSON, nullable=True),
+    Column("updated_at", DateTime(timezone=True), server_default=func.now()),
+)
+
 user_charts = Table(
     "user_charts",
     metadata,
@@ -77,3 +116,60 @@ invites = Table(
     Column("created_at", DateTime(timezone=True), server_default=func.now()),
     Column("updated_at", DateTime(timezone=True), server_default=func.now(), onupdate=func.now()),
 )
+
+history_backfills = Table(
+    "history_backfills",
+    metadata,
+    Column("id", BigInteger, primary_key=True),
+    Column("table_name", String(255), nullable=False),
+    Column("since", DateTime(timezone=True), nullable=False),
+    Column("created_at", DateTime(timezone=True), server_default=func.clock_timestamp(), index=True),
+)
+
+import_jobs = Table(
+    "import_jobs",
+    metadata,
+    Column("id", String(32), primary_key=True),
+    Column("user_id", Integer, nullable=False),
+    Column("topic", String(255), nullable=False),
+    Column("path", Text, nullable=False),
+    Column("size", BigInteger, nullable=False),
+    Column("delimiter", String(8), nullable=False),
+    Column("headers", JSON, nullable=False),
+    Column("sample", JSON, nullable=False),
+    Column("sample_complete", Boolean, nullable=False),
+    Column("status", String(20), nullable=False),
+    Column("progress", JSON, nullable=True),
+    Column("error", JSON, nullable=True),
+    Column("cancel_requested", Boolean, nullable=False, server_default="false"),
+    Column("created_at", DateTime(timezone=True), nullable=False),
+    Column("started_at", DateTime(timezone=True), nullable=True),
+    Column("finished_at", DateTime(timezone=True), nullable=True),
+    Column("updated_at", DateTime(timezone=True), nullable=False),
+)
+
+# Per-table write counters, bumped in the transaction of every write into a topic table.
+topic_writes = Table(
+    "topic_writes",
+    metadata,
+    Column("table_name", String(255), primary_key=True),
+    Column("version", BigInteger, nullable=False),
+    Column("updated_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
+
+# Per-table count of column type changes, bumped in the transaction of the ALTER.
+column_type_changes = Table(
+    "column_type_changes",
+    metadata,
+    Column("table_name", String(255), primary_key=True),
+    Column("version", BigInteger, nullable=False),
+    Column("updated_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
+
+schema_version = Table(
+    "schema_version",
+    metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(255), nullable=False),
+    Column("applied_at", DateTime(timezone=True), server_default=func.now()),
+)
@@ -0,0 +1,112 @@
+import asyncio
+import math
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import AsyncIterator
+
+from fastapi import HTTPException
+
+
+class _Lane:
+    def __init__(self, name: str, limit: int) -> None:
+        self.name = name
+        self.semaphore = asyncio.Semaphore(max(limit, 1))
+        self.waiting = 0
+
+
+class AdmissionController:
+    """Per-user and global concurrency limits for history queries.
+
+    Queries are routed by estimated cost to a ``light`` or ``heavy`` lane, each with its
+    own global limit, so a few expensive scans cannot occupy every slot. Requests wait
+    up to ``queue_seconds`` for a slot; when the queue is full or the wait times out
+    they are rejected with 429 and a ``Retry-After`` hint.
+    """
+
+    def __init__(
+        self,
+        light_limit: int,
+        heavy_limit: int,
+        user_limit: int,
+        heavy_rows: int,
+        queue_seconds: float,
+        max_queue: int,
+    ) -> None:
+        self.light = _Lane("light", light_limit)
+        self.heavy = _Lane("heavy", heavy_limit)
+        self.user_limit = max(user_limit, 1)
+        self.heavy_rows = heavy_rows
+        self.queue_seconds = queue_seconds
+        self.max_queue = max_queue
+        self._user_slots: dict[int, asyncio.Semaphore] = {}
+        self._user_refs: dict[int, int] = {}
+
+    def lane_for(self, estimated_rows: int) -> _Lane:
+        return self.heavy if estimated_rows >= self.heavy_rows else self.light
+
+    def _retry_after(self) -> str:
+        return str(max(1, math.ceil(self.queue_seconds)))
+
+    def _reject(self, detail: str) -> HTTPException:
+        return HTTPException(status_code=429, detail=detail, headers={"Retry-After": self._retry_after()})
+
+    async def _acquire(self, semaphore: asyncio.Semaphore, lane: _Lane, detail: str) -> None:
+        if semaphore.locked() and lane.waiting >= self.max_queue:
+            raise self._reject(detail)
+        lane.waiting += 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=self.queue_seconds)
+        except asyncio.TimeoutError:
+            raise self._reject(detail) from None
+        finally:
+            lane.waiting -= 1
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, estimated_rows: int) -> AsyncIterator[str]:
+        lane = self.lane_for(estimated_rows)
+        user_slot = self._user_slots.setdefault(user_id, asyncio.Semaphore(self.user_limit))
+        self._user_refs[user_id] = self._user_refs.get(user_id, 0) + 1
+        try:
+            # Take the per-user slot first so a user queueing behind their own queries
+            # does not hold a global slot meanwhile.
+            await self._acquire(user_slot, lane, "Too many concurrent history queries for this user")
+            try:
+                await self._acquire(lane.semaphore, lane, "History query capacity exhausted, retry later")
+                try:
+                    yield lane.name
+                finally:
+                    lane.semaphore.release()
+            finally:
+                user_slot.release()
+        finally:
+            self._user_refs[user_id] -= 1
+            if not self._user_refs[user_id]:
+                del self._user_refs[user_id]
+                del self._user_slots[user_id]
+
+
+def estimate_scanned_rows(
+    message_count: int | None,
+    first_ts: datetime | None,
+    last_ts: datetime | None,
+    dt_from: datetime | None,
+    dt_to: datetime | None,
+) -> int | None:
+    """Rows a range scan will touch, from the topic's average message rate.
+
+    Returns None when the topic has no statistics to base an estimate on, or when the
+    range starts before them: history imported or kept from before the statistics
+    were collected is not counted in them, so the rate says nothing about it.
+    """
+    if not message_count or first_ts is None or last_ts is None:
+        return None
+    if dt_from is None or dt_from < first_ts:
+        return None
+    # Ingest has written nothing after ``last_ts`` yet.
+    end = min(dt_to, last_ts) if dt_to else last_ts
+    if end < dt_from:
+        return 0
+    total_seconds = (last_ts - first_ts).total_seconds()
+    if total_seconds <= 0:
+        return message_count
+    return math.ceil(message_count * (end - dt_from).total_seconds() / total_seconds)
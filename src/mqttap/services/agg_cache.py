@@ -0,0 +1,177 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any
+
+SeriesKey = tuple[str, str, str, int, str]
+
+
+@dataclass
+class _CachedSeries:
+    # Every bucket starting in [covered_from, sealed_until) is either cached here or has
+    # no rows at all. covered_from=None means "from the first row of the table".
+    covered_from: datetime | None
+    sealed_until: datetime
+    buckets: dict[datetime, Any] = field(default_factory=dict)
+
+
+@dataclass
+class CachePlan:
+    """Which part of an aggregate query still has to run against the topic table."""
+
+    head_end: datetime
+    tail_from: datetime
+    cached_rows: list[dict[str, Any]]
+
+
+class AggregateCache:
+    """LRU cache of sealed aggregate buckets keyed by (table, field, agg, interval, bucket).
+
+    A bucket is sealed once it ends more than ``seal_seconds`` in the past: ingest
+    normally writes current timestamps, so such buckets never change unless something
+    writes into the past (an import, a queued or spooled ingest batch), which must call
+    :meth:`invalidate`, directly or through the backfill log. A query that was running
+    while its table was invalidated may have missed those rows, so :meth:`store` drops
+    results read before the current :meth:`generation` of the table.
+    """
+
+    def __init__(self, max_buckets: int, seal_seconds: float) -> None:
+        self.max_buckets = max_buckets
+        self.seal_seconds = seal_seconds
+        self._series: OrderedDict[SeriesKey, _CachedSeries] = OrderedDict()
+        self._size = 0
+        self._epoch = 0
+        self._generations: dict[str, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_buckets > 0
+
+    def generation(self, table_name: str) -> tuple[int, int]:
+        return self._epoch, self._generations.get(table_name, 0)
+
+    def seal_point(self, now: datetime) -> datetime:
+        return now - timedelta(seconds=self.seal_seconds)
+
+    def _usable(self, entry: _CachedSeries | None, dt_from: datetime | None) -> bool:
+        if entry is None:
+            return False
+        if entry.covered_from is None:
+            return True
+        return dt_from is not None and dt_from >= entry.covered_from
+
+    def plan(
+        self,
+        table_name: str,
+        fields: list[str],
+        agg: str,
+        interval_count: int,
+        interval_unit: str,
+        dt_from: datetime | None,
+    ) -> CachePlan | None:
+        keys = [(table_name, name, agg, interval_count, interval_unit) for name in fields]
+        entries = [self._series.get(key) for key in keys]
+        if not all(self._usable(entry, dt_from) for entry in entries):
+            return None
+        for key in keys:
+            self._series.move_to_end(key)
+
+        tail_from = min(entry.sealed_until for entry in entries)
+        buckets = sorted(
+            {
+                bucket
+                for entry in entries
+                for bucket in entry.buckets
+                if (dt_from is None or bucket >= dt_from) and bucket < tail_from
+            }
+        )
+        head_end = buckets[0] if buckets else tail_from
+        cached_rows = [
+            {"bucket": bucket, **{name: entry.buckets.get(bucket) for name, entry in zip(fields, entries)}}
+            for bucket in buckets
+        ]
+        return CachePlan(head_end=head_end, tail_from=tail_from, cached_rows=cached_rows)
+
+    def store(
+        self,
+        table_name: str,
+        fields: list[str],
+        agg: str,
+        interval_count: int,
+        interval_unit: str,
+        step: timedelta,
+        rows: list[dict[str, Any]],
+        dt_from: datetime | None,
+        now: datetime,
+        plan: CachePlan | None,
+        generation: tuple[int, int],
+    ) -> None:
+        if generation != self.generation(table_name):
+            return
+        seal_point = self.seal_point(now)
+        sealed = [
+            row
+            for row in rows
+            if (dt_from is None or row["bucket"] >= dt_from) and row["bucket"] + step <= seal_point
+        ]
+        if plan is not None:
+            sealed = [row for row in sealed if row["bucket"] >= plan.tail_from]
+        for name in fields:
+            key = (table_name, name, agg, interval_count, interval_unit)
+            if plan is None:
+                if not sealed:
+                    continue
+                self._drop(key)
+                entry = _CachedSeries(covered_from=dt_from, sealed_until=sealed[0]["bucket"])
+                self._series[key] = entry
+            else:
+                # The entry may have been evicted or invalidated while the query ran;
+                # only extend it if the new rows continue its covered range.
+                entry = self._series.get(key)
+                if entry is None or entry.sealed_until < plan.tail_from:
+                    continue
+            for row in sealed:
+                if row["bucket"] not in entry.buckets:
+                    self._size += 1
+                entry.buckets[row["bucket"]] = row.get(name)
+            if sealed:
+                entry.sealed_until = max(entry.sealed_until, sealed[-1]["bucket"] + step)
+            self._series.move_to_end(key)
+        self._evict()
+
+    def invalidate(self, table_name: str, since: datetime) -> None:
+        """Forget cached buckets of ``table_name`` that may contain rows at or after ``since``."""
+        self._generations[table_name] = self._generations.get(table_name, 0) + 1
+        for key in [key for key in self._series if key[0] == table_name]:
+            entry = self._series[key]
+            if since >= entry.sealed_until:
+                continue
+            # Buckets never span more than the interval, so anything starting after
+            # ``since - interval`` may have changed.
+            step = _interval_step(key[3], key[4])
+            keep = {bucket: value for bucket, value in entry.buckets.items() if bucket + step <= since}
+            if not keep:
+                self._drop(key)
+                continue
+            self._size -= len(entry.buckets) - len(keep)
+            entry.buckets = keep
+            entry.sealed_until = max(keep) + step
+
+    def clear(self) -> None:
+        self._epoch += 1
+        self._series.clear()
+        self._size = 0
+
+    def _drop(self, key: SeriesKey) -> None:
+        entry = self._series.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry.buckets)
+
+    def _evict(self) -> None:
+        while self._size > self.max_buckets and self._series:
+            _, entry = self._series.popitem(last=False)
+            self._size -= len(entry.buckets)
+
+
+def _interval_step(interval_count: int, interval_unit: str) -> timedelta:
+    return timedelta(**{f"{interval_unit}s": interval_count})
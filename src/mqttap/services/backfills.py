@@ -0,0 +1,97 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+# How long polled entries are reused before the log is read again.
+POLL_SECONDS = 1.0
+# Entries are read again for this long after the poll that first could have seen them,
+# so a transaction that committed a little after it inserted its entry is not missed.
+POLL_OVERLAP = timedelta(seconds=60)
+# Entries older than this are deleted. A process that has not polled for longer than
+# half of it may have missed some and is told to drop its caches instead.
+RETENTION = timedelta(hours=1)
+PRUNE_SECONDS = 60.0
+
+
+@dataclass
+class Backfill:
+    table_name: str
+    since: datetime
+    # WAL position the write is known to be included in.
+    lsn: str
+
+
+class BackfillLog:
+    """Writes into the past of topic tables, shared by every process through the database.
+
+    A writer that stores rows older than "now" (imports, merges, ingest batches that
+    were queued or spooled) records the earliest timestamp it wrote with :meth:`record`
+    in its own transaction. API processes read the log with :meth:`poll` to invalidate
+    their aggregate caches and to keep replicas that have not replayed the write from
+    serving the table, whichever process or worker made the write.
+    """
+
+    def __init__(self) -> None:
+        self._lock = asyncio.Lock()
+        self._checked_at: datetime | None = None
+        self._polled_at = 0.0
+        self._pruned_at = 0.0
+        self._seen: dict[int, datetime] = {}
+
+    async def record(self, conn: AsyncConnection, table_name: str, since: datetime) -> None:
+        await conn.execute(
+            text("INSERT INTO history_backfills (table_name, since) VALUES (:table_name, :since)"),
+            {"table_name": table_name, "since": since},
+        )
+
+    async def poll(self, engine: AsyncEngine) -> list[Backfill] | None:
+        """Entries committed since the previous poll; None when some may have been missed."""
+        async with self._lock:
+            now = time.monotonic()
+            if now - self._polled_at < POLL_SECONDS:
+                return []
+            self._polled_at = now
+            async with engine.begin() as conn:
+                checked_at, lsn = (
+                    await conn.execute(text("SELECT clock_timestamp(), pg_current_wal_lsn()::text"))
+                ).one()
+                if self._checked_at is None:
+                    # Nothing is cached yet, so earlier entries do not matter.
+                    self._checked_at = checked_at
+                    return []
+                after = self._checked_at - POLL_OVERLAP
+                rows = (
+                    await conn.execute(
+                        text(
+                            """
+                            SELECT id, table_name, since, created_at
+                            FROM history_backfills
+                            WHERE created_at >= :after
+                            """
+                        ),
+                        {"after": after},
+                    )
+                ).all()
+                if now - self._pruned_at >= PRUNE_SECONDS:
+                    self._pruned_at = now
+                    await conn.execute(
+                        text("DELETE FROM history_backfills WHERE created_at < :before"),
+                        {"before": checked_at - RETENTION},
+                    )
+            missed = checked_at - self._checked_at > RETENTION / 2
+            self._checked_at = checked_at
+            self._seen = {key: created_at for key, created_at in self._seen.items() if created_at >= after}
+            entries = []
+            for row in rows:
+                if row.id in self._seen:
+                    continue
+                self._seen[row.id] = row.created_at
+                entries.append(Backfill(row.table_name, row.since, lsn))
+            return None if missed else entries
+
+
+backfill_log = BackfillLog()
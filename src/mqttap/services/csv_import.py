@@ -0,0 +1,580 @@
+import asyncio
+import csv
+import io
+import json
+import math
+import re
+from collections import deque
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, Awaitable, BinaryIO, Callable, Iterable, TypeVar
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from mqttap.db.dynamic import quote_ident
+from mqttap.services.latest import LatestSample
+from mqttap.services.sketches import SketchBuffer
+
+# Bytes read from the start of an uploaded file to detect its delimiter.
+DELIMITER_SAMPLE_BYTES = 64 * 1024
+MAX_REPORTED_ERRORS = 100
+# Sketch buckets buffered by a streaming import before they are written out.
+SKETCH_BUFFER_BUCKETS = 10000
+# How imported rows are reconciled with rows already stored at the same ``ts``.
+CONFLICT_MODES = ("keep", "skip", "overwrite")
+# Staging table column holding the file order, so the last duplicate in a file wins.
+# Topic columns are sanitized identifiers and never start with an underscore.
+_STAGE_SEQ = "_stage_seq"
+
+CsvRecords = list[tuple[int, dict[str, str]]]
+ChunkValidator = Callable[[CsvRecords], Awaitable["ImportChunk"]]
+T = TypeVar("T")
+
+
+async def run_in_thread(func: Callable[..., T], *args: Any) -> T:
+    """``asyncio.to_thread`` that, when cancelled, waits for ``func`` before re-raising.
+
+    A cancelled ``to_thread`` leaves its thread running, so a ``finally`` that closes
+    the file being read would pull it from under the thread.
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+def local_timezone():
+    return datetime.now().astimezone().tzinfo or timezone.utc
+
+
+def ensure_tzaware(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=local_timezone())
+    return value
+
+
+def parse_import_datetime(value: str) -> datetime:
+    raw = value.strip()
+    if not raw:
+        raise ValueError("datetime is empty")
+    try:
+        return ensure_tzaware(datetime.fromisoformat(raw.replace("Z", "+00:00")))
+    except ValueError:
+        pass
+    for fmt in (
+        "%d.%m.%y %H:%M:%S",
+        "%d.%m.%Y %H:%M:%S",
+        "%d.%m.%y %H:%M",
+        "%d.%m.%Y %H:%M",
+        "%Y-%m-%d %H:%M:%S",
+        "%Y-%m-%d %H:%M",
+    ):
+        try:
+            return ensure_tzaware(datetime.strptime(raw, fmt))
+        except ValueError:
+            continue
+    raise ValueError("unsupported datetime format")
+
+
+# Day-first strptime formats probed by parse_import_datetime, as equivalent regexes with
+# groups day, month, year, hour, minute[, second]. The "%Y-%m-%d ..." ones are ISO.
+_DATETIME_FORMATS: dict[str, re.Pattern[str]] = {
+    "%d.%m.%y %H:%M:%S": re.compile(r"(\d{1,2})\.(\d{1,2})\.(\d{2}) (\d{1,2}):(\d{1,2}):(\d{1,2})"),
+    "%d.%m.%Y %H:%M:%S": re.compile(r"(\d{1,2})\.(\d{1,2})\.(\d{4}) (\d{1,2}):(\d{1,2}):(\d{1,2})"),
+    "%d.%m.%y %H:%M": re.compile(r"(\d{1,2})\.(\d{1,2})\.(\d{2}) (\d{1,2}):(\d{1,2})"),
+    "%d.%m.%Y %H:%M": re.compile(r"(\d{1,2})\.(\d{1,2})\.(\d{4}) (\d{1,2}):(\d{1,2})"),
+}
+DATETIME_SAMPLE_SIZE = 50
+
+
+class DatetimeParser:
+    """Parser for one datetime column, specialised on the format detected from a sample.
+
+    Values in the detected format go through ``fromisoformat`` or one compiled regex,
+    with the local timezone looked up once; anything else falls back to
+    :func:`parse_import_datetime`, so results never differ from it.
+    """
+
+    def __init__(self, fmt: str | None) -> None:
+        self.format = fmt
+        self._tz = local_timezone()
+        self._pattern = _DATETIME_FORMATS.get(fmt) if fmt else None
+        self._two_digit_year = fmt is not None and "%y" in fmt
+
+    def _fast(self, raw: str) -> datetime | None:
+        if self.format == "iso":
+            try:
+                value = datetime.fromisoformat(raw.replace("Z", "+00:00"))
+            except ValueError:
+                return None
+            return value if value.tzinfo is not None else value.replace(tzinfo=self._tz)
+        if self._pattern is None:
+            return None
+        match = self._pattern.fullmatch(raw)
+        if match is None:
+            return None
+        day, month, year, *clock = (int(part) for part in match.groups())
+        if self._two_digit_year:
+            year += 1900 if year >= 69 else 2000
+        try:
+            return datetime(year, month, day, *clock, tzinfo=self._tz)
+        except ValueError:
+            return None
+
+    def __call__(self, value: str) -> datetime:
+        parsed = self._fast(value.strip())
+        return parsed if parsed is not None else parse_import_datetime(value)
+
+
+def infer_datetime_parser(values: Iterable[str | None]) -> DatetimeParser:
+    """Detect the datetime format of a column from its first non-empty values."""
+    sample = []
+    for value in values:
+        raw = (value or "").strip()
+        if raw:
+            sample.append(raw)
+            if len(sample) >= DATETIME_SAMPLE_SIZE:
+                break
+    best, best_hits = None, 0
+    for fmt in ("iso", *_DATETIME_FORMATS):
+        parser = DatetimeParser(fmt)
+        hits = sum(1 for raw in sample if parser._fast(raw) is not None)
+        if hits > best_hits:
+            best, best_hits = fmt, hits
+    return DatetimeParser(best)
+
+
+def detect_csv_delimiter(csv_text: str) -> str:
+    lines = csv_text.splitlines()
+    if not lines:
+        return ";"
+    sample = "\n".join(lines[:5])
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=";,\t|")
+        if dialect.delimiter:
+            return dialect.delimiter
+    except csv.Error:
+        pass
+    first_line = lines[0]
+    counts = {delimiter: first_line.count(delimiter) for delimiter in (";", "\t", ",", "|")}
+    best = max(counts, key=counts.get)
+    return best if counts[best] > 0 else ";"
+
+
+def normalize_csv_headers(fieldnames: list[str | None] | None) -> list[str]:
+    if not fieldnames:
+        raise HTTPException(status_code=400, detail="CSV header row is required")
+    headers: list[str] = []
+    for index, fieldname in enumerate(fieldnames, start=1):
+        header = (fieldname or "").lstrip("\ufeff").strip()
+        if not header:
+            raise HTTPException(status_code=400, detail=f"CSV header #{index} is empty")
+        if header in headers:
+            raise HTTPException(status_code=400, detail=f"Duplicate CSV header: {header}")
+        headers.append(header)
+    return headers
+
+
+def normalize_number_string(value: str) -> str:
+    normalized = value.strip().replace("\u00a0", "").replace(" ", "")
+    if "," in normalized and "." not in normalized:
+        normalized = normalized.replace(",", ".")
+    return normalized
+
+
+def coerce_import_value(raw: str | None, column_type: str, float_precision: int) -> Any:
+    if raw is None:
+        return None
+    text_value = str(raw).strip()
+    if text_value == "":
+        return None
+    normalized_type = column_type.lower()
+    if normalized_type == "bigint":
+        parsed = float(normalize_number_string(text_value))
+        if not math.isfinite(parsed) or not parsed.is_integer():
+            raise ValueError("expected integer")
+        return int(parsed)
+    if normalized_type == "double precision":
+        parsed = float(normalize_number_string(text_value))
+        if not math.isfinite(parsed):
+            raise ValueError("expected finite number")
+        return round(parsed, float_precision)
+    if normalized_type == "boolean":
+        normalized_value = text_value.lower()
+        if normalized_value in {"true", "1", "yes", "on", "да"}:
+            return True
+        if normalized_value in {"false", "0", "no", "off", "нет"}:
+            return False
+        raise ValueError("expected boolean")
+    if normalized_type == "jsonb":
+        return json.loads(text_value)
+    return text_value
+
+
+def validate_import_record(
+    row_index: int,
+    record: dict[str, str],
+    datetime_column: str,
+    field_mapping: dict[str, str],
+    column_types: dict[str, str],
+    float_precision: int,
+    parse_datetime: Callable[[str], datetime] = parse_import_datetime,
+) -> tuple[dict[str, Any] | None, list[dict[str, Any]]]:
+    """Convert one CSV record into a topic table row.
+
+    Returns the row, or None when the record is invalid or has no values, and the
+    record's errors.
+    """
+    row_errors: list[dict[str, Any]] = []
+    raw_dt = record.get(datetime_column, "")
+    try:
+        parsed_dt = parse_datetime(raw_dt)
+    except ValueError as exc:
+        row_errors.append(
+            {
+                "row": row_index,
+                "column": datetime_column,
+                "value": raw_dt,
+                "message": f"Invalid datetime: {exc}",
+            }
+        )
+        parsed_dt = None
+
+    values: dict[str, Any] = {}
+    for field_name, source_column in field_mapping.items():
+        raw_value = record.get(source_column, "")
+        try:
+            coerced_value = coerce_import_value(
+                raw_value,
+                column_types.get(field_name, "text"),
+                float_precision,
+            )
+        except (TypeError, ValueError, json.JSONDecodeError) as exc:
+            row_errors.append(
+                {
+                    "row": row_index,
+                    "column": source_column,
+                    "field": field_name,
+                    "value": raw_value,
+                    "message": f"Invalid value for {field_name}: {exc}",
+                }
+            )
+            continue
+        if coerced_value is not None:
+            values[field_name] = coerced_value
+
+    if row_errors or parsed_dt is None or not values:
+        return None, row_errors
+    row = {"ts": parsed_dt}
+    for field_name in field_mapping:
+        row[field_name] = values.get(field_name)
+    return row, row_errors
+
+
+@dataclass
+class ImportChunk:
+    rows: list[dict[str, Any]]
+    errors: list[dict[str, Any]]
+    total_rows: int
+    skipped_rows: int
+    invalid_rows: int
+
+
+def validate_import_chunk(
+    records: CsvRecords,
+    datetime_column: str,
+    field_mapping: dict[str, str],
+    column_types: dict[str, str],
+    float_precision: int,
+) -> ImportChunk:
+    chunk = ImportChunk(rows=[], errors=[], total_rows=len(records), skipped_rows=0, invalid_rows=0)
+    parse_datetime = infer_datetime_parser(record.get(datetime_column) for _, record in records)
+    for row_index, record in records:
+        row, row_errors = validate_import_record(
+            row_index, record, datetime_column, field_mapping, column_types, float_precision, parse_datetime
+        )
+        if row_errors:
+            chunk.errors.extend(row_errors)
+            chunk.invalid_rows += 1
+        elif row is None:
+            chunk.skipped_rows += 1
+        else:
+            chunk.rows.append(row)
+    return chunk
+
+
+class CsvStream:
+    """Non-empty records of an uploaded CSV file, read lazily in chunks.
+
+    Only the current chunk is held in memory, whatever the size of the file.
+    """
+
+    def __init__(self, file: BinaryIO, delimiter: str | None) -> None:
+        sample = file.read(DELIMITER_SAMPLE_BYTES).decode("utf-8-sig", errors="ignore")
+        file.seek(0)
+        if not sample.strip():
+            raise HTTPException(status_code=400, detail="CSV is empty")
+        self.delimiter = delimiter or detect_csv_delimiter(sample)
+        self._text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+        self._reader = csv.reader(self._text, delimiter=self.delimiter)
+        self.headers = normalize_csv_headers(self._next_values())
+        self._row_index = 1
+        self._owned: BinaryIO | None = None
+
+    @classmethod
+    def open(cls, path: str, delimiter: str | None) -> "CsvStream":
+        """Stream over a file on disk; :meth:`close` also closes the file."""
+        file = open(path, "rb")
+        try:
+            stream = cls(file, delimiter)
+        except BaseException:
+            file.close()
+            raise
+        stream._owned = file
+        return stream
+
+    def _next_values(self) -> list[str] | None:
+        try:
+            return next(self._reader, None)
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="CSV must be UTF-8 encoded") from None
+
+    @property
+    def bytes_read(self) -> int:
+        """Approximate position in the file, for progress reporting."""
+        return self._text.buffer.tell()
+
+    def read_chunk(self, size: int) -> CsvRecords:
+        """Up to ``size`` records with their row numbers; empty at the end of the file."""
+        chunk: CsvRecords = []
+        while len(chunk) < size:
+            values = self._next_values()
+            if values is None:
+                break
+            if not any(value.strip() for value in values):
+                continue
+            self._row_index += 1
+            chunk.append((self._row_index, dict(zip(self.headers, values))))
+        return chunk
+
+    def close(self) -> None:
+        # Leave the underlying file for its owner to close unless it was opened here.
+        self._text.detach()
+        if self._owned is not None:
+            self._owned.close()
+
+
+@dataclass
+class ImportResult:
+    total_rows: int = 0
+    imported_rows: int = 0
+    skipped_rows: int = 0
+    invalid_rows: int = 0
+    errors: list[dict[str, Any]] = field(default_factory=list)
+    bytes_read: int = 0
+    first_ts: datetime | None = None
+    last_ts: datetime | None = None
+    latest: dict[str, LatestSample] = field(default_factory=dict)
+    # Set by a merge: rows added to and rows updated in the topic table.
+    inserted_rows: int | None = None
+    updated_rows: int = 0
+
+    def add_rows(self, rows: list[dict[str, Any]], fields: list[str]) -> None:
+        """Count imported rows and keep their time range and latest values."""
+        self.imported_rows += len(rows)
+        for row in rows:
+            ts = row["ts"]
+            if self.first_ts is None or ts < self.first_ts:
+                self.first_ts = ts
+            if self.last_ts is None or ts > self.last_ts:
+                self.last_ts = ts
+            for field_name in fields:
+                value = row[field_name]
+                if value is None:
+                    continue
+                current = self.latest.get(field_name)
+                if current is None or current[0] <= ts:
+                    self.latest[field_name] = (ts, value)
+
+    @property
+    def summary(self) -> dict[str, int]:
+        return {
+            "total_rows": self.total_rows,
+            "valid_rows": self.total_rows - self.invalid_rows - self.skipped_rows,
+            "invalid_rows": self.invalid_rows,
+            "skipped_rows": self.skipped_rows,
+        }
+
+
+async def copy_rows(
+    conn: AsyncConnection,
+    table_name: str,
+    columns: list[str],
+    column_types: dict[str, str],
+    rows: list[dict[str, Any]],
+) -> None:
+    """Write ``rows`` with COPY inside the transaction of ``conn``."""
+    json_columns = {column for column in columns if column_types.get(column, "").lower() == "jsonb"}
+    records = [
+        tuple(
+            json.dumps(row[column], ensure_ascii=False)
+            if column in json_columns and row[column] is not None
+            else row[column]
+            for column in columns
+        )
+        for row in rows
+    ]
+    # The asyncpg adapter opens its transaction lazily on the first statement; make sure
+    # it is open before COPY goes to the driver directly.
+    await conn.execute(text("SELECT 1"))
+    raw = await conn.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(table_name, records=records, columns=columns)
+
+
+def chunk_validator(
+    datetime_column: str,
+    field_mapping: dict[str, str],
+    column_types: dict[str, str],
+    float_precision: int,
+    executor: Executor | None = None,
+) -> ChunkValidator:
+    """Validate chunks in ``executor``: a process pool for big files, else the default threads."""
+    call = partial(
+        validate_import_chunk,
+        datetime_column=datetime_column,
+        field_mapping=field_mapping,
+        column_types=column_types,
+        float_precision=float_precision,
+    )
+
+    def validate(records: CsvRecords) -> Awaitable[ImportChunk]:
+        return asyncio.get_running_loop().run_in_executor(executor, call, records)
+
+    return validate
+
+
+async def copy_csv_stream(
+    conn: AsyncConnection,
+    stream: CsvStream,
+    table_name: str,
+    field_mapping: dict[str, str],
+    column_types: dict[str, str],
+    validate: ChunkValidator,
+    result: ImportResult,
+    chunk_rows: int,
+    in_flight: int = 1,
+    staging_table: str | None = None,
+) -> None:
+    """Validate ``stream`` chunk by chunk and COPY the rows inside ``conn``'s transaction.
+
+    Up to ``in_flight`` chunks are validated concurrently while earlier ones are written;
+    ``result`` is updated as chunks complete so it can be read for progress. After the
+    first invalid row nothing more is written and the rest is only validated to report
+    errors; the caller is expected to roll back in that case.
+
+    With ``staging_table`` rows are copied there instead and no sketches are built;
+    :func:`merge_staged_rows` then moves them into ``table_name``.
+    """
+    fields = list(field_mapping)
+    columns = ["ts", *fields]
+    sketches = SketchBuffer()
+    pending: deque[Awaitable[ImportChunk]] = deque()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < max(in_flight, 1):
+                records = await run_in_thread(stream.read_chunk, chunk_rows)
+                if not records:
+                    exhausted = True
+                    break
+                pending.append(asyncio.ensure_future(validate(records)))
+            if not pending:
+                break
+            chunk = await pending.popleft()
+            result.bytes_read = stream.bytes_read
+            result.total_rows += chunk.total_rows
+            result.skipped_rows += chunk.skipped_rows
+            result.invalid_rows += chunk.invalid_rows
+            room = MAX_REPORTED_ERRORS - len(result.errors)
+            if room > 0:
+                result.errors.extend(chunk.errors[:room])
+            if result.invalid_rows or not chunk.rows:
+                continue
+            await copy_rows(conn, staging_table or table_name, columns, column_types, chunk.rows)
+            if staging_table is None:
+                for row in chunk.rows:
+                    sketches.add_values(table_name, row["ts"], {name: row[name] for name in fields})
+                if len(sketches) >= SKETCH_BUFFER_BUCKETS:
+                    await sketches.write(conn)
+            result.add_rows(chunk.rows, fields)
+        if not result.invalid_rows:
+            await sketches.write(conn)
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def create_staging_table(conn: AsyncConnection, table_name: str, columns: list[str]) -> str:
+    """Temporary table shaped like ``columns`` of ``table_name``, dropped on commit."""
+    staging = f"import_stage_{table_name}"[:63]
+    select_cols = ", ".join(quote_ident(column) for column in columns)
+    await conn.execute(
+        text(
+            f"CREATE TEMP TABLE {quote_ident(staging)} ON COMMIT DROP AS "
+            f"SELECT {select_cols} FROM {quote_ident(table_name)} WITH NO DATA"
+        )
+    )
+    await conn.execute(text(f"ALTER TABLE {quote_ident(staging)} ADD COLUMN {_STAGE_SEQ} bigserial"))
+    return staging
+
+
+async def merge_staged_rows(
+    conn: AsyncConnection,
+    staging: str,
+    table_name: str,
+    fields: list[str],
+    conflict: str,
+) -> tuple[int, int]:
+    """Merge staged rows into ``table_name`` in one statement; returns (inserted, updated).
+
+    The last row per ``ts`` in the file wins. ``skip`` leaves rows already stored at that
+    ``ts`` alone, ``overwrite`` updates them; blank cells never overwrite stored values.
+    """
+    assert conflict in ("skip", "overwrite")
+    target = quote_ident(table_name)
+    source = quote_ident(staging)
+    columns = ["ts", *fields]
+    column_list = ", ".join(quote_ident(column) for column in columns)
+    # Temporary tables are never auto-analyzed; the join below needs row estimates.
+    await conn.execute(text(f"ANALYZE {source}"))
+    actions = []
+    if conflict == "overwrite":
+        assignments = ", ".join(
+            f"{quote_ident(name)} = COALESCE(s.{quote_ident(name)}, t.{quote_ident(name)})"
+            for name in fields
+        )
+        actions.append(f"WHEN MATCHED THEN UPDATE SET {assignments}")
+    source_values = ", ".join(f"s.{quote_ident(column)}" for column in columns)
+    actions.append(f"WHEN NOT MATCHED THEN INSERT ({column_list}) VALUES ({source_values})")
+    sql = f"""
+        WITH merged AS (
+            MERGE INTO {target} AS t
+            USING (
+                SELECT DISTINCT ON (ts) {column_list}
+                FROM {source}
+                ORDER BY ts, {_STAGE_SEQ} DESC
+            ) AS s
+            ON t.ts = s.ts
+            {' '.join(actions)}
+            RETURNING merge_action() AS action
+        )
+        SELECT action, count(*) AS rows FROM merged GROUP BY action
+    """
+    counts = dict((await conn.execute(text(sql))).all())
+    return counts.get("INSERT", 0), counts.get("UPDATE", 0)
@@ -0,0 +1,97 @@
+import ast
+import re
+from typing import Callable
+
+import numpy as np
+
+_field_token_re = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+# Operators mirror the JS expression grammar used by formula charts. `%` follows the
+# JS remainder semantics (sign of the dividend), which is np.fmod rather than np.mod.
+_BINARY_OPS: dict[type[ast.operator], Callable[[np.ndarray, np.ndarray], np.ndarray]] = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Mod: np.fmod,
+    ast.Pow: np.power,
+}
+_UNARY_OPS: dict[type[ast.unaryop], Callable[[np.ndarray], np.ndarray]] = {
+    ast.UAdd: np.positive,
+    ast.USub: np.negative,
+}
+
+
+class FormulaError(ValueError):
+    pass
+
+
+def _check_node(node: ast.AST, fields: set[str]) -> None:
+    if isinstance(node, ast.Expression):
+        _check_node(node.body, fields)
+    elif isinstance(node, ast.BinOp):
+        if type(node.op) not in _BINARY_OPS:
+            raise FormulaError("Unsupported operator in formula")
+        _check_node(node.left, fields)
+        _check_node(node.right, fields)
+    elif isinstance(node, ast.UnaryOp):
+        if type(node.op) not in _UNARY_OPS:
+            raise FormulaError("Unsupported operator in formula")
+        _check_node(node.operand, fields)
+    elif isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise FormulaError("Only numeric constants are allowed in formula")
+    elif isinstance(node, ast.Name):
+        if node.id not in fields:
+            raise FormulaError(f"Unknown field in formula: {node.id}")
+    else:
+        raise FormulaError("Unsupported expression in formula")
+
+
+def parse_formula(formula: str, fields: list[str]) -> ast.Expression:
+    """Parse a chart formula into a validated AST.
+
+    Only numbers, field names, parentheses and arithmetic operators are accepted.
+    """
+    for token in _field_token_re.findall(formula):
+        if token not in fields:
+            raise FormulaError(f"Unknown field in formula: {token}")
+    try:
+        tree = ast.parse(formula.strip(), mode="eval")
+    except SyntaxError as exc:
+        raise FormulaError("Invalid formula") from exc
+    _check_node(tree, set(fields))
+    return tree
+
+
+def _evaluate(node: ast.AST, columns: dict[str, np.ndarray]) -> np.ndarray:
+    if isinstance(node, ast.Expression):
+        return _evaluate(node.body, columns)
+    if isinstance(node, ast.BinOp):
+        op = _BINARY_OPS[type(node.op)]
+        return op(_evaluate(node.left, columns), _evaluate(node.right, columns))
+    if isinstance(node, ast.UnaryOp):
+        return _UNARY_OPS[type(node.op)](_evaluate(node.operand, columns))
+    if isinstance(node, ast.Constant):
+        return np.float64(node.value)
+    if isinstance(node, ast.Name):
+        return columns[node.id]
+    raise FormulaError("Unsupported expression in formula")
+
+
+def evaluate_formula(tree: ast.Expression, columns: dict[str, np.ndarray], size: int) -> np.ndarray:
+    """Evaluate a parsed formula over columnar float64 arrays of equal length."""
+    with np.errstate(all="ignore"):
+        result = _evaluate(tree, columns)
+    return np.broadcast_to(np.asarray(result, dtype=np.float64), (size,))
+
+
+def to_float_array(values: list) -> np.ndarray:
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+
+def downsample_indices(size: int, max_points: int) -> np.ndarray:
+    """Evenly spaced indices that keep the first and last point."""
+    if size <= max_points:
+        return np.arange(size)
+    return np.unique(np.linspace(0, size - 1, num=max_points).round().astype(np.int64))
@@ -0,0 +1,431 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import secrets
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, BinaryIO, Callable
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from mqttap.services.csv_import import CsvRecords, CsvStream, ImportResult, run_in_thread
+
+logger = logging.getLogger(__name__)
+
+# Records kept from the upload so previews never re-read the file.
+PREVIEW_SAMPLE_ROWS = 1000
+# Longest wait between two sweeps for expired jobs.
+EXPIRY_CHECK_SECONDS = 60.0
+# How often the worker running an import saves its progress and checks whether another
+# worker asked to cancel it.
+PROGRESS_SECONDS = 1.0
+# A running job whose progress has not been saved for this long lost its worker.
+STALE_SECONDS = 60.0
+# How long a cancel waits for a job running in another worker to stop.
+CANCEL_WAIT_SECONDS = 5.0
+# ImportResult counters saved as a job's progress.
+PROGRESS_FIELDS = (
+    "total_rows",
+    "imported_rows",
+    "inserted_rows",
+    "updated_rows",
+    "invalid_rows",
+    "skipped_rows",
+    "errors",
+    "bytes_read",
+)
+JOB_COLUMNS = """
+    id, user_id, topic, path, size, delimiter, headers, sample_complete, status,
+    progress, error, created_at, started_at, finished_at, updated_at
+"""
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _decode(value: Any) -> Any:
+    return json.loads(value) if isinstance(value, str) else value
+
+
+@dataclass
+class ImportJob:
+    id: str
+    user_id: int
+    topic: str
+    path: str
+    size: int
+    delimiter: str
+    headers: list[str]
+    sample_complete: bool
+    sample: CsvRecords = field(default_factory=list)
+    status: str = "uploaded"
+    created_at: datetime = field(default_factory=_now)
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    result: ImportResult = field(default_factory=ImportResult)
+    error: Any = None
+    task: asyncio.Task | None = None
+
+    @classmethod
+    def from_row(cls, row: Any) -> "ImportJob":
+        result = ImportResult()
+        for name, value in (_decode(row.progress) or {}).items():
+            if name in PROGRESS_FIELDS:
+                setattr(result, name, value)
+        job = cls(
+            id=row.id,
+            user_id=row.user_id,
+            topic=row.topic,
+            path=row.path,
+            size=row.size,
+            delimiter=row.delimiter,
+            headers=_decode(row.headers),
+            sample_complete=row.sample_complete,
+            status=row.status,
+            created_at=row.created_at,
+            started_at=row.started_at,
+            finished_at=row.finished_at,
+            result=result,
+            error=_decode(row.error),
+        )
+        if job.status == "running" and row.updated_at < _now() - timedelta(seconds=STALE_SECONDS):
+            job.status = "failed"
+            job.error = "Import worker stopped"
+        return job
+
+    def describe(self) -> dict[str, Any]:
+        result = self.result
+        elapsed = None
+        rows_per_second = None
+        if self.started_at is not None:
+            elapsed = ((self.finished_at or _now()) - self.started_at).total_seconds()
+            if elapsed > 0:
+                rows_per_second = result.total_rows / elapsed
+        return {
+            "id": self.id,
+            "topic": self.topic,
+            "status": self.status,
+            "delimiter": self.delimiter,
+            "headers": self.headers,
+            "size": self.size,
+            "bytes_read": result.bytes_read,
+            "progress": min(result.bytes_read / self.size, 1.0) if self.size else None,
+            "processed_rows": result.total_rows,
+            "imported_rows": result.imported_rows,
+            "inserted_rows": result.inserted_rows,
+            "updated_rows": result.updated_rows,
+            "invalid_rows": result.invalid_rows,
+            "skipped_rows": result.skipped_rows,
+            "errors": result.errors,
+            "rows_per_second": rows_per_second,
+            "elapsed_seconds": elapsed,
+            "error": self.error,
+        }
+
+
+class ImportJobs:
+    """CSV import jobs: upload once, preview, commit in the background.
+
+    Jobs are kept in the ``import_jobs`` table, so any API worker can report, preview,
+    commit or cancel them; uploads go to ``directory``, which the workers of a host
+    share. The worker running an import saves its progress every ``PROGRESS_SECONDS``
+    and stops it when a cancel was requested through another worker.
+
+    Uploaded files are kept until their job ends or, if it is never committed, until
+    ``ttl_seconds`` pass. Finished jobs stay visible for the same time. An import does
+    not survive a restart of its worker and is then reported as failed.
+    """
+
+    def __init__(self, engine: AsyncEngine, directory: str, ttl_seconds: float, workers: int) -> None:
+        self.engine = engine
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.workers = max(workers, 1)
+        self._running: dict[str, ImportJob] = {}
+        self._executor: ProcessPoolExecutor | None = None
+        self._sweeper: asyncio.Task | None = None
+
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # The API process runs threads (the MQTT consumer), so do not fork it.
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def create(self, user_id: int, topic: str, upload: BinaryIO, delimiter: str | None) -> ImportJob:
+        self._schedule_expiry()
+        os.makedirs(self.directory, exist_ok=True)
+        job_id = secrets.token_hex(16)
+        path = os.path.join(self.directory, f"{job_id}.csv")
+        try:
+            size = await run_in_thread(_save_upload, upload, path)
+            stream = await run_in_thread(CsvStream.open, path, delimiter)
+            try:
+                sample = await run_in_thread(stream.read_chunk, PREVIEW_SAMPLE_ROWS)
+                complete = not await run_in_thread(stream.read_chunk, 1)
+            finally:
+                stream.close()
+            job = ImportJob(
+                id=job_id,
+                user_id=user_id,
+                topic=topic,
+                path=path,
+                size=size,
+                delimiter=stream.delimiter,
+                headers=stream.headers,
+                sample=sample,
+                sample_complete=complete,
+            )
+            async with self.engine.begin() as conn:
+                await conn.execute(
+                    text(
+                        """
+                        INSERT INTO import_jobs (
+                            id, user_id, topic, path, size, delimiter, headers, sample,
+                            sample_complete, status, created_at, updated_at
+                        )
+                        VALUES (
+                            :id, :user_id, :topic, :path, :size, :delimiter,
+                            CAST(:headers AS JSONB), CAST(:sample AS JSONB),
+                            :sample_complete, :status, :created_at, :created_at
+                        )
+                        """
+                    ),
+                    {
+                        "id": job.id,
+                        "user_id": job.user_id,
+                        "topic": job.topic,
+                        "path": job.path,
+                        "size": job.size,
+                        "delimiter": job.delimiter,
+                        "headers": json.dumps(job.headers, ensure_ascii=False),
+                        "sample": json.dumps(job.sample, ensure_ascii=False),
+                        "sample_complete": job.sample_complete,
+                        "status": job.status,
+                        "created_at": job.created_at,
+                    },
+                )
+        except BaseException:
+            _remove(path)
+            raise
+        return job
+
+    async def get(self, job_id: str, user_id: int, with_sample: bool = False) -> ImportJob:
+        self._schedule_expiry()
+        job = self._running.get(job_id)
+        if job is not None and job.user_id == user_id and not with_sample:
+            return job
+        columns = f"{JOB_COLUMNS}, sample" if with_sample else JOB_COLUMNS
+        async with self.engine.connect() as conn:
+            row = (
+                await conn.execute(
+                    text(f"SELECT {columns} FROM import_jobs WHERE id = :id AND user_id = :user_id"),
+                    {"id": job_id, "user_id": user_id},
+                )
+            ).one_or_none()
+        if row is None or self._expired(row.status, row.finished_at or row.created_at):
+            raise HTTPException(status_code=404, detail="Unknown import job")
+        job = ImportJob.from_row(row)
+        if with_sample:
+            job.sample = [(number, record) for number, record in _decode(row.sample)]
+        return job
+
+    def _expired(self, status: str, since: datetime) -> bool:
+        return status != "running" and since < _now() - timedelta(seconds=self.ttl_seconds)
+
+    async def start(self, job: ImportJob, run: Callable[[ImportJob], Awaitable[None]]) -> None:
+        started_at = _now()
+        async with self.engine.begin() as conn:
+            claimed = await conn.execute(
+                text(
+                    """
+                    UPDATE import_jobs
+                    SET status = 'running', started_at = :now, updated_at = :now
+                    WHERE id = :id AND status = 'uploaded'
+                    """
+                ),
+                {"id": job.id, "now": started_at},
+            )
+        if not claimed.rowcount:
+            # Committed or cancelled through another worker in the meantime.
+            current = await self.get(job.id, job.user_id)
+            raise HTTPException(status_code=409, detail=f"Import job is {current.status}")
+        job.status = "running"
+        job.started_at = started_at
+        self._running[job.id] = job
+        job.task = asyncio.create_task(self._run(job, run))
+
+    async def _run(self, job: ImportJob, run: Callable[[ImportJob], Awaitable[None]]) -> None:
+        work = asyncio.ensure_future(run(job))
+        try:
+            try:
+                while not work.done():
+                    await asyncio.wait([work], timeout=PROGRESS_SECONDS)
+                    if not work.done() and await self._checkpoint(job):
+                        logger.info("Import job %s cancelled through another worker", job.id)
+                        work.cancel()
+            except asyncio.CancelledError:
+                work.cancel()
+                await asyncio.wait([work])
+                raise
+            await work
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+        except HTTPException as exc:
+            job.status = "failed"
+            job.error = exc.detail
+        except Exception as exc:
+            logger.exception("Import job %s failed", job.id)
+            job.status = "failed"
+            job.error = str(exc)
+        finally:
+            job.finished_at = _now()
+            _remove(job.path)
+            await self._checkpoint(job)
+            self._running.pop(job.id, None)
+
+    async def _checkpoint(self, job: ImportJob) -> bool:
+        """Save the state of a job running here; returns whether a cancel was requested."""
+        progress = {name: getattr(job.result, name) for name in PROGRESS_FIELDS}
+        try:
+            async with self.engine.begin() as conn:
+                requested = (
+                    await conn.execute(
+                        text(
+                            """
+                            UPDATE import_jobs
+                            SET status = :status, progress = CAST(:progress AS JSONB),
+                                error = CAST(:error AS JSONB), finished_at = :finished_at,
+                                updated_at = :now
+                            WHERE id = :id
+                            RETURNING cancel_requested
+                            """
+                        ),
+                        {
+                            "id": job.id,
+                            "status": job.status,
+                            "progress": json.dumps(progress, ensure_ascii=False, default=str),
+                            "error": json.dumps(job.error, ensure_ascii=False, default=str),
+                            "finished_at": job.finished_at,
+                            "now": _now(),
+                        },
+                    )
+                ).scalar_one_or_none()
+        except Exception as exc:
+            logger.warning("Could not save the state of import job %s: %s", job.id, exc)
+            return False
+        return bool(requested)
+
+    async def cancel(self, job: ImportJob) -> ImportJob:
+        local = self._running.get(job.id)
+        if local is not None and local.task is not None:
+            local.task.cancel()
+            await asyncio.wait([local.task])
+            return local
+        now = _now()
+        async with self.engine.begin() as conn:
+            cancelled = await conn.execute(
+                text(
+                    """
+                    UPDATE import_jobs
+                    SET status = 'cancelled', finished_at = :now, updated_at = :now
+                    WHERE id = :id AND status = 'uploaded'
+                    """
+                ),
+                {"id": job.id, "now": now},
+            )
+            if not cancelled.rowcount:
+                await conn.execute(
+                    text("UPDATE import_jobs SET cancel_requested = true WHERE id = :id AND status = 'running'"),
+                    {"id": job.id},
+                )
+        if cancelled.rowcount:
+            _remove(job.path)
+        # A job running in another worker stops at its next progress save.
+        deadline = time.monotonic() + CANCEL_WAIT_SECONDS
+        current = await self.get(job.id, job.user_id)
+        while current.status == "running" and time.monotonic() < deadline:
+            await asyncio.sleep(PROGRESS_SECONDS / 2)
+            current = await self.get(job.id, job.user_id)
+        return current
+
+    async def expire(self) -> None:
+        now = _now()
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                text(
+                    """
+                    UPDATE import_jobs
+                    SET status = 'failed', error = CAST(:error AS JSONB), finished_at = :now
+                    WHERE status = 'running' AND updated_at < :stale
+                    """
+                ),
+                {
+                    "error": json.dumps("Import worker stopped"),
+                    "now": now,
+                    "stale": now - timedelta(seconds=STALE_SECONDS),
+                },
+            )
+            paths = (
+                await conn.execute(
+                    text(
+                        """
+                        DELETE FROM import_jobs
+                        WHERE status <> 'running'
+                          AND COALESCE(finished_at, created_at) < :cutoff
+                        RETURNING path
+                        """
+                    ),
+                    {"cutoff": now - timedelta(seconds=self.ttl_seconds)},
+                )
+            ).scalars().all()
+        for path in paths:
+            _remove(path)
+
+    def _schedule_expiry(self) -> None:
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._expire_periodically())
+
+    async def _expire_periodically(self) -> None:
+        # Uploads that are never committed are removed even if no request comes by.
+        while True:
+            try:
+                await self.expire()
+            except Exception as exc:
+                logger.warning("Could not expire import jobs: %s", exc)
+            await asyncio.sleep(min(self.ttl_seconds, EXPIRY_CHECK_SECONDS))
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        # Imports running here are rolled back; uploads stay for the other workers.
+        for job in list(self._running.values()):
+            await self.cancel(job)
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+def _save_upload(upload: BinaryIO, path: str) -> int:
+    with open(path, "wb") as target:
+        shutil.copyfileobj(upload, target, 1024 * 1024)
+        return target.tell()
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,187 @@
+import asyncio
+import itertools
+import logging
+import logging.config
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.connection import Connection
+from typing import Any
+
+from mqttap.config import settings
+from mqttap.db.core import maintenance_engine
+from mqttap.logging_config import get_logging_config
+from mqttap.services.latest import latest_values
+from mqttap.services.metrics import metrics
+from mqttap.services.mqtt import MqttConsumer, new_event_loop
+from mqttap.services.topic_stats import topic_stats
+
+logger = logging.getLogger(__name__)
+
+STATUS_INTERVAL_SECONDS = 2.0
+REPLY_TIMEOUT_SECONDS = 5.0
+RESTART_DELAYS = (1.0, 2.0, 5.0, 10.0, 30.0)
+
+
+class IngestProcess:
+    """The MQTT consumer in a child process, supervised by the API process.
+
+    The child runs :class:`MqttConsumer` on its own (uv)loop, so ingest does not share
+    the GIL with request handling. The parent polls it over a pipe for status and
+    metrics, restarts it with a backoff when it exits, and stops it with a handshake:
+    ``stop`` is answered once the consumer has drained its queue and flushed its buffers.
+    """
+
+    def __init__(self) -> None:
+        self._context = multiprocessing.get_context("spawn")
+        self._process: multiprocessing.process.BaseProcess | None = None
+        self._conn: Connection | None = None
+        self._lock = asyncio.Lock()
+        self._sequence = itertools.count(1)
+        self._supervisor: asyncio.Task | None = None
+        self._status: dict[str, Any] = {}
+        self._restarts = 0
+
+    async def start(self) -> None:
+        if self._supervisor is not None:
+            return
+        self._spawn()
+        self._supervisor = asyncio.create_task(self._supervise())
+
+    def _spawn(self) -> None:
+        parent, child = self._context.Pipe()
+        process = self._context.Process(target=_child_main, args=(child,), name="mqttap-ingest", daemon=True)
+        process.start()
+        child.close()
+        self._process, self._conn, self._status = process, parent, {}
+        logger.info("Started ingest process %s", process.pid)
+
+    def status(self) -> dict[str, Any]:
+        alive = bool(self._process and self._process.is_alive())
+        return {
+            "running": alive and self._status.get("running", True),
+            "connected": alive and self._status.get("connected", False),
+            "loop": self._status.get("loop"),
+            "pid": self._process.pid if self._process else None,
+            "restarts": self._restarts,
+        }
+
+    def metrics_snapshot(self) -> dict[str, Any] | None:
+        """Metrics of the child as of its last status reply."""
+        return self._status.get("metrics")
+
+    async def _request(self, command: str, timeout: float = REPLY_TIMEOUT_SECONDS) -> Any:
+        async with self._lock:
+            conn = self._conn
+            assert conn is not None
+            sequence = next(self._sequence)
+            conn.send((sequence, command))
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not await asyncio.to_thread(conn.poll, remaining):
+                    raise TimeoutError(f"Ingest process did not answer {command!r}")
+                # Replies to requests that already timed out are dropped here.
+                reply_sequence, payload = conn.recv()
+                if reply_sequence == sequence:
+                    return payload
+
+    async def _supervise(self) -> None:
+        failures = 0
+        while True:
+            await asyncio.sleep(STATUS_INTERVAL_SECONDS)
+            assert self._process is not None
+            if self._process.is_alive():
+                try:
+                    self._status = await self._request("status")
+                    failures = 0
+                except (TimeoutError, EOFError, OSError) as exc:
+                    logger.warning("Ingest process status unavailable: %s", exc)
+                continue
+            delay = RESTART_DELAYS[min(failures, len(RESTART_DELAYS) - 1)]
+            logger.error(
+                "Ingest process %s exited with code %s; restarting in %.0f s",
+                self._process.pid,
+                self._process.exitcode,
+                delay,
+            )
+            metrics.increment("ingest_process_restarts")
+            await asyncio.sleep(delay)
+            failures += 1
+            self._restarts += 1
+            self._spawn()
+
+    async def stop(self) -> None:
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            await asyncio.gather(self._supervisor, return_exceptions=True)
+            self._supervisor = None
+        process = self._process
+        if process is None:
+            return
+        if process.is_alive():
+            try:
+                timeout = settings.ingest_drain_seconds + REPLY_TIMEOUT_SECONDS
+                self._status = await self._request("stop", timeout)
+                logger.info("Ingest process %s stopped, drain: %s", process.pid, self._status.get("last_drain"))
+            except (TimeoutError, EOFError, OSError) as exc:
+                logger.warning("Ingest process did not stop cleanly: %s", exc)
+        await asyncio.to_thread(process.join, REPLY_TIMEOUT_SECONDS)
+        if process.is_alive():
+            logger.warning("Terminating ingest process %s", process.pid)
+            process.terminate()
+            await asyncio.to_thread(process.join, REPLY_TIMEOUT_SECONDS)
+            if process.is_alive():
+                process.kill()
+        if self._conn is not None:
+            self._conn.close()
+        self._process = self._conn = None
+
+
+def _child_main(conn: Connection) -> None:
+    # Ctrl+C reaches the whole process group; the parent decides when ingest stops.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.config.dictConfig(get_logging_config())
+    with asyncio.Runner(loop_factory=new_event_loop) as runner:
+        runner.run(_child(conn))
+
+
+def _receive(conn: Connection, timeout: float) -> tuple[int, str] | None:
+    try:
+        if not conn.poll(timeout):
+            return None
+        return conn.recv()
+    except (EOFError, OSError):
+        # The parent is gone: stop as if asked to.
+        return (0, "stop")
+
+
+async def _child(conn: Connection) -> None:
+    await latest_values.load(maintenance_engine)
+    await topic_stats.load(maintenance_engine)
+    await maintenance_engine.dispose()
+    consumer = MqttConsumer()
+    serving = asyncio.create_task(consumer.serve())
+
+    def status() -> dict[str, Any]:
+        return {**consumer.status(), "pid": os.getpid(), "metrics": metrics.snapshot()}
+
+    sequence = 0
+    try:
+        while not serving.done():
+            message = await asyncio.to_thread(_receive, conn, 0.5)
+            if message is None:
+                continue
+            sequence, command = message
+            if command == "stop":
+                break
+            if command == "status":
+                conn.send((sequence, status()))
+    finally:
+        await consumer.stop()
+        await asyncio.gather(serving, return_exceptions=True)
+        try:
+            conn.send((sequence, status()))
+        except OSError:
+            pass
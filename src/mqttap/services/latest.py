@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+LatestSample = tuple[datetime, Any]
+
+
+class LatestValues:
+    """Most recent sample per (table, field), kept in memory and persisted to ``topic_latest``.
+
+    Updated from the ingest thread and read by API handlers, so access is guarded by a
+    lock. Older samples (e.g. from a CSV backfill) never replace newer ones. When ingest
+    runs in another process, ``reload_seconds`` makes :meth:`refresh` re-read the table.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._values: dict[str, dict[str, LatestSample]] = {}
+        self._dirty: set[tuple[str, str]] = set()
+        self.reload_seconds: float | None = None
+        self._loaded_at: float | None = None
+
+    def update(self, table_name: str, ts: datetime, values: dict[str, Any]) -> None:
+        with self._lock:
+            fields = self._values.setdefault(table_name, {})
+            for field, value in values.items():
+                current = fields.get(field)
+                if current is not None and current[0] > ts:
+                    continue
+                fields[field] = (ts, value)
+                self._dirty.add((table_name, field))
+
+    def get(self, table_name: str) -> dict[str, LatestSample]:
+        with self._lock:
+            return dict(self._values.get(table_name, {}))
+
+    def _merge_loaded(self, table_name: str, field: str, ts: datetime, value: Any) -> None:
+        fields = self._values.setdefault(table_name, {})
+        current = fields.get(field)
+        if current is None or current[0] < ts:
+            fields[field] = (ts, value)
+
+    async def load(self, engine: AsyncEngine) -> int:
+        sql = text("SELECT table_name, field, ts, value FROM topic_latest")
+        async with engine.begin() as conn:
+            rows = (await conn.execute(sql)).mappings().all()
+        with self._lock:
+            for row in rows:
+                value = row["value"]
+                if isinstance(value, str):
+                    value = json.loads(value)
+                self._merge_loaded(row["table_name"], row["field"], row["ts"], value)
+        return len(rows)
+
+    async def refresh(self, engine: AsyncEngine) -> None:
+        if self.reload_seconds is None:
+            return
+        now = time.monotonic()
+        if self._loaded_at is not None and now - self._loaded_at < self.reload_seconds:
+            return
+        self._loaded_at = now
+        await self.load(engine)
+
+    async def flush(self, engine: AsyncEngine) -> int:
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            pending = [
+                {
+                    "table_name": table_name,
+                    "field": field,
+                    "ts": self._values[table_name][field][0],
+                    "value": json.dumps(self._values[table_name][field][1], ensure_ascii=False, default=str),
+                }
+                for table_name, field in sorted(dirty)
+            ]
+        if not pending:
+            return 0
+        sql = text(
+            """
+            INSERT INTO topic_latest (table_name, field, ts, value, updated_at)
+            VALUES (:table_name, :field, :ts, :value, now())
+            ON CONFLICT (table_name, field) DO UPDATE
+            SET ts = EXCLUDED.ts, value = EXCLUDED.value, updated_at = now()
+            WHERE topic_latest.ts <= EXCLUDED.ts
+            """
+        )
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(sql, pending)
+        except Exception:
+            with self._lock:
+                self._dirty |= dirty
+            raise
+        return len(pending)
+
+
+latest_values = LatestValues()
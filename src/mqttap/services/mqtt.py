@@ -1,15 +1,53 @@
 import asyncio
+import functools
 import sys
 import threading
+import time
+from datetime import datetime, timezone
+from typing import Any
 
-from aiomqtt import Client, MqttError
+from aiomqtt import Client, MqttError, ProtocolVersion
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 
 import logging
 
 from mqttap.config import settings
 from mqttap.db.core import create_engine_from_settings
-from mqttap.services.settings import load_settings
-from mqttap.services.storage import store_message
+from mqttap.services.latest import latest_values
+from mqttap.services.metrics import metrics
+from mqttap.services.settings import load_settings, settings_version
+from mqttap.services.sketches import SketchBuffer
+from mqttap.services.spool import IngestMessage, MessageSpool
+from mqttap.services.storage import store_messages
+from mqttap.services.topic_stats import topic_stats
+
+logger = logging.getLogger(__name__)
+
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """Event loop for the ingest loop: uvloop where it is installed, selector on Windows."""
+    if sys.platform == "win32":
+        return asyncio.SelectorEventLoop()
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+    return uvloop.new_event_loop()
+
+
+class _IncomingQueue(asyncio.Queue):
+    """aiomqtt's queue of received messages; counts those it discards when full."""
+
+    def put_nowait(self, item: Any) -> None:
+        try:
+            super().put_nowait(item)
+        except asyncio.QueueFull:
+            metrics.increment("mqtt_discarded_messages")
+            raise
+
 
 class MqttConsumer:
     def __init__(self) -> None:
@@ -19,6 +57,23 @@ class MqttConsumer:
         self._loop: asyncio.AbstractEventLoop | None = None
         self._thread: threading.Thread | None = None
         self._engine = None
+        self._maintenance_engine = None
+        self._sketches = SketchBuffer()
+        self._queue: asyncio.Queue[IngestMessage] | None = None
+        self._writing: list[IngestMessage] = []
+        self._written = 0
+        self._catching_up = False
+        self._catch_up_started = 0.0
+        self._catch_up_written = 0
+        self._drain_started: float | None = None
+        self._drain_pending = 0
+        self._drain_written = 0
+        # Filters subscribed on the broker; a persistent session keeps them across reconnects.
+        self._subscribed: list[str] = []
+        self._spool = MessageSpool(settings.ingest_spool_path)
+        # Replayed messages neither written nor spooled again yet.
+        self._replay_left = 0
+        self.last_drain: dict[str, Any] | None = None
 
     async def start(self) -> None:
         if self._thread and self._thread.is_alive():
@@ -26,71 +81,391 @@ class MqttConsumer:
         self._thread = threading.Thread(target=self._thread_main, daemon=True)
         self._thread.start()
 
+    def status(self) -> dict[str, Any]:
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "connected": self._client is not None,
+            "loop": type(self._loop).__module__ if self._loop else None,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "catching_up": self._catching_up,
+            "last_drain": self.last_drain,
+        }
+
     async def stop(self) -> None:
         if self._loop and self._stop_event:
             asyncio.run_coroutine_threadsafe(self._set_stop(), self._loop)
         if self._thread:
-            self._thread.join(timeout=5)
+            await asyncio.to_thread(self._thread.join, settings.ingest_drain_seconds + 5)
 
     async def _set_stop(self) -> None:
         if self._stop_event:
             self._stop_event.set()
 
     def _thread_main(self) -> None:
-        if sys.platform == "win32":
-            loop = asyncio.SelectorEventLoop()
-        else:
-            loop = asyncio.new_event_loop()
+        loop = new_event_loop()
         asyncio.set_event_loop(loop)
-        self._loop = loop
-        self._stop_event = asyncio.Event()
-        self._task = loop.create_task(self._run())
         try:
-            self._engine = create_engine_from_settings()
-            loop.run_until_complete(self._task)
+            loop.run_until_complete(self.serve())
         finally:
-            if self._engine:
-                loop.run_until_complete(self._engine.dispose())
             loop.stop()
             loop.close()
 
+    async def serve(self) -> None:
+        """Consume on the running event loop until :meth:`stop`."""
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._queue = asyncio.Queue(maxsize=settings.ingest_queue_size)
+        # Buffer flushes get their own pool so they never hold up message writes.
+        self._engine = create_engine_from_settings("ingest")
+        self._maintenance_engine = create_engine_from_settings("maintenance")
+        self._task = asyncio.current_task()
+        try:
+            await self._run()
+        finally:
+            for engine in (self._engine, self._maintenance_engine):
+                await engine.dispose()
+
+    async def _flush_buffers(self) -> None:
+        try:
+            await self._sketches.flush(self._maintenance_engine)
+        except Exception:
+            logger.exception("Failed to flush quantile sketches")
+        try:
+            await latest_values.flush(self._maintenance_engine)
+        except Exception:
+            logger.exception("Failed to persist latest values")
+        try:
+            await topic_stats.flush(self._maintenance_engine)
+        except Exception:
+            logger.exception("Failed to flush topic statistics")
+
+    async def _flush_loop(self, done: asyncio.Event) -> None:
+        while not done.is_set():
+            try:
+                await asyncio.wait_for(done.wait(), timeout=settings.sketch_flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            await self._flush_buffers()
+
     async def _run(self) -> None:
-        logger = logging.getLogger(__name__)
         assert self._stop_event is not None
+        drained = asyncio.Event()
+        flush_task = asyncio.create_task(self._flush_loop(drained))
+        writer = asyncio.create_task(self._write_loop())
+        try:
+            await self._replay_spool()
+            await self._consume()
+        finally:
+            await self._drain(writer)
+            # The flush loop writes the remaining buffers once the drain is over.
+            drained.set()
+            await flush_task
+
+    async def _replay_spool(self) -> None:
+        assert self._queue is not None and self._stop_event is not None
+        messages = self._spool.take()
+        if not messages:
+            return
+        logger.info("Replaying %s spooled messages from %s", len(messages), self._spool.path)
+        self._replay_left = len(messages)
+        for index, message in enumerate(messages):
+            if self._stop_event.is_set():
+                self._replay_settled(self._spool.append(messages[index:]))
+                return
+            await self._queue.put(message)
+
+    def _replay_settled(self, count: int) -> None:
+        if not count or not self._replay_left:
+            return
+        self._replay_left -= count
+        if not self._replay_left:
+            self._spool.replayed()
+
+    async def _write_loop(self) -> None:
+        assert self._queue is not None
+        while True:
+            batch = [await self._queue.get()]
+            limit = settings.ingest_catchup_batch_size if self._catching_up else settings.ingest_batch_size
+            while len(batch) < limit and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self._writing = batch
+            try:
+                await self._write_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            # Left set when the drain cancels this write, so the batch is not lost.
+            self._writing = []
+            self._written += len(batch)
+            for message in batch:
+                if message.ack is not None:
+                    message.ack()
+            self._replay_settled(sum(1 for message in batch if message.spooled))
+            self._track_catch_up(len(batch))
+
+    async def _write_batch(self, batch: list[IngestMessage]) -> None:
+        delay = 1.0
+        while True:
+            try:
+                runtime = await load_settings(self._engine)
+                precision = int(runtime.get("float_precision", settings.float_precision))
+                await store_messages(self._engine, batch, precision, sketches=self._sketches)
+                return
+            except Exception as exc:
+                if _is_transient(exc):
+                    # Keep the batch (and its acknowledgements) until the database is back;
+                    # the full queue then stops reading from the client (see _create_client).
+                    logger.warning("Database unavailable, retrying %s messages: %s", len(batch), exc)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 30.0)
+                    continue
+                if len(batch) == 1:
+                    logger.exception("Failed to store MQTT message on %s", batch[0].topic)
+                    return
+                break
+        # One bad message fails the whole transaction; write the batch one by one.
+        for message in batch:
+            await self._write_batch([message])
+
+    def _track_catch_up(self, written: int) -> None:
+        assert self._queue is not None
+        if self._catching_up:
+            self._catch_up_written += written
+            if self._queue.empty():
+                self._catching_up = False
+                logger.info(
+                    "Ingest caught up: %s messages in %.1f s",
+                    self._catch_up_written,
+                    time.monotonic() - self._catch_up_started,
+                )
+        elif self._queue.qsize() >= settings.ingest_batch_size:
+            self._catching_up = True
+            self._catch_up_started = time.monotonic()
+            self._catch_up_written = 0
+            logger.info("Ingest catching up on %s queued messages", self._queue.qsize())
+
+    async def _wait_for_queue(self, timeout: float) -> bool:
+        assert self._queue is not None
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def _begin_drain(self) -> float:
+        """Start the drain on first call; returns the time left until its deadline."""
+        assert self._queue is not None
+        if self._drain_started is None:
+            self._drain_started = time.monotonic()
+            self._drain_pending = self._queue.qsize() + len(self._writing)
+            self._drain_written = self._written
+        return max(settings.ingest_drain_seconds - (time.monotonic() - self._drain_started), 0.0)
+
+    async def _drain(self, writer: asyncio.Task) -> None:
+        """Write what is queued within the drain deadline and spool the rest."""
+        assert self._queue is not None
+        remaining = self._begin_drain()
+        if self._queue.qsize() or self._writing:
+            await self._wait_for_queue(remaining)
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        # A write cut off by the deadline may or may not have committed; writing it
+        # again risks a duplicate rather than a loss.
+        left = list(self._writing)
+        while not self._queue.empty():
+            left.append(self._queue.get_nowait())
+        # Unacknowledged messages of a persistent session stay with the broker, which
+        # delivers them again after the restart; spooling them too would store them twice.
+        redelivered = sum(1 for message in left if message.ack is not None)
+        left = [message for message in left if message.ack is None]
+        spilled = 0
+        if left:
+            try:
+                spilled = self._spool.append(left)
+            except OSError:
+                logger.exception("Failed to spool %s messages to %s", len(left), self._spool.path)
+            else:
+                self._replay_settled(sum(1 for message in left if message.spooled))
+        drained = self._written - self._drain_written
+        assert self._drain_started is not None
+        self.last_drain = {
+            "pending": self._drain_pending,
+            "drained": drained,
+            "spilled": spilled,
+            "redelivered": redelivered,
+            "lost": len(left) - spilled,
+            "seconds": time.monotonic() - self._drain_started,
+        }
+        metrics.increment("ingest_drained_messages", drained)
+        metrics.increment("ingest_spilled_messages", spilled)
+        if self._drain_pending:
+            logger.info(
+                "Ingest drain: %s of %s queued messages written, %s spooled to %s, "
+                "%s left to the broker, in %.1f s",
+                drained,
+                self._drain_pending,
+                spilled,
+                self._spool.path,
+                redelivered,
+                self.last_drain["seconds"],
+            )
+
+    def _ack(self, client: Client, mid: int, qos: int) -> None:
+        # Message ids belong to a connection: after a reconnect the broker delivers the
+        # message again, and the id may already stand for another one.
+        if self._client is client:
+            # aiomqtt has no acknowledgement API; paho's client does.
+            client._client.ack(mid, qos)
+
+    async def _receive(self, client: Client, manual_ack: bool) -> None:
+        assert self._queue is not None
+        async for message in client.messages:
+            ack = None
+            if manual_ack and message.qos > 0:
+                ack = functools.partial(self._ack, client, message.mid, message.qos)
+            await self._queue.put(
+                IngestMessage(str(message.topic), message.payload, datetime.now(timezone.utc), ack)
+            )
+
+    async def _serve_connection(
+        self, client: Client, manual_ack: bool, runtime: dict[str, Any], version: Any
+    ) -> None:
+        """Receive until stopped or until the connection settings change."""
+        assert self._stop_event is not None
+        tasks = [
+            asyncio.create_task(self._receive(client, manual_ack)),
+            asyncio.create_task(self._watch_settings(client, runtime, version)),
+            asyncio.create_task(self._stop_event.wait()),
+        ]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    async def _watch_settings(self, client: Client, runtime: dict[str, Any], version: Any) -> None:
+        """Apply topic changes to the live connection; returns when broker settings change."""
+        assert self._engine is not None
+        while True:
+            await asyncio.sleep(settings.mqtt_settings_poll_seconds)
+            try:
+                current = await settings_version(self._engine)
+                if current == version:
+                    continue
+                updated = await load_settings(self._engine)
+            except Exception as exc:
+                logger.warning("Could not check MQTT settings: %s", exc)
+                continue
+            version = current
+            if _connection_settings(updated) != _connection_settings(runtime):
+                logger.info("MQTT connection settings changed, reconnecting")
+                metrics.increment("mqtt_reconnects", reason="settings")
+                return
+            added, removed = await self._apply_topics(client, _topics(updated))
+            if added or removed:
+                logger.info("MQTT subscriptions changed: added %s, removed %s", added, removed)
+                metrics.increment("mqtt_subscription_changes")
+
+    async def _apply_topics(
+        self, client: Client, topics: list[str], connected: bool = False
+    ) -> tuple[list[str], list[str]]:
+        """Subscribe to new filters and drop removed ones; returns (added, removed)."""
+        removed = [topic for topic in self._subscribed if topic not in topics]
+        # A new connection may not have its old session (expired or never created), so
+        # it subscribes to every filter again.
+        added = list(topics) if connected else [topic for topic in topics if topic not in self._subscribed]
+        if removed:
+            await client.unsubscribe(removed)
+        for topic in added:
+            await client.subscribe(topic, qos=1 if settings.mqtt_persistent_session else 0)
+        self._subscribed = list(topics)
+        return added, removed
+
+    def _create_client(self, runtime: dict[str, Any]) -> Client:
+        options: dict[str, Any] = {}
+        # Once the write queue is full, received messages wait in aiomqtt's queue. Bound
+        # it too: QoS 0 messages are not limited by the broker and are dropped past it.
+        incoming = settings.ingest_queue_size
+        if settings.mqtt_persistent_session:
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = settings.mqtt_session_expiry_seconds
+            # Lets the broker send a whole catch-up batch without waiting for acks.
+            properties.ReceiveMaximum = max(1, min(settings.ingest_catchup_batch_size, 65535))
+            options = {"protocol": ProtocolVersion.V5, "clean_start": False, "properties": properties}
+            # Unacknowledged QoS 1 messages never exceed Receive Maximum, so none is dropped.
+            incoming = max(incoming, properties.ReceiveMaximum)
+        client = Client(
+            runtime.get("mqtt_host", settings.mqtt_host),
+            int(runtime.get("mqtt_port", settings.mqtt_port)),
+            identifier=settings.mqtt_client_id,
+            username=runtime.get("mqtt_username", settings.mqtt_username),
+            password=runtime.get("mqtt_password", settings.mqtt_password),
+            queue_type=_IncomingQueue,
+            max_queued_incoming_messages=incoming,
+            **options,
+        )
+        if settings.mqtt_persistent_session:
+            # Set before connecting: a stored session is delivered right after CONNACK.
+            client._client.manual_ack_set(True)
+        return client
+
+    async def _consume(self) -> None:
+        assert self._stop_event is not None and self._queue is not None
+        persistent = settings.mqtt_persistent_session
         while not self._stop_event.is_set():
             try:
+                # Read the version first so a change made meanwhile is seen by the watcher.
+                version = await settings_version(self._engine)
                 runtime = await load_settings(self._engine)
-                topics_raw = runtime.get("mqtt_topics", settings.mqtt_topics)
-                if isinstance(topics_raw, (list, tuple)):
-                    topics = [str(t).strip() for t in topics_raw if str(t).strip()]
-                else:
-                    topics = [t.strip() for t in str(topics_raw).split(",") if t.strip()]
-
-                async with Client(
-                    runtime.get("mqtt_host", settings.mqtt_host),
-                    int(runtime.get("mqtt_port", settings.mqtt_port)),
-                    identifier="mqttap_app",
-                    username=runtime.get("mqtt_username", settings.mqtt_username),
-                    password=runtime.get("mqtt_password", settings.mqtt_password),
-                ) as client:
+
+                async with self._create_client(runtime) as client:
+                    if not persistent:
+                        # A clean session starts without subscriptions.
+                        self._subscribed = []
+                    await self._apply_topics(client, _topics(runtime), connected=True)
                     self._client = client
-                    for topic in topics:
-                        await client.subscribe(topic)
-                    async for message in client.messages:
-                        await self.handle_message(message.topic, message.payload)
+                    try:
+                        await self._serve_connection(client, persistent, runtime, version)
+                        # Drain while connected, so written messages get acknowledged.
+                        if self._stop_event.is_set():
+                            await self._wait_for_queue(self._begin_drain())
+                        elif not await self._wait_for_queue(settings.ingest_drain_seconds):
+                            logger.warning("Reconnecting with %s messages still queued", self._queue.qsize())
+                    finally:
+                        self._client = None
             except MqttError as exc:
                 logger.warning("MQTT connection error: %s", exc)
-                await asyncio.sleep(1)
+                await self._settle_before_reconnect()
             except Exception as exc:
                 logger.exception("MQTT loop error: %s", exc)
-                await asyncio.sleep(1)
+                await self._settle_before_reconnect()
 
-    async def handle_message(self, topic: str, payload: bytes) -> None:
-        if not self._engine:
-            return
-        try:
-            runtime = await load_settings(self._engine)
-            precision = int(runtime.get("float_precision", settings.float_precision))
-            await store_message(self._engine, topic, payload, precision)
-        except Exception:
-            logging.getLogger(__name__).exception("Failed to store MQTT message")
+    async def _settle_before_reconnect(self) -> None:
+        # Let the writer catch up before reconnecting, so a session that redelivers does
+        # not pile the same messages onto a backlog (bounded by the drain deadline).
+        assert self._stop_event is not None and self._queue is not None
+        await asyncio.sleep(1)
+        if not self._stop_event.is_set() and not await self._wait_for_queue(settings.ingest_drain_seconds):
+            logger.warning("Reconnecting with %s messages still queued", self._queue.qsize())
+
+
+def _topics(runtime: dict[str, Any]) -> list[str]:
+    topics_raw = runtime.get("mqtt_topics", settings.mqtt_topics)
+    if isinstance(topics_raw, (list, tuple)):
+        return [str(t).strip() for t in topics_raw if str(t).strip()]
+    return [t.strip() for t in str(topics_raw).split(",") if t.strip()]
+
+
+def _connection_settings(runtime: dict[str, Any]) -> tuple[Any, ...]:
+    return tuple(runtime.get(key) for key in ("mqtt_host", "mqtt_port", "mqtt_username", "mqtt_password"))
+
+
+def _is_transient(exc: Exception) -> bool:
+    """Whether a failed write means the database is unreachable rather than the data bad."""
+    if isinstance(exc, DBAPIError):
+        return exc.connection_invalidated or isinstance(exc, (OperationalError, InterfaceError))
+    return isinstance(exc, (OSError, asyncio.TimeoutError, PoolTimeoutError))
@@ -69,6 +69,13 @@ async def load_settings(engine: AsyncEngine) -> dict[str, Any]:
     return merged
 
 
+async def settings_version(engine: AsyncEngine) -> tuple[Any, ...]:
+    """Changes whenever a setting is added or updated."""
+    sql = text("SELECT max(updated_at), count(*) FROM settings")
+    async with engine.begin() as conn:
+        return tuple((await conn.execute(sql)).one())
+
+
 async def save_settings(engine: AsyncEngine, payload: dict[str, Any]) -> None:
     sql = text(
         """
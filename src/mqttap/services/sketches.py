@@ -0,0 +1,444 @@
+import math
+import re
+import struct
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from mqttap.db.dynamic import quote_ident
+from mqttap.services.watermarks import write_watermarks
+
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_MAX_BINS = 2048
+SKETCH_BUCKET_SECONDS = 60
+SKETCH_FORMAT_VERSION = 1
+# Rows read and sketch buckets buffered at a time when sketches are rebuilt.
+REBUILD_BATCH_ROWS = 10000
+
+_MIN_INDEXABLE = 1e-9
+_quantile_agg_re = re.compile(r"^p(\d{1,2}(?:\.\d+)?)$")
+_header = struct.Struct("<Bddd")
+
+
+def parse_quantile_agg(agg: str | None) -> float | None:
+    """Return the quantile for aggregations like ``p95``/``p99.9``, otherwise None."""
+    if not agg:
+        return None
+    match = _quantile_agg_re.match(agg.strip().lower())
+    if not match:
+        return None
+    value = float(match.group(1))
+    if not 0 <= value <= 100:
+        return None
+    return value / 100
+
+
+def sketch_bucket(ts: datetime) -> datetime:
+    epoch = int(ts.timestamp())
+    start = epoch - epoch % SKETCH_BUCKET_SECONDS
+    return datetime.fromtimestamp(start, tz=timezone.utc)
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varint(data: bytes, offset: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, offset
+        shift += 7
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+def _unzigzag(value: int) -> int:
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+class DDSketch:
+    """Mergeable quantile sketch with relative-error guarantees (DDSketch).
+
+    Values are mapped to logarithmic bins, so two sketches built with the same
+    accuracy can be merged by adding bin counts.
+    """
+
+    def __init__(
+        self,
+        relative_accuracy: float = SKETCH_RELATIVE_ACCURACY,
+        max_bins: int = SKETCH_MAX_BINS,
+    ) -> None:
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.positive: dict[int, int] = {}
+        self.negative: dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _key(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, key: int) -> float:
+        return 2 * self._gamma**key / (self._gamma + 1)
+
+    def add(self, value: float) -> None:
+        if not math.isfinite(value):
+            return
+        if value > _MIN_INDEXABLE:
+            key = self._key(value)
+            self.positive[key] = self.positive.get(key, 0) + 1
+            self._collapse(self.positive)
+        elif value < -_MIN_INDEXABLE:
+            key = self._key(-value)
+            self.negative[key] = self.negative.get(key, 0) + 1
+            self._collapse(self.negative)
+        else:
+            self.zero_count += 1
+        self.count += 1
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "DDSketch") -> None:
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        for key, count in other.positive.items():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in other.negative.items():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self._collapse(self.positive)
+        self._collapse(self.negative)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def _collapse(self, bins: dict[int, int]) -> None:
+        # Fold the lowest-magnitude bins together; high quantiles keep their accuracy.
+        if len(bins) <= self.max_bins:
+            return
+        keys = sorted(bins)
+        excess = len(keys) - self.max_bins
+        target = keys[excess]
+        for key in keys[:excess]:
+            bins[target] += bins.pop(key)
+
+    def quantile(self, q: float) -> float | None:
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return self._clamp(-self._value(key))
+        seen += self.zero_count
+        if seen > rank:
+            return self._clamp(0.0)
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._clamp(self._value(key))
+        return self.max
+
+    def _clamp(self, value: float) -> float:
+        return min(max(value, self.min), self.max)
+
+    def to_bytes(self) -> bytes:
+        out = bytearray(
+            _header.pack(SKETCH_FORMAT_VERSION, self.relative_accuracy, self.min, self.max)
+        )
+        _write_varint(out, self.count)
+        _write_varint(out, self.zero_count)
+        for bins in (self.positive, self.negative):
+            _write_varint(out, len(bins))
+            previous = 0
+            for key in sorted(bins):
+                _write_varint(out, _zigzag(key - previous))
+                _write_varint(out, bins[key])
+                previous = key
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "DDSketch":
+        version, accuracy, min_value, max_value = _header.unpack_from(data, 0)
+        if version != SKETCH_FORMAT_VERSION:
+            raise ValueError(f"Unsupported sketch format: {version}")
+        sketch = cls(relative_accuracy=accuracy)
+        sketch.min = min_value
+        sketch.max = max_value
+        offset = _header.size
+        sketch.count, offset = _read_varint(data, offset)
+        sketch.zero_count, offset = _read_varint(data, offset)
+        for bins in (sketch.positive, sketch.negative):
+            size, offset = _read_varint(data, offset)
+            key = 0
+            for _ in range(size):
+                delta, offset = _read_varint(data, offset)
+                count, offset = _read_varint(data, offset)
+                key += _unzigzag(delta)
+                bins[key] = count
+        return sketch
+
+
+def _is_sketchable(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class SketchBuffer:
+    """Per-minute sketches collected from the ingest stream until the next flush."""
+
+    def __init__(self) -> None:
+        self._pending: dict[tuple[str, str, datetime], DDSketch] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, table_name: str, field: str, ts: datetime, value: Any) -> None:
+        if not _is_sketchable(value):
+            return
+        key = (table_name, field, sketch_bucket(ts))
+        sketch = self._pending.get(key)
+        if sketch is None:
+            sketch = self._pending[key] = DDSketch()
+        sketch.add(float(value))
+
+    def add_values(self, table_name: str, ts: datetime, values: dict[str, Any]) -> None:
+        for field, value in values.items():
+            self.add(table_name, field, ts, value)
+
+    async def write(self, conn: AsyncConnection) -> list[str]:
+        """Merge pending sketches into ``topic_sketches`` inside the transaction of ``conn``.
+
+        Returns the tables written; their watermarks are left to the caller.
+        """
+        if not self._pending:
+            return []
+        pending, self._pending = self._pending, {}
+        try:
+            await _merge_sketches(conn, pending)
+        except BaseException:
+            self._restore(pending)
+            raise
+        return sorted({key[0] for key in pending})
+
+    async def flush(self, engine: AsyncEngine) -> int:
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        try:
+            async with engine.begin() as conn:
+                await _merge_sketches(conn, pending)
+                await write_watermarks.record(conn, {key[0] for key in pending})
+        except BaseException:
+            # Keep the sketches for the next flush; values added meanwhile are merged in.
+            self._restore(pending)
+            raise
+        # Quantile responses change when sketches land, not when raw rows do.
+        for table_name in sorted({key[0] for key in pending}):
+            write_watermarks.bump(table_name)
+        return len(pending)
+
+    def _restore(self, pending: dict[tuple[str, str, datetime], DDSketch]) -> None:
+        for key, sketch in pending.items():
+            newer = self._pending.get(key)
+            if newer is not None:
+                sketch.merge(newer)
+            self._pending[key] = sketch
+
+
+async def _merge_sketches(
+    conn: AsyncConnection, pending: dict[tuple[str, str, datetime], DDSketch]
+) -> None:
+    # Every writer takes its rows in key order, compared bytewise ("C" collation, which
+    # is also how Python sorts the UTF-8 names): missing rows are created as empty
+    # placeholders first, so concurrent writers of a new minute queue on the same row
+    # instead of both inserting it, and the locked read then sees every row it merges.
+    keys = sorted(pending)
+    empty = DDSketch().to_bytes()
+    await conn.execute(
+        text(
+            """
+            INSERT INTO topic_sketches (table_name, field, bucket, sketch, updated_at)
+            VALUES (:table_name, :field, :bucket, :sketch, now())
+            ON CONFLICT (table_name, field, bucket) DO NOTHING
+            """
+        ),
+        [
+            {"table_name": table_name, "field": field, "bucket": bucket, "sketch": empty}
+            for table_name, field, bucket in keys
+        ],
+    )
+    rows = (
+        await conn.execute(
+            text(
+                """
+                SELECT table_name, field, bucket, sketch
+                FROM topic_sketches
+                WHERE (table_name, field, bucket) IN (
+                    SELECT * FROM unnest(
+                        CAST(:tables AS text[]),
+                        CAST(:fields AS text[]),
+                        CAST(:buckets AS timestamptz[])
+                    )
+                )
+                ORDER BY table_name COLLATE "C", field COLLATE "C", bucket
+                FOR UPDATE
+                """
+            ),
+            {
+                "tables": [key[0] for key in keys],
+                "fields": [key[1] for key in keys],
+                "buckets": [key[2] for key in keys],
+            },
+        )
+    ).mappings().all()
+    merged: list[dict[str, Any]] = []
+    for row in rows:
+        # Merge into the stored sketch so ``pending`` stays intact if the write fails.
+        sketch = DDSketch.from_bytes(row["sketch"])
+        sketch.merge(pending[(row["table_name"], row["field"], row["bucket"])])
+        merged.append(
+            {
+                "table_name": row["table_name"],
+                "field": row["field"],
+                "bucket": row["bucket"],
+                "sketch": sketch.to_bytes(),
+            }
+        )
+    await conn.execute(
+        text(
+            """
+            UPDATE topic_sketches
+            SET sketch = :sketch, updated_at = now()
+            WHERE table_name = :table_name AND field = :field AND bucket = :bucket
+            """
+        ),
+        merged,
+    )
+
+
+async def rebuild_sketches(
+    conn: AsyncConnection,
+    table_name: str,
+    fields: list[str],
+    dt_from: datetime,
+    dt_to: datetime,
+) -> None:
+    """Recompute the sketches of ``fields`` for the minutes covering [dt_from, dt_to].
+
+    Used after rows in that range were merged or updated in place, which additive
+    sketches cannot follow. Rows are streamed, so memory is bounded by the buffer.
+    """
+    start = sketch_bucket(dt_from)
+    end = sketch_bucket(dt_to) + timedelta(seconds=SKETCH_BUCKET_SECONDS)
+    params = {"table_name": table_name, "fields": fields, "start": start, "end": end}
+    # Lock in the same key order as the ingest writer before deleting.
+    await conn.execute(
+        text(
+            """
+            SELECT 1 FROM topic_sketches
+            WHERE table_name = :table_name AND field = ANY(:fields)
+              AND bucket >= :start AND bucket < :end
+            ORDER BY table_name COLLATE "C", field COLLATE "C", bucket
+            FOR UPDATE
+            """
+        ),
+        params,
+    )
+    await conn.execute(
+        text(
+            """
+            DELETE FROM topic_sketches
+            WHERE table_name = :table_name AND field = ANY(:fields)
+              AND bucket >= :start AND bucket < :end
+            """
+        ),
+        params,
+    )
+    select_cols = ", ".join(quote_ident(field) for field in ["ts", *fields])
+    rows = await conn.stream(
+        text(f"SELECT {select_cols} FROM {quote_ident(table_name)} WHERE ts >= :start AND ts < :end"),
+        {"start": start, "end": end},
+    )
+    buffer = SketchBuffer()
+    async for partition in rows.mappings().partitions(REBUILD_BATCH_ROWS):
+        for row in partition:
+            buffer.add_values(table_name, row["ts"], {field: row[field] for field in fields})
+        if len(buffer) >= REBUILD_BATCH_ROWS:
+            await buffer.write(conn)
+    await buffer.write(conn)
+
+
+async def query_quantiles(
+    engine: AsyncEngine,
+    table_name: str,
+    fields: list[str],
+    dt_from: datetime | None,
+    dt_to: datetime | None,
+    quantile: float,
+    interval: timedelta,
+) -> list[dict[str, Any]]:
+    """Merge stored per-minute sketches into ``interval`` buckets and read a quantile.
+
+    Sketches cover whole minutes: the minutes containing ``dt_from`` and the instant
+    before ``dt_to`` are included entirely.
+    """
+    where = ["table_name = :table_name", "field = ANY(:fields)"]
+    params: dict[str, Any] = {
+        "table_name": table_name,
+        "fields": fields,
+        "interval": interval,
+    }
+    if dt_from:
+        where.append("bucket >= :from_ts")
+        params["from_ts"] = sketch_bucket(dt_from)
+    if dt_to:
+        where.append("bucket < :to_ts")
+        params["to_ts"] = dt_to
+    sql = text(
+        f"""
+        SELECT date_bin(:interval, bucket, '1970-01-01') AS bucket, field, sketch
+        FROM topic_sketches
+        WHERE {' AND '.join(where)}
+        ORDER BY bucket
+        """
+    )
+    async with engine.begin() as conn:
+        rows = (await conn.execute(sql, params)).mappings().all()
+
+    merged: dict[datetime, dict[str, DDSketch]] = {}
+    for row in rows:
+        by_field = merged.setdefault(row["bucket"], {})
+        sketch = DDSketch.from_bytes(row["sketch"])
+        if row["field"] in by_field:
+            by_field[row["field"]].merge(sketch)
+        else:
+            by_field[row["field"]] = sketch
+    result: list[dict[str, Any]] = []
+    for bucket, by_field in merged.items():
+        item: dict[str, Any] = {"bucket": bucket}
+        for field in fields:
+            sketch = by_field.get(field)
+            item[field] = sketch.quantile(quantile) if sketch else None
+        result.append(item)
+    return result
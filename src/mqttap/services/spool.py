@@ -0,0 +1,94 @@
+import base64
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class IngestMessage:
+    topic: str
+    payload: bytes
+    received_at: datetime
+    # Acknowledges the message to the broker once it is written (persistent sessions).
+    ack: Callable[[], None] | None = field(default=None, repr=False)
+    # Read back from the spool; the spool keeps it until :meth:`MessageSpool.replayed`.
+    spooled: bool = False
+
+
+class MessageSpool:
+    """Messages left unwritten when ingest stopped, kept in a local JSON lines file.
+
+    The consumer appends to it when a drain runs out of time and takes everything
+    back at its next start, before it subscribes again. Taken messages are moved to a
+    ``.replaying`` file that is only removed once they are written or spooled again,
+    so a crash during the replay repeats it instead of losing them.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.replaying_path = f"{path}.replaying"
+
+    def append(self, messages: list[IngestMessage]) -> int:
+        if not messages:
+            return 0
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as spool:
+            for message in messages:
+                record = {
+                    "topic": message.topic,
+                    "payload": base64.b64encode(message.payload).decode("ascii"),
+                    "received_at": message.received_at.isoformat(),
+                }
+                spool.write(json.dumps(record) + "\n")
+            spool.flush()
+            os.fsync(spool.fileno())
+        return len(messages)
+
+    def take(self) -> list[IngestMessage]:
+        """Move the spooled messages aside for replay and return them."""
+        if os.path.exists(self.replaying_path):
+            # A replay was cut short by a crash; it is repeated along with anything
+            # spooled since.
+            if os.path.exists(self.path):
+                with open(self.path, "rb") as spool, open(self.replaying_path, "ab") as replaying:
+                    replaying.write(spool.read())
+                    replaying.flush()
+                    os.fsync(replaying.fileno())
+                os.remove(self.path)
+        else:
+            try:
+                os.replace(self.path, self.replaying_path)
+            except FileNotFoundError:
+                return []
+        with open(self.replaying_path, encoding="utf-8") as replaying:
+            lines = replaying.readlines()
+        messages = []
+        for number, line in enumerate(lines, start=1):
+            try:
+                record = json.loads(line)
+                messages.append(
+                    IngestMessage(
+                        topic=record["topic"],
+                        payload=base64.b64decode(record["payload"]),
+                        received_at=datetime.fromisoformat(record["received_at"]),
+                        spooled=True,
+                    )
+                )
+            except (ValueError, KeyError, TypeError):
+                # A line cut short by a crash while spooling; the rest is still usable.
+                logger.warning("Skipping unreadable line %s of %s", number, self.replaying_path)
+        return messages
+
+    def replayed(self) -> None:
+        """Forget the taken messages; each is written or back in the spool."""
+        try:
+            os.remove(self.replaying_path)
+        except FileNotFoundError:
+            pass
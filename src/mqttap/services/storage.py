@@ -1,20 +1,32 @@
 import json
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from typing import Any
 
-from sqlalchemy import text
+from sqlalchemy import TextClause, text
 from sqlalchemy.ext.asyncio import AsyncEngine
 
 from mqttap.config import settings
 from mqttap.db.dynamic import (
+    ColumnSpec,
     ensure_columns,
     ensure_topic_table,
-    infer_column_spec,
+    get_table_columns,
+    insert_columns,
+    insert_statement,
     json_key_to_column,
     normalize_value_for_column,
     topic_to_table,
     widen_column,
     _infer_type,
 )
+from mqttap.services.backfills import backfill_log
+from mqttap.services.latest import latest_values
+from mqttap.services.sketches import SketchBuffer
+from mqttap.services.spool import IngestMessage
+from mqttap.services.topic_stats import topic_stats
+from mqttap.services.watermarks import write_watermarks
 
 
 def _round_float(value: float, precision: int) -> float:
@@ -37,7 +49,13 @@ def _parse_payload(payload: bytes) -> Any:
         return text_value
 
 
+# Topics known to be in topic_registry; entries are never removed while running.
+_registered_topics: set[str] = set()
+
+
 async def _register_topic(engine: AsyncEngine, topic: str, table_name: str, is_json: bool) -> None:
+    if topic in _registered_topics:
+        return
     sql = text(
         """
         INSERT INTO topic_registry (topic, table_name, is_json)
@@ -47,56 +65,129 @@ async def _register_topic(engine: AsyncEngine, topic: str, table_name: str, is_j
     )
     async with engine.begin() as conn:
         await conn.execute(sql, {"topic": topic, "table_name": table_name, "is_json": is_json})
+    _registered_topics.add(topic)
 
 
-async def store_message(engine: AsyncEngine, topic: str, payload: bytes, float_precision: int) -> None:
-    topic_str = str(topic)
-    parsed = _parse_payload(payload)
-    is_json = isinstance(parsed, dict)
-    table_name = topic_to_table(topic_str, is_json=is_json)
-
-    await ensure_topic_table(engine, table_name, is_json=is_json)
-    await _register_topic(engine, topic_str, table_name, is_json=is_json)
-
-    if is_json:
-        await _store_json(engine, table_name, parsed, float_precision)
-    else:
-        await _store_scalar(engine, table_name, parsed, float_precision)
+@dataclass
+class _PreparedRow:
+    table_name: str
+    statement: TextClause
+    params: dict[str, Any]
+    values: dict[str, Any]
+    sketch_values: dict[str, Any]
+    size: int
 
 
-async def _store_json(
-    engine: AsyncEngine, table_name: str, payload: dict[str, Any], float_precision: int
+async def store_messages(
+    engine: AsyncEngine,
+    messages: list[IngestMessage],
+    float_precision: int,
+    sketches: SketchBuffer | None = None,
 ) -> None:
-    columns = []
-    values: dict[str, Any] = {}
-    for key, value in payload.items():
-        col = json_key_to_column(key)
-        value = _normalize_value(value, float_precision)
-        columns.append(infer_column_spec(col, value))
-        values[col] = value
-
-    existing = await ensure_columns(engine, table_name, columns)
-
-    # Widen types if needed
-    for col_name, value in values.items():
-        current_type = existing.get(col_name, "text")
-        incoming_type = _infer_type(value)
-        new_type = None
-        if current_type != incoming_type:
-            if current_type == "bigint" and incoming_type == "double precision":
-                new_type = "double precision"
-            else:
-                new_type = "text"
-        if new_type:
+    """Insert ``messages`` in one transaction, after the schema changes they need.
+
+    The columns of each JSON topic table are read and extended once per batch, and rows
+    sharing an INSERT statement are sent together with one executemany.
+
+    Rows are stamped with the time their message was received, so queued or spooled
+    messages keep it. Rows old enough that API processes may already have cached their
+    aggregate buckets as final are recorded in the backfill log.
+    """
+    parsed_messages = []
+    json_payloads: dict[str, list[dict[str, Any]]] = {}
+    for message in messages:
+        parsed = _parse_payload(message.payload)
+        is_json = isinstance(parsed, dict)
+        table_name = topic_to_table(message.topic, is_json=is_json)
+        await ensure_topic_table(engine, table_name, is_json=is_json)
+        await _register_topic(engine, message.topic, table_name, is_json=is_json)
+        if is_json:
+            parsed = {
+                json_key_to_column(key): _normalize_value(value, float_precision)
+                for key, value in parsed.items()
+            }
+            json_payloads.setdefault(table_name, []).append(parsed)
+        parsed_messages.append((message, table_name, is_json, parsed))
+
+    table_columns = {
+        table_name: await _resolve_columns(engine, table_name, payloads)
+        for table_name, payloads in json_payloads.items()
+    }
+    rows = []
+    for message, table_name, is_json, parsed in parsed_messages:
+        if is_json:
+            row = _prepare_json(table_name, table_columns[table_name], parsed)
+        else:
+            row = _prepare_scalar(table_name, parsed, float_precision)
+        row.params["ts"] = message.received_at
+        row.size = len(message.payload)
+        rows.append(row)
+    statements: dict[TextClause, list[dict[str, Any]]] = {}
+    for row in rows:
+        statements.setdefault(row.statement, []).append(row.params)
+
+    # Half the seal window leaves room for the time the transaction takes to commit.
+    late_before = datetime.now(timezone.utc) - timedelta(seconds=settings.agg_cache_seal_seconds / 2)
+    late: dict[str, datetime] = {}
+    for message, row in zip(messages, rows):
+        if message.received_at < min(late_before, late.get(row.table_name, late_before)):
+            late[row.table_name] = message.received_at
+
+    async with engine.begin() as conn:
+        for statement, params in statements.items():
+            await conn.execute(statement, params)
+        for table_name, since in late.items():
+            await backfill_log.record(conn, table_name, since)
+        await write_watermarks.record(conn, {row.table_name for row in rows})
+
+    for table_name in {row.table_name for row in rows}:
+        write_watermarks.bump(table_name)
+    for row in rows:
+        ts = row.params["ts"]
+        latest_values.update(row.table_name, ts, row.values)
+        topic_stats.record_message(row.table_name, ts, row.size)
+        if sketches is not None:
+            sketches.add_values(row.table_name, ts, row.sketch_values)
+
+
+async def _resolve_columns(
+    engine: AsyncEngine, table_name: str, payloads: list[dict[str, Any]]
+) -> dict[str, str]:
+    """Columns of ``table_name`` once they are added or widened to fit ``payloads``."""
+    existing = await get_table_columns(engine, table_name)
+    wanted: dict[str, str] = {}
+    for values in payloads:
+        for col_name, value in values.items():
+            current_type = wanted.get(col_name, existing.get(col_name))
+            incoming_type = _infer_type(value)
+            if current_type is None:
+                wanted[col_name] = incoming_type
+            elif current_type != incoming_type:
+                if current_type == "bigint" and incoming_type == "double precision":
+                    wanted[col_name] = "double precision"
+                else:
+                    wanted[col_name] = "text"
+    missing = [ColumnSpec(name, type_name) for name, type_name in wanted.items() if name not in existing]
+    schema_changed = bool(missing)
+    if missing:
+        existing, _ = await ensure_columns(engine, table_name, missing)
+    for col_name, new_type in wanted.items():
+        if existing.get(col_name) != new_type:
             await widen_column(engine, table_name, col_name, new_type)
             existing[col_name] = new_type
+            schema_changed = True
+    if schema_changed:
+        topic_stats.record_schema_change(table_name)
+    return existing
 
+
+def _prepare_json(table_name: str, existing: dict[str, str], values: dict[str, Any]) -> _PreparedRow:
     values = {k: normalize_value_for_column(v, existing.get(k, "text")) for k, v in values.items()}
-    column_names = ", ".join([f'"{k}"' for k in values.keys()])
-    placeholders = ", ".join([f":{k}" for k in values.keys()])
-    sql = text(f'INSERT INTO "{table_name}" ({column_names}) VALUES ({placeholders})')
-    async with engine.begin() as conn:
-        await conn.execute(sql, values)
+    # Always insert every column in the same order so payloads with different key
+    # order or missing keys share one prepared statement per table.
+    columns = ("ts", *insert_columns(existing))
+    params = {column: values.get(column) for column in columns}
+    return _PreparedRow(table_name, insert_statement(table_name, columns), params, values, values, 0)
 
 
 def _infer_logical_type(value: Any) -> str:
@@ -113,9 +204,7 @@ def _infer_logical_type(value: Any) -> str:
     return "json"
 
 
-async def _store_scalar(
-    engine: AsyncEngine, table_name: str, value: Any, float_precision: int
-) -> None:
+def _prepare_scalar(table_name: str, value: Any, float_precision: int) -> _PreparedRow:
     value = _normalize_value(value, float_precision)
     value_type = _infer_logical_type(value)
 
@@ -139,14 +228,18 @@ async def _store_scalar(
     else:
         data["value_text"] = None if value is None else str(value)
 
-    sql = text(
+    numeric = data["value_float"] if value_type == "float" else data["value_int"]
+    return _PreparedRow(table_name, _scalar_statement(table_name), dict(data), data, {"value": numeric}, 0)
+
+
+@lru_cache(maxsize=1024)
+def _scalar_statement(table_name: str) -> TextClause:
+    return text(
         f"""
         INSERT INTO "{table_name}" (
-            value_type, value_int, value_float, value_bool, value_text, value_json
+            ts, value_type, value_int, value_float, value_bool, value_text, value_json
         ) VALUES (
-            :value_type, :value_int, :value_float, :value_bool, :value_text, :value_json
+            :ts, :value_type, :value_int, :value_float, :value_bool, :value_text, :value_json
         )
         """
     )
-    async with engine.begin() as conn:
-        await conn.execute(sql, data)
@@ -0,0 +1,242 @@
+import math
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from mqttap.db.dynamic import quote_ident
+
+# Time constant of the message-rate EWMA: a burst fades to 1/e after this many seconds.
+RATE_WINDOW_SECONDS = 60.0
+
+
+@dataclass
+class _Pending:
+    message_count: int = 0
+    bytes: int = 0
+    schema_changes: int = 0
+    first_ts: datetime | None = None
+    last_ts: datetime | None = None
+
+
+@dataclass
+class _Rate:
+    value: float
+    at: datetime
+
+    def decayed(self, now: datetime) -> float:
+        elapsed = max((now - self.at).total_seconds(), 0.0)
+        return self.value * math.exp(-elapsed / RATE_WINDOW_SECONDS)
+
+
+class TopicStats:
+    """Per-table ingest counters, accumulated in memory and added to ``topic_stats`` on flush.
+
+    The message rate is an exponentially decaying event rate (messages per second), so
+    it is updated in O(1) per message and simply decays when a topic goes quiet.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pending: dict[str, _Pending] = {}
+        self._rates: dict[str, _Rate] = {}
+
+    def record_message(self, table_name: str, ts: datetime, size: int) -> None:
+        with self._lock:
+            pending = self._pending.setdefault(table_name, _Pending())
+            pending.message_count += 1
+            pending.bytes += size
+            if pending.first_ts is None or ts < pending.first_ts:
+                pending.first_ts = ts
+            if pending.last_ts is None or ts > pending.last_ts:
+                pending.last_ts = ts
+            rate = self._rates.get(table_name)
+            if rate is None:
+                self._rates[table_name] = _Rate(1 / RATE_WINDOW_SECONDS, ts)
+            elif ts >= rate.at:
+                self._rates[table_name] = _Rate(rate.decayed(ts) + 1 / RATE_WINDOW_SECONDS, ts)
+
+    def record_schema_change(self, table_name: str) -> None:
+        with self._lock:
+            self._pending.setdefault(table_name, _Pending()).schema_changes += 1
+
+    def overlay(self, rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """Add counters that have not been flushed yet to rows read from ``topic_stats``."""
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            pending = {name: _Pending(**vars(item)) for name, item in self._pending.items()}
+            rates = dict(self._rates)
+        result = []
+        for row in rows:
+            item = dict(row)
+            extra = pending.get(item["table_name"])
+            if extra is not None:
+                item["message_count"] = (item.get("message_count") or 0) + extra.message_count
+                item["bytes"] = (item.get("bytes") or 0) + extra.bytes
+                item["schema_changes"] = (item.get("schema_changes") or 0) + extra.schema_changes
+                item["first_ts"] = _earliest(item.get("first_ts"), extra.first_ts)
+                item["last_ts"] = _latest(item.get("last_ts"), extra.last_ts)
+            rate = rates.get(item["table_name"])
+            if rate is not None:
+                item["rate"] = rate.decayed(now)
+            elif item.get("rate_ewma") is not None and item.get("rate_at") is not None:
+                item["rate"] = _Rate(item["rate_ewma"], item["rate_at"]).decayed(now)
+            else:
+                item["rate"] = None
+            item.pop("rate_ewma", None)
+            item.pop("rate_at", None)
+            result.append(item)
+        return result
+
+    async def load(self, engine: AsyncEngine) -> None:
+        sql = text(
+            "SELECT table_name, rate_ewma, rate_at FROM topic_stats WHERE rate_at IS NOT NULL"
+        )
+        async with engine.begin() as conn:
+            rows = (await conn.execute(sql)).mappings().all()
+        with self._lock:
+            for row in rows:
+                current = self._rates.get(row["table_name"])
+                if current is None or current.at < row["rate_at"]:
+                    self._rates[row["table_name"]] = _Rate(row["rate_ewma"], row["rate_at"])
+
+    async def flush(self, engine: AsyncEngine) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            rates = {name: self._rates.get(name) for name in pending}
+        if not pending:
+            return 0
+        params = [
+            {
+                "table_name": table_name,
+                "message_count": item.message_count,
+                "bytes": item.bytes,
+                "schema_changes": item.schema_changes,
+                "first_ts": item.first_ts,
+                "last_ts": item.last_ts,
+                "rate_ewma": rates[table_name].value if rates[table_name] else None,
+                "rate_at": rates[table_name].at if rates[table_name] else None,
+            }
+            for table_name, item in sorted(pending.items())
+        ]
+        sql = text(
+            """
+            INSERT INTO topic_stats (
+                table_name, message_count, bytes, schema_changes,
+                first_ts, last_ts, rate_ewma, rate_at, updated_at
+            ) VALUES (
+                :table_name, :message_count, :bytes, :schema_changes,
+                :first_ts, :last_ts, :rate_ewma, :rate_at, now()
+            )
+            ON CONFLICT (table_name) DO UPDATE SET
+                message_count = topic_stats.message_count + EXCLUDED.message_count,
+                bytes = topic_stats.bytes + EXCLUDED.bytes,
+                schema_changes = topic_stats.schema_changes + EXCLUDED.schema_changes,
+                first_ts = LEAST(topic_stats.first_ts, EXCLUDED.first_ts),
+                last_ts = GREATEST(topic_stats.last_ts, EXCLUDED.last_ts),
+                rate_ewma = COALESCE(EXCLUDED.rate_ewma, topic_stats.rate_ewma),
+                rate_at = COALESCE(EXCLUDED.rate_at, topic_stats.rate_at),
+                -- Left NULL until history_start() has scanned the table.
+                history_start = CASE WHEN topic_stats.history_start IS NOT NULL
+                    THEN LEAST(topic_stats.history_start, EXCLUDED.first_ts) END,
+                updated_at = now()
+            """
+        )
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(sql, params)
+        except Exception:
+            with self._lock:
+                for table_name, item in pending.items():
+                    self._merge_pending(table_name, item)
+            raise
+        return len(params)
+
+    async def record_history_start(
+        self, conn: AsyncConnection, table_name: str, since: datetime
+    ) -> None:
+        """Lower the recorded start of ``table_name``'s history for rows written before it.
+
+        Call it in the writing transaction. The upsert locks the stats row, so a concurrent
+        :meth:`history_start` either sees the rows or runs first and is lowered here.
+        """
+        await conn.execute(
+            text(
+                """
+                INSERT INTO topic_stats (table_name) VALUES (:table_name)
+                ON CONFLICT (table_name) DO UPDATE SET
+                    history_start = CASE WHEN topic_stats.history_start IS NOT NULL
+                        THEN LEAST(topic_stats.history_start, :since) END
+                """
+            ),
+            {"table_name": table_name, "since": since},
+        )
+
+    async def history_start(self, conn: AsyncConnection, table_name: str) -> datetime | None:
+        """Earliest ``ts`` in ``table_name``, scanned once and then kept in ``topic_stats``."""
+        params = {"table_name": table_name}
+        await conn.execute(
+            text(
+                "INSERT INTO topic_stats (table_name) VALUES (:table_name) "
+                "ON CONFLICT (table_name) DO NOTHING"
+            ),
+            params,
+        )
+        row = (
+            await conn.execute(
+                text(
+                    """
+                    SELECT history_start FROM topic_stats
+                    WHERE table_name = :table_name
+                    FOR UPDATE
+                    """
+                ),
+                params,
+            )
+        ).one()
+        if row.history_start is not None:
+            return _earliest(row.history_start, self._pending_first_ts(table_name))
+        # Scanned after taking the row lock, so it sees every writer that lowered it first.
+        history_start = (
+            await conn.execute(text(f"SELECT min(ts) FROM {quote_ident(table_name)}"))
+        ).scalar_one()
+        if history_start is not None:
+            await conn.execute(
+                text(
+                    "UPDATE topic_stats SET history_start = :history_start "
+                    "WHERE table_name = :table_name"
+                ),
+                {**params, "history_start": history_start},
+            )
+        return _earliest(history_start, self._pending_first_ts(table_name))
+
+    def _pending_first_ts(self, table_name: str) -> datetime | None:
+        with self._lock:
+            pending = self._pending.get(table_name)
+            return pending.first_ts if pending is not None else None
+
+    def _merge_pending(self, table_name: str, item: _Pending) -> None:
+        current = self._pending.setdefault(table_name, _Pending())
+        current.message_count += item.message_count
+        current.bytes += item.bytes
+        current.schema_changes += item.schema_changes
+        current.first_ts = _earliest(current.first_ts, item.first_ts)
+        current.last_ts = _latest(current.last_ts, item.last_ts)
+
+
+def _earliest(left: datetime | None, right: datetime | None) -> datetime | None:
+    if left is None or right is None:
+        return left or right
+    return min(left, right)
+
+
+def _latest(left: datetime | None, right: datetime | None) -> datetime | None:
+    if left is None or right is None:
+        return left or right
+    return max(left, right)
+
+
+topic_stats = TopicStats()
@@ -0,0 +1,96 @@
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Iterable
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+# How long write counters read from the database are reused before they are read again.
+DATABASE_REFRESH_SECONDS = 1.0
+
+DATABASE_WRITES_SQL = """
+    SELECT table_name, version::text AS writes
+    FROM topic_writes
+    WHERE table_name = ANY(:table_names)
+"""
+# Names are sorted, so concurrent writers lock the counter rows in the same order.
+RECORD_WRITES_SQL = """
+    INSERT INTO topic_writes (table_name, version, updated_at)
+    SELECT table_name, 1, now() FROM unnest(CAST(:table_names AS text[])) AS table_name
+    ON CONFLICT (table_name) DO UPDATE SET version = topic_writes.version + 1, updated_at = now()
+"""
+
+
+class WriteWatermarks:
+    """Per-table write counters, bumped by every storage write.
+
+    The ingest consumer runs in its own thread, so access is guarded by a lock. Tokens
+    carry a per-process epoch so counters that restart from zero never repeat a token
+    handed out before a restart.
+
+    Writers also bump a counter per table in ``topic_writes`` with :meth:`record`, in
+    the transaction of the write, so it changes exactly when the rows become visible.
+    When ingest runs in another process (API-only mode), ``track_database`` adds those
+    counters, read by :meth:`refresh` and reused for up to a second.
+    """
+
+    def __init__(self) -> None:
+        self._epoch = secrets.token_hex(4)
+        self._lock = threading.Lock()
+        self._versions: dict[str, int] = {}
+        self._last_write: dict[str, datetime] = {}
+        self.track_database = False
+        self._database_writes: dict[str, tuple[str, float]] = {}
+
+    def bump(self, table_name: str) -> None:
+        with self._lock:
+            self._versions[table_name] = self._versions.get(table_name, 0) + 1
+            self._last_write[table_name] = datetime.now(timezone.utc)
+
+    async def record(self, conn: AsyncConnection, table_names: Iterable[str]) -> None:
+        """Bump the shared counters of ``table_names`` inside the transaction of ``conn``.
+
+        The counter rows stay locked until the commit, so call it at the end of the
+        transaction.
+        """
+        await conn.execute(text(RECORD_WRITES_SQL), {"table_names": sorted(set(table_names))})
+
+    def token(self, table_name: str) -> str:
+        with self._lock:
+            version = self._versions.get(table_name, 0)
+            database = self._database_writes.get(table_name)
+        if database is None:
+            return f"{self._epoch}.{version}"
+        # Leave the process epoch out while nothing was written here, so every API
+        # worker hands out the same token.
+        return database[0] if version == 0 else f"{database[0]}.{self._epoch}.{version}"
+
+    async def refresh(self, engine: AsyncEngine, table_names: list[str]) -> None:
+        if not self.track_database:
+            return
+        now = time.monotonic()
+        with self._lock:
+            stale = sorted(
+                name
+                for name in set(table_names)
+                if name not in self._database_writes
+                or now - self._database_writes[name][1] >= DATABASE_REFRESH_SECONDS
+            )
+        if not stale:
+            return
+        async with engine.connect() as conn:
+            rows = (await conn.execute(text(DATABASE_WRITES_SQL), {"table_names": stale})).all()
+        writes = dict.fromkeys(stale, "")
+        writes.update({row.table_name: row.writes for row in rows})
+        with self._lock:
+            for name, value in writes.items():
+                self._database_writes[name] = (value, now)
+
+    def last_write(self, table_name: str) -> datetime | None:
+        with self._lock:
+            return self._last_write.get(table_name)
+
+
+write_watermarks = WriteWatermarks()